@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+""" Command line start-up benchmark.  Runs short upstream commands, such
+as --version and --help, many times over, each in a fresh interpreter as
+a job runner would, and reports how long they take from start to exit.
+A run of ``python -c pass`` is measured alongside, as the floor that no
+change to upstream can get below.
+
+Usage::
+
+    python benchmarks/bench_startup.py --runs 50 --json startup.json
+    python benchmarks/bench_startup.py --baseline startup.json
+    python benchmarks/bench_startup.py --importtime
+
+--importtime lists the modules that take longest to import along with
+upstream.clitool (Python 3.7 and later).
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#: Runs the tool the way the installed console script does
+ENTRY_POINT = 'from upstream.clitool import main; main()'
+
+#: Name and command line arguments of each case
+CASES = [
+    ('python', None),
+    ('--version', ['--version']),
+    ('--help', ['--help']),
+    ('upload --help', ['upload', '--help']),
+    ('download --help', ['download', '--help']),
+]
+
+
+def command(args):
+    """ Returns the argv running upstream with args, or a bare interpreter
+    for None
+    """
+    if args is None:
+        return [sys.executable, '-c', 'pass']
+    return [sys.executable, '-c', ENTRY_POINT] + args
+
+
+def environment():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    return env
+
+
+def time_run(argv, env):
+    """ Runs argv to completion and returns the wall time in seconds """
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        subprocess.call(argv, stdout=devnull, stderr=devnull, cwd=ROOT,
+                        env=env)
+        return time.time() - start
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(args):
+    """ Times every case; runs of the cases are interleaved, so that a
+    burst of load on the machine does not land on a single case.
+
+    :return: List of result dicts, one per case
+    """
+    env = environment()
+    times = dict((name, []) for name, _ in CASES)
+    for _ in range(args.warmup):
+        for name, case_args in CASES:
+            time_run(command(case_args), env)
+    for _ in range(args.runs):
+        for name, case_args in CASES:
+            times[name].append(time_run(command(case_args), env))
+    rows = []
+    for name, _ in CASES:
+        values = times[name]
+        rows.append({
+            'case': name,
+            'runs': len(values),
+            'min_ms': min(values) * 1000,
+            'median_ms': percentile(values, 0.5) * 1000,
+            'p90_ms': percentile(values, 0.9) * 1000,
+        })
+    return rows
+
+
+def print_rows(rows, out=sys.stdout):
+    print('%-18s %5s %9s %9s %9s'
+          % ('case', 'runs', 'min ms', 'median ms', 'p90 ms'), file=out)
+    for row in rows:
+        print('%-18s %5d %9.1f %9.1f %9.1f'
+              % (row['case'], row['runs'], row['min_ms'], row['median_ms'],
+                 row['p90_ms']), file=out)
+
+
+def import_times(top=15):
+    """ Returns the (cumulative microseconds, module) pairs of the top
+    slowest imports of upstream.clitool, from ``python -X importtime``.
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', 'import upstream.clitool'],
+        stderr=subprocess.STDOUT, cwd=ROOT, env=environment())
+    pairs = []
+    for line in output.decode('utf-8', 'replace').splitlines():
+        fields = line.split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        pairs.append((int(fields[1]), fields[2].strip()))
+    return sorted(pairs, reverse=True)[:top]
+
+
+def compare(rows, baseline, tolerance):
+    """ Returns descriptions of the cases whose median start-up time rose
+    more than tolerance (a fraction) above the baseline's.
+    """
+    expected = dict((row['case'], row['median_ms']) for row in baseline)
+    regressions = []
+    for row in rows:
+        before = expected.get(row['case'])
+        if before and row['median_ms'] > before * (1 + tolerance):
+            regressions.append('%s: %.1f ms, baseline %.1f ms'
+                               % (row['case'], row['median_ms'], before))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the start-up time of the upstream command '
+                    'line tool')
+    parser.add_argument('--runs', type=int, default=20,
+                        help='Times to run each case, default: 20')
+    parser.add_argument('--warmup', type=int, default=2,
+                        help='Untimed runs of each case first, to warm the '
+                             'file system cache, default: 2')
+    parser.add_argument('--importtime', action='store_true',
+                        help='List the slowest imports instead')
+    parser.add_argument('--json', help='Write results to this file')
+    parser.add_argument('--baseline',
+                        help='Results file to compare against; exits with '
+                             'status 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed rise in median start-up time against '
+                             'the baseline, default: 0.2')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.importtime:
+        for micros, module in import_times():
+            print('%9.1f ms  %s' % (micros / 1000, module))
+        return 0
+    rows = run(args)
+    print_rows(rows)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(rows, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('Regression: %s' % regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+""" End-to-end transfer benchmarks against a local stand-in web-core
+server.  Uploads and downloads a file of random data through Streamer for
+every combination of shard size, read size and number of jobs, and
+reports for each the throughput, the client CPU time per GB transferred
+and the client's peak resident memory.
+
+The stand-in server runs in its own process, and every measurement in a
+fresh process of its own, so that the CPU and memory figures are the
+client's alone.  Latency, a bandwidth cap and injected failures make the
+server behave more like a real, distant node.
+
+Usage::
+
+    python benchmarks/bench_transfer.py --size 256m --shard-sizes 8m,32m \\
+        --read-sizes 1k,64k --jobs 1,4 --json results.json
+    python benchmarks/bench_transfer.py --baseline results.json
+
+Unix only: it relies on the resource module.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import itertools
+import multiprocessing
+
+from six.moves.queue import Empty
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+from webcore import WebCore  # noqa: E402
+from upstream.shard import Shard  # noqa: E402
+from upstream.streamer import Streamer  # noqa: E402
+from upstream.clitool import parse_shard_size, fixed_shards  # noqa: E402
+from upstream.exc import TransferError  # noqa: E402
+
+
+class BenchmarkError(Exception):
+    """ A measurement could not be completed """
+
+
+def peak_rss():
+    """ Returns this process's peak resident memory in bytes """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def serve(options, queue):
+    """ Runs a stand-in server until terminated, sending its URL back """
+    server = WebCore(**options)
+    queue.put(server.url)
+    server.serve_forever()
+
+
+def run_case(case, queue):
+    """ Runs one upload or download and sends back its measurements """
+    streamer = Streamer(case['server'], pool_size=case['jobs'],
+                        upload_method=case['upload_method'])
+    plan = fixed_shards(case['size'], case['shard_size'])
+    uris = case.get('uris')
+    errors = {}
+    cpu, start = cpu_time(), time.time()
+    try:
+        if case['op'] == 'upload':
+            shards = streamer.upload_shards(
+                case['file'], plan, jobs=case['jobs'],
+                read_size=case['read_size'])
+            uris = [shard.uri for shard in shards]
+        else:
+            shards = []
+            for uri in uris:
+                shard = Shard()
+                shard.from_uri(uri)
+                shards.append(shard)
+            streamer.download_shards(
+                shards, case['dest'], jobs=case['jobs'],
+                sizes=[end - begin for begin, end in plan],
+                slicesize=case['read_size'])
+    except TransferError as e:
+        errors = e.errors
+    seconds = time.time() - start
+    cpu = cpu_time() - cpu
+    queue.put({
+        'seconds': seconds,
+        'cpu': cpu,
+        'rss': peak_rss(),
+        'failed': len(errors),
+        'uris': uris,
+    })
+
+
+def measure(case, timeout=600, poll=1):
+    """ Runs run_case() in a fresh process and returns its results
+
+    :param timeout: Seconds to wait for the results
+    :param poll: Seconds between checks that the process is still alive
+    :raise BenchmarkError: If the process dies or times out first
+    """
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=run_case, args=(case, queue))
+    proc.start()
+    deadline = time.time() + timeout
+    try:
+        while True:
+            alive = proc.is_alive()
+            try:
+                return queue.get(timeout=poll)
+            except Empty:
+                pass
+            if not alive:
+                # Checked before the last get, so that results sent just
+                # before exiting are not missed.
+                raise BenchmarkError(
+                    "%s process exited with code %s without results"
+                    % (case['op'], proc.exitcode))
+            if time.time() > deadline:
+                raise BenchmarkError("%s timed out after %d seconds"
+                                     % (case['op'], timeout))
+    finally:
+        if proc.is_alive():
+            proc.terminate()
+        proc.join()
+
+
+def make_file(size):
+    """ Writes size bytes of random data to a temporary file """
+    fd, path = tempfile.mkstemp(prefix='upstream-bench-')
+    with os.fdopen(fd, 'wb') as f:
+        remaining = size
+        while remaining:
+            block = min(remaining, 1048576)
+            f.write(os.urandom(block))
+            remaining -= block
+    return path
+
+
+def run(args):
+    """ Runs the whole benchmark matrix
+
+    :return: List of result dicts, one per measurement
+    """
+    queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=({
+        'latency': args.latency,
+        'bandwidth': parse_shard_size(args.bandwidth) or None,
+        'fail_rate': args.fail_rate,
+        'drop_rate': args.drop_rate,
+        'seed': args.seed,
+    }, queue))
+    server.daemon = True
+    server.start()
+    url = queue.get()
+
+    size = parse_shard_size(args.size)
+    path = make_file(size)
+    dest = path + '.download'
+    rows = []
+    try:
+        for shard_size, read_size, jobs in itertools.product(
+                args.shard_sizes, args.read_sizes, args.jobs):
+            case = {
+                'server': url,
+                'file': path,
+                'dest': dest,
+                'size': size,
+                'shard_size': shard_size,
+                'read_size': read_size,
+                'jobs': jobs,
+                'upload_method': args.upload_method,
+            }
+            for repeat in range(args.repeat):
+                case['op'] = 'upload'
+                uploaded = measure(case, args.timeout)
+                rows.append(result_row(case, uploaded))
+                if uploaded['failed']:
+                    continue
+                case['op'] = 'download'
+                case['uris'] = uploaded['uris']
+                rows.append(result_row(case, measure(case, args.timeout)))
+                del case['uris']
+                if os.path.exists(dest):
+                    os.remove(dest)
+    finally:
+        server.terminate()
+        os.remove(path)
+        if os.path.exists(dest):
+            os.remove(dest)
+    return rows
+
+
+def result_row(case, result):
+    seconds = max(result['seconds'], 1e-9)
+    row = dict((key, case[key]) for key in
+               ('op', 'size', 'shard_size', 'read_size', 'jobs',
+                'upload_method'))
+    row.update({
+        'seconds': seconds,
+        'mb_per_s': case['size'] / seconds / 1e6,
+        'cpu_s_per_gb': result['cpu'] / (case['size'] / 1e9),
+        'peak_rss_mib': result['rss'] / 1048576,
+        'failed': result['failed'],
+    })
+    return row
+
+
+def case_key(row):
+    return (row['op'], row['size'], row['shard_size'], row['read_size'],
+            row['jobs'], row['upload_method'])
+
+
+def print_rows(rows, out=sys.stdout):
+    header = ('%-8s %10s %9s %4s %9s %10s %9s %6s'
+              % ('op', 'shard', 'read', 'jobs', 'MB/s', 'CPU s/GB',
+                 'RSS MiB', 'failed'))
+    print(header, file=out)
+    for row in rows:
+        print('%-8s %10d %9d %4d %9.1f %10.2f %9.1f %6d'
+              % (row['op'], row['shard_size'], row['read_size'],
+                 row['jobs'], row['mb_per_s'], row['cpu_s_per_gb'],
+                 row['peak_rss_mib'], row['failed']), file=out)
+
+
+def compare(rows, baseline, tolerance):
+    """ Returns descriptions of the cases whose throughput fell more than
+    tolerance (a fraction) below the baseline's.
+    """
+    best = {}
+    for row in baseline:
+        key = case_key(row)
+        best[key] = max(best.get(key, 0), row['mb_per_s'])
+    regressions = []
+    for row in rows:
+        expected = best.get(case_key(row))
+        if expected and row['mb_per_s'] < expected * (1 - tolerance):
+            regressions.append(
+                '%s shard=%d read=%d jobs=%d: %.1f MB/s, baseline %.1f'
+                % (row['op'], row['shard_size'], row['read_size'],
+                   row['jobs'], row['mb_per_s'], expected))
+    return regressions
+
+
+def size_list(value):
+    return [parse_shard_size(item) for item in value.split(',')]
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark upstream transfers against a local '
+                    'stand-in web-core server')
+    parser.add_argument('--size', default='64m',
+                        help='Size of the file to transfer, default: 64m')
+    parser.add_argument('--shard-sizes', type=size_list, default='4m,16m',
+                        help='Comma separated shard sizes, default: 4m,16m')
+    parser.add_argument('--read-sizes', type=size_list, default='1k,64k',
+                        help='Comma separated read sizes, default: 1k,64k')
+    parser.add_argument('--jobs', type=int_list, default='1,4',
+                        help='Comma separated job counts, default: 1,4')
+    parser.add_argument('--upload-method', default='form',
+                        choices=sorted(Streamer.UPLOAD_METHODS))
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Times to run each case, default: 1')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds the server waits before answering')
+    parser.add_argument('--bandwidth', default='0',
+                        help='Per-connection bandwidth cap, bytes per '
+                             'second, e.g. 10m; default: no cap')
+    parser.add_argument('--fail-rate', type=float, default=0,
+                        help='Fraction of requests answered with 500')
+    parser.add_argument('--drop-rate', type=float, default=0,
+                        help='Fraction of downloads cut off half way')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed for injected failures')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='Seconds to wait for each measurement, '
+                             'default: 600')
+    parser.add_argument('--json', help='Write results to this file')
+    parser.add_argument('--baseline',
+                        help='Results file to compare throughput against; '
+                             'exits with status 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Allowed throughput drop against the '
+                             'baseline, default: 0.1')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        rows = run(args)
+    except BenchmarkError as e:
+        print('Benchmark failed: %s' % e, file=sys.stderr)
+        return 2
+    print_rows(rows)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(rows, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('Regression: %s' % regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
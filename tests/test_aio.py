@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import asyncio
+import hashlib
+import unittest
+import threading
+import mock
+
+from webcore import WebCore
+from upstream.aio import AsyncStreamer
+from upstream.shard import Shard
+from upstream.exc import (ConnectError, ResponseError, TransferError,
+                          IntegrityError)
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class TestAsyncStreamer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = WebCore().__enter__()
+        self.stream = AsyncStreamer(self.server.url, max_concurrency=2,
+                                    read_size=65536)
+        self.uploadfile = 'tests/one-meg.testfile'
+        self.downloadfile = 'download.testfile'
+        with open(self.uploadfile, 'rb') as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+        if os.path.exists(self.downloadfile):
+            os.remove(self.downloadfile)
+
+    def test_check_connectivity(self):
+        run(self.stream.check_connectivity())
+        with self.assertRaises(ConnectError):
+            run(AsyncStreamer('http://127.0.0.1:1').check_connectivity())
+
+    def test_check_connectivity_bad_response(self):
+        for error in (ResponseError("Malformed response from server."),
+                      ValueError("invalid literal for int()")):
+            with mock.patch.object(AsyncStreamer, '_request',
+                                   side_effect=error):
+                with self.assertRaises(ConnectError):
+                    run(self.stream.check_connectivity())
+
+    def test_upload_download(self):
+        shard = run(self.stream.upload(self.uploadfile, shard_size=300000,
+                                       start_pos=100))
+        self.assertEqual(self.server.files[shard.filehash],
+                         self.data[100:300100])
+        self.assertEqual(run(self.stream.download(shard)),
+                         self.data[100:300100])
+        self.assertEqual(run(self.stream.download(shard, offset=299990)),
+                         self.data[300090:300100])
+
+    def test_download_missing(self):
+        with self.assertRaises(ResponseError) as ex:
+            run(self.stream.download(Shard('abcdef', '0123')))
+        self.assertEqual(ex.exception.response.status_code, 404)
+
+    def test_upload_download_shards(self):
+        plan = [(0, 400000), (400000, 800000), (800000, 1048576)]
+        shards = run(self.stream.upload_shards(self.uploadfile, plan))
+        self.assertEqual(len(shards), 3)
+        written = run(self.stream.download_shards(shards, self.downloadfile))
+        self.assertEqual(written, len(self.data))
+        with open(self.downloadfile, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_download_shards_partial_failure(self):
+        shards = run(self.stream.upload_shards(
+            self.uploadfile, [(0, 1000), (1000, 2000)]))
+        shards.insert(1, Shard('abcdef', '0123'))
+        with self.assertRaises(TransferError) as ex:
+            run(self.stream.download_shards(shards, self.downloadfile,
+                                            sizes=[1000, 5, 1000]))
+        self.assertEqual(list(ex.exception.errors), [1])
+        self.assertEqual(ex.exception.results, [1000, None, 1000])
+
+    def test_download_shards_verifies_digest(self):
+        plan = [(0, 1000), (1000, 2000)]
+        shards = run(self.stream.upload_shards(self.uploadfile, plan))
+        shards[0].digest = hashlib.sha256(self.data[:1000]).hexdigest()
+        shards[1].digest = hashlib.sha256(b'something else').hexdigest()
+        with self.assertRaises(TransferError) as ex:
+            run(self.stream.download_shards(shards, self.downloadfile))
+        self.assertEqual(list(ex.exception.errors), [1])
+        self.assertIsInstance(ex.exception.errors[1], IntegrityError)
+        self.assertEqual(ex.exception.results[0], 1000)
+
+    def test_timeout(self):
+        shard = run(self.stream.upload(self.uploadfile, shard_size=1000))
+        self.server.latency = 1
+        stream = AsyncStreamer(self.server.url, timeout=0.2)
+        with self.assertRaises(asyncio.TimeoutError):
+            run(stream.download(shard))
+
+    def test_download_writes_off_the_loop(self):
+        shard = run(self.stream.upload(self.uploadfile, shard_size=300000))
+        threads = set()
+
+        def write_at(data, offset):
+            threads.add(threading.current_thread())
+            return len(data)
+        writer = mock.Mock(write_at=write_at)
+        self.assertEqual(run(self.stream.download_into(shard, writer, 0)),
+                         300000)
+        self.assertTrue(threads)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_limiter(self):
+        limiter = mock.Mock()
+        limiter.reserve.return_value = 0.001
+        stream = AsyncStreamer(self.server.url, read_size=65536,
+                               limiter=limiter)
+        shard = run(stream.upload(self.uploadfile, shard_size=300000))
+        sent = sum(args[0] for args, _ in limiter.reserve.call_args_list)
+        # The multipart framing around the data is counted too.
+        self.assertTrue(300000 < sent < 300500, sent)
+        limiter.reserve.reset_mock()
+        run(stream.download(shard))
+        self.assertEqual(
+            sum(args[0] for args, _ in limiter.reserve.call_args_list),
+            300000)
+
+
+if __name__ == '__main__':
+    unittest.main()
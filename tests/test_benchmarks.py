@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'benchmarks'))
+import bench_transfer  # noqa: E402
+
+
+class TestBenchTransfer(unittest.TestCase):
+
+    def test_measure_reports_dead_process(self):
+        # The process fails on the missing server and exits.
+        with self.assertRaises(bench_transfer.BenchmarkError) as ex:
+            bench_transfer.measure({'op': 'upload'}, timeout=30, poll=0.1)
+        self.assertIn('exited with code 1', str(ex.exception))
+
+    def test_compare(self):
+        row = {'op': 'upload', 'size': 100, 'shard_size': 10,
+               'read_size': 1, 'jobs': 1, 'upload_method': 'form',
+               'mb_per_s': 80.0}
+        baseline = [dict(row, mb_per_s=100.0)]
+        self.assertEqual(bench_transfer.compare([row], baseline, 0.25), [])
+        self.assertEqual(len(bench_transfer.compare([row], baseline, 0.1)),
+                         1)
+
+    def test_run(self):
+        args = bench_transfer.parse_args(
+            ['--size', '256k', '--shard-sizes', '128k', '--read-sizes',
+             '64k', '--jobs', '2'])
+        rows = bench_transfer.run(args)
+        self.assertEqual([row['op'] for row in rows],
+                         ['upload', 'download'])
+        self.assertTrue(all(row['failed'] == 0 and row['mb_per_s'] > 0
+                            for row in rows))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import time
+import shutil
+import threading
+import unittest
+
+from upstream.cache import ShardCache
+
+
+class TestShardCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = 'cache.testdir'
+        self.cache = ShardCache(self.root, max_size=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _writer(self, data, calls=None):
+        def _download(path):
+            if calls is not None:
+                calls.append(path)
+            with open(path, 'wb') as f:
+                f.write(data)
+        return _download
+
+    def test_fetch_once(self):
+        calls = []
+        path = self.cache.fetch('abcd', self._writer(b'1234', calls))
+        self.assertEqual(path, os.path.join(self.root, 'ab', 'abcd'))
+        self.assertEqual(self.cache.fetch('abcd', self._writer(b'', calls)),
+                         path)
+        self.assertEqual(len(calls), 1)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'1234')
+        self.assertEqual(self.cache.size(), 4)
+
+    def test_get_missing(self):
+        self.assertIs(self.cache.get('abcd'), None)
+
+    def _fail(self, path):
+        with open(path, 'wb') as f:
+            f.write(b'12')
+        raise IOError('connection lost')
+
+    def test_failed_fetch_leaves_nothing(self):
+        with self.assertRaises(IOError):
+            self.cache.fetch('abcd', self._fail)
+        self.assertIs(self.cache.get('abcd'), None)
+        self.assertEqual(os.listdir(os.path.join(self.root, 'ab')), [])
+
+    def test_evicts_least_recently_used(self):
+        old = self.cache.fetch('aa01', self._writer(b'1234'))
+        os.utime(old, (time.time() - 100, time.time() - 100))
+        used = self.cache.fetch('aa02', self._writer(b'1234'))
+        os.utime(used, (time.time() - 200, time.time() - 200))
+        self.cache.get('aa02')
+        self.cache.fetch('aa03', self._writer(b'1234'))
+        self.assertIs(self.cache.get('aa01'), None)
+        self.assertEqual(self.cache.get('aa02'), used)
+        self.assertEqual(self.cache.size(), 8)
+
+    def test_held_shard_is_not_evicted(self):
+        with self.cache.use('aa01', self._writer(b'123456')) as held:
+            path = self.cache.fetch('aa02', self._writer(b'123456'))
+            self.assertTrue(os.path.exists(held))
+            self.assertTrue(os.path.exists(path))
+        # Once released, the cache shrinks back under max_size.
+        self.assertIs(self.cache.get('aa01'), None)
+        self.assertEqual(self.cache.get('aa02'), path)
+        self.assertEqual(self.cache.size(), 6)
+
+    def test_fetch_keeps_new_shard(self):
+        self.cache.fetch('aa01', self._writer(b'123456'))
+        path = self.cache.fetch('aa02', self._writer(b'123456'))
+        self.assertTrue(os.path.exists(path))
+        self.assertIs(self.cache.get('aa01'), None)
+        self.assertEqual(self.cache.size(), 6)
+
+    def test_oversized_shard(self):
+        kept = self.cache.fetch('aa01', self._writer(b'1234'))
+        with self.cache.use('aa02', self._writer(b'x' * 20)) as path:
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'x' * 20)
+            self.assertEqual(self.cache.get('aa01'), kept)
+        self.assertIs(self.cache.get('aa02'), None)
+        self.assertEqual(self.cache.get('aa01'), kept)
+        self.assertEqual(self.cache.size(), 4)
+
+    def test_size_is_tracked(self):
+        self.cache.fetch('aa01', self._writer(b'1234'))
+        self.assertEqual(self.cache.size(), 4)
+        # Changes made behind the cache's back show up after a rescan.
+        os.remove(self.cache.path('aa01'))
+        self.assertEqual(self.cache.size(), 4)
+        self.cache.evict()
+        self.assertEqual(self.cache.size(), 0)
+
+    def test_locks_are_pruned(self):
+        self.cache.fetch('aa01', self._writer(b'1234'))
+        with self.assertRaises(IOError):
+            self.cache.fetch('aa02', self._fail)
+        self.assertEqual(self.cache._locks, {})
+        self.assertEqual(self.cache._pins, {})
+
+    def test_concurrent_fetches_collapse(self):
+        calls = []
+        started = threading.Event()
+
+        def _slow(path):
+            calls.append(path)
+            started.set()
+            time.sleep(0.1)
+            self._writer(b'1234')(path)
+
+        paths = []
+        threads = [threading.Thread(
+            target=lambda: paths.append(self.cache.fetch('abcd', _slow)))
+            for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(paths)), 1)
+
+    def test_waits_for_other_process(self):
+        os.makedirs(os.path.join(self.root, 'ab'))
+        lock = self.cache.path('abcd') + '.lock'
+        open(lock, 'w').close()
+
+        def _other_process():
+            time.sleep(0.2)
+            self._writer(b'1234')(self.cache.path('abcd'))
+            os.remove(lock)
+
+        thread = threading.Thread(target=_other_process)
+        thread.start()
+        calls = []
+        self.cache.fetch('abcd', self._writer(b'', calls))
+        thread.join()
+        self.assertEqual(calls, [])
+
+    def test_other_process_fails(self):
+        os.makedirs(os.path.join(self.root, 'ab'))
+        lock = self.cache.path('abcd') + '.lock'
+        open(lock, 'w').close()
+
+        def _other_process():
+            time.sleep(0.2)
+            os.remove(lock)
+
+        thread = threading.Thread(target=_other_process)
+        thread.start()
+        path = self.cache.fetch('abcd', self._writer(b'1234'))
+        thread.join()
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(lock))
+
+    def test_stale_lock_is_taken_over(self):
+        os.makedirs(os.path.join(self.root, 'ab'))
+        lock = self.cache.path('abcd') + '.lock'
+        open(lock, 'w').close()
+        os.utime(lock, (time.time() - 1000, time.time() - 1000))
+        path = self.cache.fetch('abcd', self._writer(b'1234'))
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(lock))
+
+    def test_lock_is_kept_during_long_download(self):
+        # Two caches on one directory stand in for two processes.
+        first = ShardCache(self.root, lock_timeout=0.5)
+        second = ShardCache(self.root, lock_timeout=0.5)
+        started = threading.Event()
+        calls = []
+        errors = []
+
+        def _slow(path):
+            calls.append(path)
+            started.set()
+            time.sleep(1.5)
+            self._writer(b'1234')(path)
+
+        def _fetch():
+            try:
+                first.fetch('abcd', _slow)
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=_fetch)
+        thread.start()
+        started.wait()
+        path = second.fetch('abcd', self._writer(b'', calls))
+        thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(calls), 1)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'1234')
+        self.assertFalse(os.path.exists(path + '.lock'))
+
+    def test_lock_taken_over_is_left_alone(self):
+        lock = self.cache.path('abcd') + '.lock'
+
+        def _taken_over(path):
+            with open(lock, 'w') as f:
+                f.write('other')
+            self._writer(b'1234')(path)
+
+        path = self.cache.fetch('abcd', _taken_over)
+        self.assertTrue(os.path.exists(path))
+        with open(lock) as f:
+            self.assertEqual(f.read(), 'other')
+
+    def test_link(self):
+        dest = 'cache.testfile'
+        self.cache.fetch('abcd', self._writer(b'1234'))
+        try:
+            self.cache.link('abcd', dest)
+            with open(dest, 'rb') as f:
+                self.assertEqual(f.read(), b'1234')
+        finally:
+            os.remove(dest)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import random
+import unittest
+
+from upstream.chunker import cdc_shards, boundary_mask
+
+
+class TestChunker(unittest.TestCase):
+
+    def setUp(self):
+        rand = random.Random(42)
+        self.data = bytes(bytearray(rand.getrandbits(8)
+                                    for _ in range(512 * 1024)))
+        self.path = 'chunker.testfile'
+        self.write(self.data)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def write(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+
+    def test_covers_file(self):
+        shards = cdc_shards(self.path, 16384, read_size=10000)
+        self.assertEqual(shards[0][0], 0)
+        self.assertEqual(shards[-1][1], len(self.data))
+        for prev, cur in zip(shards, shards[1:]):
+            self.assertEqual(prev[1], cur[0])
+
+    def test_size_limits(self):
+        shards = cdc_shards(self.path, 16384, min_size=4096, max_size=20000)
+        sizes = [end - start for start, end in shards]
+        self.assertTrue(all(4096 <= size <= 20000 for size in sizes[:-1]))
+        self.assertTrue(8192 < len(self.data) / len(shards) < 20000)
+
+    def test_read_size_does_not_matter(self):
+        self.assertEqual(cdc_shards(self.path, 16384, read_size=777),
+                         cdc_shards(self.path, 16384))
+
+    def test_insert_keeps_later_boundaries(self):
+        before = cdc_shards(self.path, 16384)
+        self.write(b'inserted' + self.data)
+        after = cdc_shards(self.path, 16384)
+        ends_before = set(end for start, end in before)
+        ends_after = set(end - 8 for start, end in after)
+        self.assertTrue(len(ends_before & ends_after) >= len(before) - 2)
+
+    def test_empty_and_small_files(self):
+        self.write(b'')
+        self.assertEqual(cdc_shards(self.path, 16384), [])
+        self.write(b'tiny')
+        self.assertEqual(cdc_shards(self.path, 16384), [(0, 4)])
+
+    def test_bad_sizes(self):
+        with self.assertRaises(ValueError):
+            cdc_shards(self.path, 16384, min_size=10, max_size=5)
+
+    def test_boundary_mask(self):
+        self.assertEqual(boundary_mask(1024), 0xffc0000000000000)
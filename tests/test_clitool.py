@@ -25,15 +25,32 @@
 
 import os
 import sys
+import subprocess
+import json
+import shutil
 import hashlib
+import tempfile
 import unittest
 import mock
+from six.moves import StringIO
+
+from webcore import WebCore
 
 from upstream import clitool
 from upstream.shard import Shard
 from upstream.streamer import Streamer
 from upstream.file import SizeHelpers
-from upstream.exc import FileError, ResponseError, ShardError
+from upstream.manifest import read_manifest
+from upstream.journal import UploadJournal
+from upstream.exc import FileError, ResponseError, ShardError, TransferError
+
+
+def cli_args(server, *argv):
+    """ Parses a command line as main() would, without retries or probe
+    caching
+    """
+    return clitool.parse_args(['--server', server, '--retries', '0',
+                               '--probe-ttl', '0'] + list(argv))
 
 
 class TestClitool(unittest.TestCase):
@@ -47,13 +64,11 @@ class TestClitool(unittest.TestCase):
             "2032e4fd19d4ab49a74ead0984a5f672c26e60da6e992eaf51f05dc874e94bd7",
             "1b1f463cef1807a127af668f3a4fdcc7977c647bf2f357d9fa125f13548b1d14"
         )
-        self.args = mock.MagicMock()
-        self.args.verbose = False
-        self.args.server = 'http://node1.metadisk.org'
-        self.args.uri = [self.shard.uri]
-        self.args.file = self.uploadfile
-        self.args.dest = self.downloadfile
-        self.args.shard_size = SizeHelpers.mib_to_bytes(250)
+        self.server = 'http://node1.metadisk.org'
+        self.args = cli_args(self.server, 'upload', self.uploadfile)
+        self.download_args = cli_args(self.server, 'download',
+                                      '--uri', self.shard.uri,
+                                      '--dest', self.downloadfile)
 
     def tearDown(self):
         del self.stream
@@ -69,6 +84,7 @@ class TestClitool(unittest.TestCase):
         del self.downloadfile
         del self.shard
         del self.args
+        del self.download_args
 
     def test_main(self):
         sys.argv = ['', 'upload', 'nothing']
@@ -81,15 +97,12 @@ class TestClitool(unittest.TestCase):
             clitool.main()
 
     def test_doomed_upload(self):
-        self.args.action = 'upload'
-        self.args.server = 'http://metadisk.org'
-        self.assertRaises(ResponseError, clitool.upload, self.args)
+        args = cli_args('http://metadisk.org', 'upload', self.uploadfile)
+        self.assertRaises(ResponseError, clitool.upload, args)
 
     def test_upload_download(self):
-        self.args.action = 'upload'
         clitool.upload(self.args)
-        self.args.action = 'download'
-        clitool.download(self.args)
+        clitool.download(self.download_args)
 
         orig_sha256 = ("bc839c0f9195028d375d652e72a5d08d"
                        "293eefd22868493185f084bc4aa61d00")
@@ -100,11 +113,11 @@ class TestClitool(unittest.TestCase):
         self.assertEqual(orig_sha256, new_sha256)
 
     def test_upload_download_with_verbosity(self):
-        self.args.verbose = True
-        self.args.action = 'upload'
-        clitool.upload(self.args)
-        self.args.action = 'download'
-        clitool.download(self.args)
+        clitool.upload(cli_args(self.server, '-v', 'upload',
+                                self.uploadfile))
+        clitool.download(cli_args(self.server, '-v', 'download',
+                                  '--uri', self.shard.uri,
+                                  '--dest', self.downloadfile))
 
         orig_sha256 = ("bc839c0f9195028d375d652e72a5d08d"
                        "293eefd22868493185f084bc4aa61d00")
@@ -115,24 +128,18 @@ class TestClitool(unittest.TestCase):
         self.assertEqual(orig_sha256, new_sha256)
 
     def test_upload_bad_file(self):
-        self.args.action = 'upload'
-        self.args.file = 'notreal'
         with self.assertRaises(SystemExit) as ex:
-            clitool.upload(self.args)
+            clitool.upload(cli_args(self.server, 'upload', 'notreal'))
         self.assertEqual(ex.exception.code, 1)
 
     def test_upload_bad_file_with_verbosity(self):
-        self.args.action = 'upload'
-        self.args.verbose = True
-        self.args.file = 'notreal'
         with self.assertRaises(SystemExit) as ex:
-            clitool.upload(self.args)
+            clitool.upload(cli_args(self.server, '-v', 'upload', 'notreal'))
         self.assertEqual(ex.exception.code, 1)
 
     def test_download_no_dest(self):
-        self.args.action = 'download'
-        self.args.dest = None
-        filepath = clitool.download(self.args)
+        filepath = clitool.download(cli_args(self.server, 'download',
+                                             '--uri', self.shard.uri))
         self.assertTrue(filepath)
         self.assertTrue(os.path.isfile(filepath))
 
@@ -146,10 +153,10 @@ class TestClitool(unittest.TestCase):
         os.remove(filepath)
 
     def test_download_bad_dest(self):
-        self.args.action = 'download'
-        self.args.dest = 'tests'
+        args = cli_args(self.server, 'download', '--uri', self.shard.uri,
+                        '--dest', 'tests')
         with self.assertRaises(FileError):
-            clitool.download(self.args)
+            clitool.download(args)
 
     def test_and_get_dest(self):
         path, fname = clitool.check_and_get_dest(self.downloadfile)
@@ -183,3 +190,246 @@ class TestClitool(unittest.TestCase):
         self.assertEqual(len(shards), 11)
         self.assertEqual(shards[0], (0, 100))
         self.assertEqual(shards[-1], (1000, 1100))
+
+
+class TestClitoolManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.core = WebCore().__enter__()
+        self.uploadfile = "tests/1k.testfile"
+        self.downloadfile = "download.testfile"
+        self.manifest = "manifest.testfile"
+        self.args = self.upload_args()
+
+    def upload_args(self, jobs=2, *argv):
+        return cli_args(self.core.url, 'upload', '--shard-size', '256',
+                        '--jobs', str(jobs), *argv + (self.uploadfile,))
+
+    def tearDown(self):
+        self.core.__exit__(None, None, None)
+        for path in (self.downloadfile, self.manifest):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_upload_download_manifest(self, jobs=2):
+        args = self.upload_args(jobs, '--manifest', self.manifest)
+        with mock.patch('sys.stdout', new_callable=StringIO):
+            clitool.upload(args)
+        with open(self.manifest) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], 'upstream-manifest 2')
+        self.assertEqual(len(lines), 5)
+
+        args = cli_args(self.core.url, 'download', '--jobs', str(jobs),
+                        '--manifest', self.manifest,
+                        '--dest', self.downloadfile)
+        with mock.patch('sys.stdout', new_callable=StringIO), \
+                mock.patch.object(Streamer, '_shard_sizes') as sizes:
+            clitool.download(args)
+        with open(self.uploadfile, 'rb') as f:
+            expected = f.read()
+        with open(self.downloadfile, 'rb') as f:
+            self.assertEqual(f.read(), expected)
+        # Sizes come from the manifest rather than from the server.
+        self.assertFalse(sizes.called)
+
+    def test_manifest_odd_size(self):
+        # The last shard is shorter than the others.
+        self.uploadfile = 'odd.testfile'
+        with open(self.uploadfile, 'wb') as f:
+            f.write(os.urandom(1000))
+        try:
+            for jobs in (1, 3):
+                self.test_upload_download_manifest(jobs)
+                sizes = [entry.size for entry in read_manifest(self.manifest)]
+                self.assertEqual(sizes, [256, 256, 256, 232])
+                os.remove(self.downloadfile)
+        finally:
+            os.remove(self.uploadfile)
+
+    @unittest.skipUnless(hasattr(os, 'sendfile'), 'needs os.sendfile')
+    def test_upload_sendfile_default_jobs(self):
+        args = cli_args(self.core.url, 'upload', '--shard-size', '256',
+                        '--upload-method', 'sendfile',
+                        '--manifest', self.manifest, self.uploadfile)
+        with mock.patch('sys.stdout', new_callable=StringIO), \
+                mock.patch.object(Streamer, '_sendfile_body', autospec=True,
+                                  side_effect=Streamer._sendfile_body) as sf, \
+                mock.patch.object(Streamer, '_upload_lean') as lean:
+            clitool.upload(args)
+        self.assertEqual(sf.call_count, 4)
+        self.assertFalse(lean.called)
+        with open(self.uploadfile, 'rb') as f:
+            data = f.read()
+        self.assertEqual([entry.digest for entry in
+                          read_manifest(self.manifest)],
+                         [hashlib.sha256(data[i:i + 256]).hexdigest()
+                          for i in range(0, len(data), 256)])
+
+    def test_journal_outside_source_directory(self):
+        source = tempfile.mkdtemp()
+        cache = tempfile.mkdtemp()
+        try:
+            shutil.copy(self.uploadfile, source)
+            filepath = os.path.join(source, os.path.basename(self.uploadfile))
+            self.core.fail_next = 2
+            with mock.patch.dict('os.environ', {'XDG_CACHE_HOME': cache}), \
+                    mock.patch('sys.stdout', new_callable=StringIO), \
+                    mock.patch('sys.stderr', new_callable=StringIO):
+                args = cli_args(self.core.url, 'upload', '--shard-size',
+                                '256', filepath)
+                with self.assertRaises(TransferError):
+                    clitool.upload(args)
+                self.assertEqual(os.listdir(source),
+                                 [os.path.basename(filepath)])
+                journal = UploadJournal.default_path(filepath)
+                self.assertTrue(journal.startswith(cache))
+                self.assertEqual(len(UploadJournal.load(journal).pending()),
+                                 2)
+                clitool.upload(cli_args(self.core.url, 'upload', '--resume',
+                                        '--shard-size', '256', filepath))
+                self.assertFalse(os.path.exists(journal))
+        finally:
+            shutil.rmtree(source)
+            shutil.rmtree(cache)
+
+    def test_upload_progress(self):
+        with mock.patch('sys.stdout') as stdout, \
+                mock.patch.object(clitool, 'ProgressBar') as bar:
+            stdout.isatty.return_value = True
+            clitool.upload(self.args)
+        bar.assert_called_once_with('Uploading: ', 1024)
+        self.assertEqual(bar.return_value.update.call_args,
+                         mock.call(1024, 1024))
+        self.assertTrue(bar.return_value.finish.called)
+
+    def test_no_progress_without_terminal(self):
+        with mock.patch('sys.stdout') as stdout, \
+                mock.patch.object(clitool, 'ProgressBar') as bar:
+            stdout.isatty.return_value = False
+            clitool.upload(self.args)
+        self.assertFalse(bar.called)
+
+
+class TestClitoolStartup(unittest.TestCase):
+
+    def test_no_heavy_imports(self):
+        code = ('import sys; import upstream.clitool; '
+                'print(" ".join(name for name in ("requests", '
+                '"requests_toolbelt", "progressbar", "upstream.streamer") '
+                'if name in sys.modules))')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=root)
+        self.assertEqual(output.strip(), b'')
+
+    def test_upload_methods(self):
+        self.assertEqual(clitool.UPLOAD_METHODS,
+                         sorted(Streamer.UPLOAD_METHODS))
+
+
+class TestClitoolBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.core = WebCore().__enter__()
+        self.dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.dir, 'source')
+        os.makedirs(os.path.join(self.source, 'sub'))
+        self.files = {'a': os.urandom(1000), os.path.join('sub', 'b'):
+                      os.urandom(2500), 'empty': b''}
+        for name, data in self.files.items():
+            with open(os.path.join(self.source, name), 'wb') as f:
+                f.write(data)
+        self.argv = ['upstream', '--probe-ttl', '0', '--server',
+                     self.core.url, 'upload-batch', '--shard-size', '1024',
+                     '--jobs', '3']
+
+    def tearDown(self):
+        self.core.__exit__(None, None, None)
+        shutil.rmtree(self.dir)
+
+    def run_main(self, argv, stdin=''):
+        with mock.patch('sys.argv', argv), \
+                mock.patch('sys.stdin', StringIO(stdin)), \
+                mock.patch('sys.stdout', new_callable=StringIO):
+            clitool.main()
+
+    def test_manifest_dir(self):
+        manifests = os.path.join(self.dir, 'manifests')
+        self.run_main(self.argv + ['--manifest-dir', manifests, self.source])
+
+        stream = Streamer(self.core.url)
+        for name, data in self.files.items():
+            entries = list(read_manifest(os.path.join(manifests,
+                                                      name + '.manifest')))
+            self.assertEqual(sum(entry.size for entry in entries), len(data))
+            shards = []
+            for entry in entries:
+                shard = Shard(digest=entry.digest)
+                shard.from_uri(entry.uri)
+                shards.append(shard)
+            dest = os.path.join(self.dir, 'download')
+            stream.download_shards(shards, dest,
+                                   sizes=[e.size for e in entries])
+            with open(dest, 'rb') as f:
+                self.assertEqual(f.read(), data)
+            os.remove(dest)
+        self.assertEqual(len(self.core.files), 4)
+
+    def test_catalog_from_stdin(self):
+        catalog = os.path.join(self.dir, 'catalog')
+        paths = [os.path.join(self.source, 'sub', 'b'),
+                 os.path.join(self.dir, 'missing')]
+        with mock.patch('sys.stderr', new_callable=StringIO) as stderr:
+            self.run_main(self.argv + ['-0', '--catalog', catalog, '-'],
+                          '\0'.join(paths) + '\0')
+        self.assertIn('Skipping', stderr.getvalue())
+        with open(catalog) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual(len(entries), 1)
+        self.assertTrue(entries[0]['path'].endswith(os.path.join('sub', 'b')))
+        self.assertFalse(os.path.isabs(entries[0]['path']))
+        self.assertEqual(entries[0]['size'], 2500)
+        self.assertEqual([(s['offset'], s['size'])
+                          for s in entries[0]['shards']],
+                         [(0, 1024), (1024, 1024), (2048, 452)])
+        self.assertEqual(entries[0]['shards'][0]['servers'], [self.core.url])
+
+    def test_interrupted_batch_keeps_finished_files(self):
+        catalog = os.path.join(self.dir, 'catalog')
+        upload_range = Streamer._upload_range
+
+        def _upload_range(stream, filepath, *args, **kwargs):
+            if filepath.endswith(os.path.join('sub', 'b')):
+                raise KeyboardInterrupt
+            return upload_range(stream, filepath, *args, **kwargs)
+        argv = self.argv[:-1] + ['1', '--catalog', catalog, self.source]
+        with mock.patch.object(Streamer, '_upload_range', _upload_range):
+            with self.assertRaises(KeyboardInterrupt):
+                self.run_main(argv)
+        with open(catalog) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual(sorted(entry['path'] for entry in entries),
+                         ['a', 'empty'])
+
+    def test_helpers(self):
+        self.assertEqual(clitool.read_paths(StringIO('a\r\nb c\n\n')),
+                         ['a', 'b c'])
+        self.assertEqual(clitool.read_paths(StringIO('a\nb\0c\0'), True),
+                         ['a\nb', 'c'])
+        self.assertEqual(clitool.batch_name('../x/./y'),
+                         os.path.join('x', 'y'))
+        self.assertEqual(clitool.scan_files(self.source),
+                         sorted(os.path.join(self.source, name)
+                                for name in self.files))
+        self.assertEqual(clitool.fixed_shards(10, 4),
+                         [(0, 4), (4, 8), (8, 10)])
+
+    def test_content_defined_shards(self):
+        path = os.path.join(self.source, 'sub', 'b')
+        # Above 1000 MiB, a quarter of the size is over the 250 MiB cap.
+        self.assertEqual(clitool.content_defined_shards(
+            path, SizeHelpers.mib_to_bytes(2000)), [(0, 2500)])
+        shards = clitool.content_defined_shards(path, 256)
+        self.assertEqual(shards[-1][1], 2500)
+        self.assertTrue(all(end - start <= 1024 for start, end in shards))
@@ -23,11 +23,14 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import os
 import types
+import hashlib
 import random
 import unittest
 
-from upstream.file import SizeHelpers, ShardFile
+from upstream.file import (SizeHelpers, ShardFile, MappedShardFile,
+                           PositionalWriter, hash_range)
 
 
 def callback(value):
@@ -154,8 +157,143 @@ class TestShardFile(unittest.TestCase):
         self.assertEqual(
             self.shard.total_read_bytes, self.shard.max_seek - number)
 
+    def test_hash_range(self):
+        with open(self.testfile, 'rb') as f:
+            f.seek(1000)
+            expected = hashlib.sha256(f.read(5000)).hexdigest()
+        self.assertEqual(hash_range(self.testfile, 1000, 5000, read_size=64),
+                         (expected, 5000))
+        digest, size = hash_range(self.testfile, 1048000, 5000)
+        self.assertEqual(size, 576)
+
     def test_size_helpers_bytes_to_kib(self):
         self.assertEqual(SizeHelpers.bytes_to_kib(1024), 1)
 
     def test_size_helpers_bytes_to_mib(self):
         self.assertEqual(SizeHelpers.bytes_to_mib(1048576), 1)
+
+    def test_readinto(self):
+        self.shard.shard_size = 1000
+        self.shard._calc_max_seek()
+        buf = bytearray(768)
+        self.assertEqual(self.shard.readinto(buf), 768)
+        self.assertEqual(self.shard.readinto(buf), 232)
+        self.assertEqual(self.shard.readinto(buf), 0)
+
+    def test_hashers(self):
+        with open(self.testfile, 'rb') as f:
+            f.seek(1000)
+            expected = hashlib.sha256(f.read(5000)).hexdigest()
+        hasher = hashlib.sha256()
+        with ShardFile(self.testfile, 'rb', shard_size=5000, start_pos=1000,
+                       hashers=[hasher]) as shard:
+            list(shard)
+        self.assertEqual(hasher.hexdigest(), expected)
+
+    def test_hashers_read_and_readinto(self):
+        with open(self.testfile, 'rb') as f:
+            f.seek(1000)
+            expected = hashlib.sha256(f.read(5000)).hexdigest()
+        hasher = hashlib.sha256()
+        with ShardFile(self.testfile, 'rb', shard_size=5000, start_pos=1000,
+                       hashers=[hasher]) as shard:
+            shard.read(100)
+            # Bytes read again after seeking back are not hashed twice.
+            shard.seek(1050)
+            shard.readinto(bytearray(3000))
+            shard.read()
+        self.assertEqual(hasher.hexdigest(), expected)
+
+
+class TestMappedShardFile(unittest.TestCase):
+
+    def setUp(self):
+        self.testfile = 'tests/one-meg.testfile'
+        self.shard = MappedShardFile(self.testfile, shard_size=5000,
+                                     start_pos=100)
+        with open(self.testfile, 'rb') as f:
+            f.seek(100)
+            self.expected = f.read(5000)
+
+    def tearDown(self):
+        self.shard.close()
+        del self.shard
+
+    def test_slices_are_views(self):
+        slices = list(self.shard)
+        self.assertTrue(all(isinstance(s, memoryview) for s in slices))
+        self.assertEqual([len(s) for s in slices], [1024] * 4 + [904])
+        self.assertEqual(b''.join(s.tobytes() for s in slices),
+                         self.expected)
+
+    def test_read(self):
+        self.assertEqual(self.shard.read(10), self.expected[:10])
+        self.assertEqual(self.shard.read(), self.expected[10:])
+        self.assertEqual(self.shard.read(1), b'')
+
+    def test_readinto(self):
+        buf = bytearray(4096)
+        self.assertEqual(self.shard.readinto(buf), 4096)
+        self.assertEqual(bytes(buf), self.expected[:4096])
+        self.assertEqual(self.shard.readinto(buf), 904)
+        self.assertEqual(self.shard.readinto(buf), 0)
+
+    def test_hashers(self):
+        hasher = hashlib.sha256()
+        with MappedShardFile(self.testfile, shard_size=5000, start_pos=100,
+                             hashers=[hasher]) as shard:
+            list(shard)
+        self.assertEqual(hasher.hexdigest(),
+                         hashlib.sha256(self.expected).hexdigest())
+
+    def test_seek_tell(self):
+        self.shard.seek(10, os.SEEK_CUR)
+        self.assertEqual(self.shard.tell(), 110)
+        self.assertEqual(len(self.shard), 4990)
+
+    def test_callback(self):
+        values = []
+        shard = MappedShardFile(self.testfile, shard_size=2048,
+                                callback=values.append)
+        list(shard)
+        shard.close()
+        self.assertEqual(values, [(0, 2048), (1024, 2048)])
+
+    def test_close_with_live_slices(self):
+        view = next(iter(self.shard))
+        self.shard.close()
+        self.assertEqual(len(view), 1024)
+        self.assertTrue(self.shard._f_obj.closed)
+
+
+class TestPositionalWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.path = 'positional.testfile'
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_preallocate(self):
+        with PositionalWriter(self.path, size=4096):
+            pass
+        self.assertEqual(os.path.getsize(self.path), 4096)
+
+    def test_write_at_out_of_order(self):
+        with PositionalWriter(self.path, size=6) as writer:
+            self.assertEqual(writer.write_at(b'def', 3), 3)
+            writer.write_at(b'abc', 0)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'abcdef')
+
+    def test_read_at(self):
+        with PositionalWriter(self.path) as writer:
+            writer.write_at(b'abcdef', 0)
+            self.assertEqual(writer.read_at(3, 2), b'cde')
+            self.assertEqual(writer.read_at(10, 4), b'ef')
+
+    def test_close_twice(self):
+        writer = PositionalWriter(self.path)
+        writer.close()
+        writer.close()
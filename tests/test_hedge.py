@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import time
+import unittest
+import threading
+
+from webcore import WebCore
+from upstream.streamer import Streamer
+from upstream.metrics import Metrics
+from upstream.hedge import HedgePolicy, Hedger, Cancelled
+
+
+class MemoryWriter(object):
+
+    def __init__(self, size):
+        self.data = bytearray(size)
+
+    def write_at(self, data, offset):
+        self.data[offset:offset + len(data)] = data
+        return len(data)
+
+    def read_at(self, size, offset):
+        return bytes(self.data[offset:offset + size])
+
+
+class TestHedgePolicy(unittest.TestCase):
+
+    def test_is_straggler(self):
+        policy = HedgePolicy(slowdown=3.0, min_elapsed=1.0)
+        self.assertTrue(policy.is_straggler(10, 2.0, [100, 50, 20]))
+        self.assertFalse(policy.is_straggler(20, 2.0, [100, 50, 20]))
+        # Too early to tell, or no one to compare with
+        self.assertFalse(policy.is_straggler(0, 0.5, [100, 50, 20]))
+        self.assertFalse(policy.is_straggler(0, 2.0, []))
+
+
+class TestHedger(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = HedgePolicy(min_elapsed=0.05, interval=0.01)
+        self.hedger = Hedger(self.policy)
+        self.writer = MemoryWriter(8)
+
+    def test_hedge_wins(self):
+        stalled = threading.Event()
+        release = threading.Event()
+        lost = []
+        starts = []
+
+        def fetch(writer, start, on_progress):
+            starts.append(start)
+            if len(starts) == 1:
+                # The first request writes half, then stalls.
+                writer.write_at(b'abcd', 0)
+                on_progress(4)
+                stalled.set()
+                release.wait(5)
+                try:
+                    writer.write_at(b'XXXX', 4)
+                except Cancelled:
+                    lost.append(True)
+                    raise
+            writer.write_at(b'efgh', 4)
+            on_progress(8)
+            return 8
+
+        def peer(writer, start, on_progress):
+            on_progress(8)
+            return 8
+
+        progress = []
+        self.hedger.run('peer', peer, MemoryWriter(8))
+        time.sleep(0.05)
+        size = self.hedger.run(0, fetch, self.writer,
+                               on_progress=progress.append)
+        self.assertEqual(size, 8)
+        self.assertEqual(starts, [0, 4])
+        self.assertEqual(progress, [4, 8])
+        self.assertEqual(self.hedger.hedges, 1)
+
+        # The stalled request is cut off from the file once it wakes up.
+        release.set()
+        for _ in range(100):
+            if lost:
+                break
+            time.sleep(0.01)
+        self.assertEqual(lost, [True])
+        self.assertEqual(bytes(self.writer.data), b'abcdefgh')
+
+    def test_no_peers(self):
+        def fetch(writer, start, on_progress):
+            time.sleep(0.2)
+            return 8
+
+        self.assertEqual(self.hedger.run(0, fetch, self.writer), 8)
+        self.assertEqual(self.hedger.hedges, 0)
+
+    def test_error(self):
+        def fetch(writer, start, on_progress):
+            raise IOError('failed')
+
+        with self.assertRaises(IOError):
+            self.hedger.run(0, fetch, self.writer)
+
+
+class TestHedgedDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.cores = [WebCore().__enter__() for _ in range(2)]
+        self.urls = [core.url for core in self.cores]
+        self.uploadfile = 'tests/1k.testfile'
+        self.downloadfile = 'download.testfile'
+        with open(self.uploadfile, 'rb') as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        for core in self.cores:
+            core.__exit__(None, None, None)
+        if os.path.exists(self.downloadfile):
+            os.remove(self.downloadfile)
+
+    def test_slow_node(self):
+        plan = [(i, i + 128) for i in range(0, 1024, 128)]
+        stream = Streamer(self.urls, replicas=2,
+                          hedge=HedgePolicy(min_elapsed=0.2, interval=0.02,
+                                            max_hedges=8))
+        shards = stream.upload_shards(self.uploadfile, plan, jobs=4)
+
+        # Shards sent by the slow node would take eight seconds each.
+        slow = self.cores[0]
+        slow.bandwidth = 16
+        slow.block_size = 16
+        started = time.time()
+        stream.download_shards(shards, self.downloadfile, jobs=4,
+                               sizes=[128] * 8)
+        self.assertLess(time.time() - started, 4)
+        with open(self.downloadfile, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_overtaken_request_is_not_a_failure(self):
+        plan = [(i, i + 128) for i in range(0, 1024, 128)]
+        metrics = Metrics()
+        stream = Streamer(self.urls, replicas=2, metrics=metrics,
+                          hedge=HedgePolicy(min_elapsed=0.2, interval=0.02,
+                                            max_hedges=8))
+        shards = stream.upload_shards(self.uploadfile, plan, jobs=4)
+
+        slow = self.cores[0]
+        slow.bandwidth = 64
+        slow.block_size = 16
+        stream.download_shards(shards, self.downloadfile, jobs=4,
+                               sizes=[128] * 8)
+        # Wait for the overtaken requests to notice.
+        deadline = time.time() + 5
+        while (any(stream.scheduler.stats(url).active for url in self.urls)
+               and time.time() < deadline):
+            time.sleep(0.05)
+
+        downloads = [ops['download'] for ops in metrics.servers.values()
+                     if 'download' in ops]
+        self.assertEqual(sum(stats['shards'] for stats in downloads), 8)
+        self.assertEqual(sum(stats['errors'] for stats in downloads), 0)
+        for url in self.urls:
+            self.assertEqual(stream.scheduler.stats(url).failures, 0)
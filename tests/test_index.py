@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import threading
+import unittest
+
+from upstream.index import ShardIndex
+
+
+class TestShardIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.path = 'index.testfile'
+        self.index = ShardIndex(self.path)
+        self.server = 'http://node1.metadisk.org'
+
+    def tearDown(self):
+        self.index.close()
+        os.remove(self.path)
+
+    def test_lookup_missing(self):
+        self.assertIs(self.index.lookup(self.server, 'ab', 10), None)
+
+    def test_add_lookup_persists(self):
+        self.index.add(self.server, 'ab', 10, 'hash?key=key')
+        self.index.close()
+        self.index = ShardIndex(self.path)
+        self.assertEqual(self.index.lookup(self.server, 'ab', 10),
+                         'hash?key=key')
+        self.assertIs(self.index.lookup(self.server, 'ab', 11), None)
+        self.assertIs(self.index.lookup('http://other', 'ab', 10), None)
+        self.assertEqual(len(self.index), 1)
+
+    def test_add_replaces(self):
+        self.index.add(self.server, 'ab', 10, 'old?key=key')
+        self.index.add(self.server, 'ab', 10, 'new?key=key')
+        self.assertEqual(self.index.lookup(self.server, 'ab', 10),
+                         'new?key=key')
+        self.assertEqual(len(self.index), 1)
+
+    def test_remove(self):
+        self.index.add(self.server, 'ab', 10, 'hash?key=key')
+        self.index.remove(self.server, 'ab', 10)
+        self.assertEqual(len(self.index), 0)
+
+    def test_threads(self):
+        def _add(n):
+            self.index.add(self.server, str(n), n, 'uri')
+        threads = [threading.Thread(target=_add, args=(n,))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.index), 8)
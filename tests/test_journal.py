@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import json
+import shutil
+import unittest
+import mock
+
+from upstream.shard import Shard
+from upstream.journal import UploadJournal, DownloadJournal
+from upstream.exc import FileError
+
+
+class TestUploadJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.uploadfile = 'journal.testfile'
+        shutil.copy('tests/1k.testfile', self.uploadfile)
+        self.path = self.uploadfile + '.upstream-journal'
+        self.shards = [(0, 512), (512, 1024)]
+        self.journal = UploadJournal(self.path, self.uploadfile, self.shards)
+
+    def tearDown(self):
+        for path in (self.uploadfile, self.path):
+            if os.path.exists(path):
+                os.remove(path)
+        del self.journal
+
+    def test_record_and_load(self):
+        self.journal.record(1, Shard('hash', 'key'))
+        loaded = UploadJournal.load(self.path)
+        self.assertEqual(loaded.shards, self.shards)
+        self.assertEqual(loaded.uris, {1: 'hash?key=key'})
+        self.assertEqual(loaded.pending(), [0])
+        self.assertTrue(loaded.matches(self.uploadfile))
+
+    def test_record_digest(self):
+        self.journal.record(0, Shard('hash', 'key', digest='abcd'))
+        self.journal.record(1, Shard('hash', 'key'))
+        loaded = UploadJournal.load(self.path)
+        self.assertEqual(loaded.digests, {0: 'abcd'})
+
+    def test_record_servers(self):
+        self.journal.record(0, Shard('hash', 'key',
+                                     servers=['http://a', 'http://b']))
+        self.journal.record(1, Shard('hash', 'key'))
+        loaded = UploadJournal.load(self.path)
+        self.assertEqual(loaded.servers, {0: ['http://a', 'http://b']})
+
+    def test_record_appends(self):
+        self.journal.save()
+        self.journal.record(0, Shard('hash', 'key', digest='abcd'))
+        with open(self.path) as f:
+            header = f.readline()
+        self.journal.record(1, Shard('hash2', 'key2'))
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0] + '\n', header)
+        self.assertEqual(json.loads(lines[2]), {'idx': 1,
+                                                'uri': 'hash2?key=key2'})
+
+    def test_load_ignores_cut_short_record(self):
+        self.journal.record(0, Shard('hash', 'key'))
+        with open(self.path, 'a') as f:
+            f.write('{"idx": 1, "uri": "ha')
+        loaded = UploadJournal.load(self.path)
+        self.assertEqual(loaded.uris, {0: 'hash?key=key'})
+        with open(self.path, 'a') as f:
+            f.write('\n{"idx": 1, "uri": "hash?key=key"}\n')
+        with self.assertRaises(FileError):
+            UploadJournal.load(self.path)
+
+    def test_load_single_document(self):
+        data = self.journal._to_dict()
+        data['uris'] = {'1': 'hash?key=key'}
+        with open(self.path, 'w') as f:
+            json.dump(data, f)
+        self.assertEqual(UploadJournal.load(self.path).pending(), [0])
+
+    def test_default_path(self):
+        cache = os.path.abspath('journal.testdir')
+        with mock.patch.dict('os.environ', {'XDG_CACHE_HOME': cache}):
+            path = UploadJournal.default_path(self.uploadfile)
+            self.assertEqual(os.path.dirname(path),
+                             os.path.join(cache, 'upstream', 'journals'))
+            self.assertNotEqual(path, UploadJournal.default_path('other'))
+            journal = UploadJournal(path, self.uploadfile, self.shards)
+            try:
+                journal.record(0, Shard('hash', 'key'))
+                self.assertEqual(UploadJournal.load(path).pending(), [1])
+            finally:
+                shutil.rmtree(cache)
+
+    def test_matches_modified_file(self):
+        self.journal.save()
+        with open(self.uploadfile, 'ab') as f:
+            f.write(b'more')
+        self.assertFalse(UploadJournal.load(self.path).matches(
+            self.uploadfile))
+
+    def test_matches_other_file(self):
+        self.assertFalse(self.journal.matches('tests/1k.testfile'))
+        self.assertFalse(self.journal.matches('not-a-real-file'))
+
+    def test_load_invalid(self):
+        with open(self.path, 'w') as f:
+            f.write('not json')
+        with self.assertRaises(FileError):
+            UploadJournal.load(self.path)
+        with self.assertRaises(FileError):
+            UploadJournal.load('not-a-real-journal')
+
+    def test_remove(self):
+        self.journal.save()
+        self.journal.remove()
+        self.assertFalse(os.path.exists(self.path))
+        self.journal.remove()
+
+
+class TestDownloadJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.path = DownloadJournal.default_path('download.testfile')
+        self.uris = ['a?key=1', 'b?key=2']
+        self.journal = DownloadJournal(self.path, self.uris,
+                                       save_interval=3600)
+
+    def tearDown(self):
+        self.journal.remove()
+        del self.journal
+
+    def test_update_is_throttled(self):
+        self.journal.update(0, 10)
+        self.journal.update(0, 20)
+        self.assertEqual(DownloadJournal.load(self.path).written, [10, 0])
+
+    def test_finish_saves(self):
+        self.journal.update(0, 10)
+        self.journal.finish(1, 30)
+        loaded = DownloadJournal.load(self.path)
+        self.assertEqual(loaded.written, [10, 30])
+        self.assertEqual(loaded.sizes, [None, 30])
+        self.assertTrue(loaded.matches(self.uris))
+        self.assertFalse(loaded.matches(self.uris[:1]))
+
+    def test_load_invalid(self):
+        with open(self.path, 'w') as f:
+            f.write('{"uris": [], "sizes": [1], "written": []}')
+        with self.assertRaises(FileError):
+            DownloadJournal.load(self.path)
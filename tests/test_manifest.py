@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import unittest
+
+from upstream.manifest import (ManifestEntry, ManifestWriter, read_manifest,
+                               write_manifest)
+from upstream.exc import FileError
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = 'manifest.testfile'
+        self.entries = [
+            ManifestEntry(0, 512, 'ab' * 32, 'hash0?key=key0'),
+            ManifestEntry(512, 512, None, 'hash1?key=key1'),
+            ManifestEntry(1024, 3, 'cd' * 32, 'hash2?key=key2',
+                          ['http://a', 'http://b']),
+        ]
+
+    def tearDown(self):
+        for path in (self.path, self.path + '.tmp'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _write(self, text):
+        with open(self.path, 'w') as f:
+            f.write(text)
+
+    def test_round_trip(self):
+        write_manifest(self.path, self.entries)
+        self.assertEqual(list(read_manifest(self.path)), self.entries)
+
+    def test_format(self):
+        write_manifest(self.path, self.entries[:2])
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'upstream-manifest 2\n'
+                                       '0 512 %s hash0?key=key0\n'
+                                       '512 512 - hash1?key=key1\n'
+                             % ('ab' * 32))
+
+    def test_read_is_lazy(self):
+        self._write('upstream-manifest 1\n'
+                    '0 10 - hash0?key=key0\n'
+                    'garbage\n')
+        entries = read_manifest(self.path)
+        self.assertEqual(next(entries).uri, 'hash0?key=key0')
+        with self.assertRaises(FileError) as ex:
+            next(entries)
+        self.assertIn(':3:', str(ex.exception))
+
+    def test_writer_rejects_gap(self):
+        with self.assertRaises(ValueError):
+            with ManifestWriter(self.path) as manifest:
+                manifest.add(0, 10, 'hash0?key=key0')
+                manifest.add(20, 10, 'hash1?key=key1')
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_read_rejects_gap(self):
+        self._write('upstream-manifest 1\n'
+                    '0 10 - hash0?key=key0\n'
+                    '11 10 - hash1?key=key1\n')
+        with self.assertRaises(FileError):
+            list(read_manifest(self.path))
+
+    def test_read_not_a_manifest(self):
+        self._write('hash0?key=key0\n')
+        with self.assertRaises(FileError):
+            list(read_manifest(self.path))
+
+    def test_format_servers(self):
+        write_manifest(self.path, [self.entries[2]._replace(offset=0)])
+        with open(self.path) as f:
+            self.assertEqual(f.read().splitlines()[1],
+                             '0 3 %s hash2?key=key2 http://a,http://b'
+                             % ('cd' * 32))
+
+    def test_read_version_1(self):
+        self._write('upstream-manifest 1\n'
+                    '0 10 - hash0?key=key0\n')
+        self.assertEqual(list(read_manifest(self.path)),
+                         [ManifestEntry(0, 10, None, 'hash0?key=key0')])
+
+    def test_read_unsupported_version(self):
+        self._write('upstream-manifest 3\n')
+        with self.assertRaises(FileError):
+            list(read_manifest(self.path))
+
+    def test_read_missing(self):
+        with self.assertRaises(FileError):
+            list(read_manifest(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import json
+import unittest
+import mock
+from six.moves import StringIO
+
+from webcore import WebCore
+from upstream import clitool
+from upstream.streamer import Streamer
+from upstream.shard import Shard
+from upstream.metrics import Histogram, Metrics, ShardMetrics
+from upstream.retry import RetryPolicy
+from upstream.exc import ResponseError
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_observe(self):
+        histogram = Histogram(buckets=(0.1, 1.0, float('inf')))
+        for value in (0.05, 0.5, 0.7, 5):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [1, 3, 4])
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 6.25)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics(buckets=(0.1, float('inf')))
+        self.path = 'metrics.testfile'
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_record_aggregates(self):
+        hooked = []
+        self.metrics.add_hook(hooked.append)
+        self.metrics.record(ShardMetrics('upload', 'http://a', bytes=10,
+                                         ttfb=0.05, duration=0.2))
+        self.metrics.record(ShardMetrics('upload', 'http://a', bytes=5,
+                                         duration=0.05, error='boom',
+                                         final=False))
+        self.metrics.record(ShardMetrics('upload', 'http://a', bytes=5,
+                                         duration=0.05, retries=1,
+                                         error='boom'))
+        self.assertEqual(len(hooked), 3)
+        stats = self.metrics.to_dict()['servers']['http://a']['upload']
+        self.assertEqual(stats['shards'], 2)
+        self.assertEqual(stats['bytes'], 20)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['retries'], 1)
+        self.assertEqual(stats['ttfb']['count'], 1)
+        self.assertEqual(stats['duration']['buckets'],
+                         [[0.1, 2], ['+Inf', 3]])
+
+    def test_keep_records(self):
+        metrics = Metrics(keep_records=False)
+        metrics.record(ShardMetrics('upload', 'http://a'))
+        self.assertEqual(metrics.to_dict()['shards'], [])
+
+    def test_prometheus(self):
+        self.metrics.record(ShardMetrics('download', 'http://a', bytes=10,
+                                         ttfb=0.05, duration=0.2))
+        text = self.metrics.to_prometheus()
+        self.assertIn('upstream_bytes_total{server="http://a",'
+                      'op="download"} 10\n', text)
+        self.assertIn('upstream_shard_ttfb_seconds_bucket{server="http://a",'
+                      'op="download",le="0.1"} 1\n', text)
+        self.assertIn('upstream_shard_duration_seconds_count{server='
+                      '"http://a",op="download"} 1\n', text)
+
+    def test_write(self):
+        self.metrics.record(ShardMetrics('upload', 'http://a'))
+        self.metrics.write(self.path)
+        with open(self.path) as f:
+            self.assertEqual(len(json.load(f)['shards']), 1)
+        self.metrics.write(self.path, 'prometheus')
+        with open(self.path) as f:
+            self.assertTrue(f.read().startswith('# HELP'))
+        with self.assertRaises(ValueError):
+            self.metrics.write(self.path, 'xml')
+
+
+class TestStreamerMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.server = WebCore().__enter__()
+        self.metrics = Metrics()
+        self.stream = Streamer(self.server.url, metrics=self.metrics)
+        self.uploadfile = 'tests/1k.testfile'
+        self.path = 'metrics.testfile'
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_upload_download(self):
+        shard = self.stream.upload(self.uploadfile, shard_size=600)
+        self.stream.download_shards([shard], 'download.testfile')
+        os.remove('download.testfile')
+        upload, download = self.metrics.records
+        self.assertEqual((upload.op, upload.bytes, upload.shard),
+                         ('upload', 600, shard.filehash))
+        self.assertEqual((download.op, download.bytes),
+                         ('download', 600))
+        for record in (upload, download):
+            self.assertEqual(record.server, self.server.url)
+            self.assertIsNone(record.error)
+            self.assertTrue(record.ttfb > 0)
+            self.assertTrue(record.duration >= record.ttfb)
+        # The connection check opened the pooled connection already.
+        self.assertEqual(upload.connect, 0)
+
+    def test_connect_time(self):
+        stream = Streamer(self.server.url, metrics=self.metrics,
+                          keep_alive=False)
+        stream.upload(self.uploadfile)
+        self.assertTrue(self.metrics.records[0].connect > 0)
+
+    def test_failure(self):
+        self.server.fail_next = 1
+        with self.assertRaises(ResponseError):
+            self.stream.upload(self.uploadfile)
+        self.assertEqual(self.metrics.records[0].error, 'Server error.')
+        with self.assertRaises(ResponseError):
+            self.stream.download_shards([Shard('abcdef', '0123')],
+                                        'download.testfile')
+        os.remove('download.testfile')
+        self.assertEqual(self.metrics.records[1].op, 'download')
+        self.assertIn('404', self.metrics.records[1].error)
+
+    def test_retries(self):
+        stream = Streamer(self.server.url, metrics=self.metrics,
+                          retry=RetryPolicy(attempts=5, backoff=0))
+        self.server.fail_next = 3
+        shard = stream.upload(self.uploadfile)
+        self.server.fail_next = 3
+        stream.download_shards([shard], 'download.testfile')
+        os.remove('download.testfile')
+        self.assertEqual([record.final for record in self.metrics.records],
+                         [False, False, False, True] * 2)
+        text = self.metrics.to_prometheus()
+        for op in ('upload', 'download'):
+            labels = 'server="%s",op="%s"' % (self.server.url, op)
+            self.assertIn('upstream_shards_total{%s} 1\n' % labels, text)
+            self.assertIn('upstream_retries_total{%s} 3\n' % labels, text)
+            self.assertIn('upstream_errors_total{%s} 0\n' % labels, text)
+
+    def test_cli_metrics_out(self):
+        argv = ['upstream', '--probe-ttl', '0', '--server', self.server.url,
+                '--metrics-out', self.path, '--metrics-format', 'prometheus',
+                'upload', '--shard-size', '256', self.uploadfile]
+        with mock.patch('sys.argv', argv), \
+                mock.patch('sys.stdout', new_callable=StringIO):
+            clitool.main()
+        with open(self.path) as f:
+            text = f.read()
+        self.assertIn('upstream_shards_total{server="%s",op="upload"} 4'
+                      % self.server.url, text)
+
+
+if __name__ == '__main__':
+    unittest.main()
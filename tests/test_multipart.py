@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+
+from requests_toolbelt import MultipartEncoder
+
+from upstream.file import ShardFile, MappedShardFile
+from upstream.multipart import MultipartBody
+
+
+class TestMultipartBody(unittest.TestCase):
+
+    def setUp(self):
+        self.testfile = 'tests/one-meg.testfile'
+
+    def _body(self, cls=ShardFile, **kwargs):
+        with cls(self.testfile, 'rb', shard_size=300000,
+                 start_pos=100) as shard:
+            body = MultipartBody(shard, boundary='b0und4ry', **kwargs)
+            length = len(body)
+            data = b''.join(bytes(block) for block in body)
+        return body, length, data
+
+    def test_matches_multipart_encoder(self):
+        body, length, data = self._body()
+        with ShardFile(self.testfile, 'rb', shard_size=300000,
+                       start_pos=100) as shard:
+            expected = MultipartEncoder({'file': ('file', shard)},
+                                        boundary='b0und4ry').read()
+        self.assertEqual(data, expected)
+        self.assertEqual(length, len(expected))
+        self.assertEqual(body.content_type,
+                         'multipart/form-data; boundary=b0und4ry')
+
+    def test_large_buffers(self):
+        with ShardFile(self.testfile, 'rb', shard_size=300000) as shard:
+            blocks = list(MultipartBody(shard, buffer_size=131072))
+        self.assertEqual([len(b) for b in blocks[1:-1]],
+                         [131072, 131072, 37856])
+
+    def test_mapped_shard(self):
+        body, length, data = self._body(MappedShardFile)
+        self.assertEqual(len(data), length)
+        self.assertEqual(self._body()[2], data)
+
+    def test_random_boundary(self):
+        with ShardFile(self.testfile, 'rb') as shard:
+            self.assertNotEqual(MultipartBody(shard).boundary,
+                                MultipartBody(shard).boundary)
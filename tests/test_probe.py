@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import mock
+
+from webcore import WebCore
+from upstream import clitool
+from upstream.streamer import Streamer
+from upstream.probe import ProbeCache, default_path
+from upstream.exc import ConnectError
+
+
+class TestProbeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'upstream', 'probes.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_ttl(self):
+        cache = ProbeCache(ttl=10)
+        self.assertIsNone(cache.get('a'))
+        with mock.patch('time.time', return_value=100):
+            cache.put('a', True)
+            cache.put('b', False)
+        with mock.patch('time.time', return_value=105):
+            self.assertTrue(cache.get('a'))
+            self.assertIs(cache.get('b'), False)
+        with mock.patch('time.time', return_value=111):
+            self.assertIsNone(cache.get('a'))
+
+    def test_shared_file(self):
+        first = ProbeCache(self.path)
+        second = ProbeCache(self.path)
+        first.put('a', True)
+        second.put('b', False)
+        # Each write keeps what the other process wrote.
+        third = ProbeCache(self.path)
+        self.assertTrue(third.get('a'))
+        self.assertIs(third.get('b'), False)
+
+        with mock.patch.object(ProbeCache, '_save') as save:
+            third.put('a', True)
+            self.assertFalse(save.called)
+            third.put('a', False)
+            self.assertTrue(save.called)
+
+    def test_bad_file(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('{"a": 1')
+        cache = ProbeCache(self.path)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', True)
+        with open(self.path) as f:
+            self.assertEqual(list(json.load(f)), ['a'])
+
+    def test_default_path(self):
+        with mock.patch.dict('os.environ', {'XDG_CACHE_HOME': self.dir}):
+            self.assertEqual(default_path(), self.path)
+            self.assertEqual(clitool.make_probe_cache(60).path, self.path)
+        self.assertIsNone(clitool.make_probe_cache(0).path)
+
+
+class TestStreamerProbe(unittest.TestCase):
+
+    def setUp(self):
+        self.core = WebCore().__enter__()
+        self.cache = ProbeCache()
+        self.uploadfile = 'tests/1k.testfile'
+
+    def tearDown(self):
+        self.core.__exit__(None, None, None)
+
+    def test_eager_cached(self):
+        Streamer(self.core.url, probe_cache=self.cache)
+        self.assertTrue(self.cache.get(self.core.url))
+        with mock.patch('requests.Session.get') as get:
+            stream = Streamer(self.core.url, probe_cache=self.cache)
+        self.assertFalse(get.called)
+        self.assertEqual(stream.servers, [self.core.url])
+
+        self.cache.put(self.core.url, False)
+        with self.assertRaises(ConnectError):
+            Streamer(self.core.url, probe_cache=self.cache)
+
+    def test_lazy(self):
+        down = 'http://127.0.0.1:1'
+        with mock.patch('requests.Session.get') as get:
+            stream = Streamer([down, self.core.url], probe='lazy',
+                              probe_cache=self.cache)
+        self.assertFalse(get.called)
+        self.assertEqual(stream.servers, [down, self.core.url])
+
+        # The first transfer to each server stands in for the probe.
+        stream.upload_shards(self.uploadfile, [(0, 512), (512, 1024)])
+        self.assertIs(self.cache.get(down), False)
+        self.assertTrue(self.cache.get(self.core.url))
+        stream = Streamer([down, self.core.url], probe='lazy',
+                          probe_cache=self.cache)
+        self.assertEqual(stream.servers, [self.core.url])
+
+    def test_no_probe(self):
+        with mock.patch('requests.Session.get') as get:
+            Streamer('http://127.0.0.1:1', probe=None,
+                     probe_cache=self.cache)
+        self.assertFalse(get.called)
+        with self.assertRaises(ValueError):
+            Streamer(self.core.url, probe='sometimes')
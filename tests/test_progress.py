@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import threading
+import unittest
+import mock
+
+from upstream.progress import Progress
+
+
+class TestProgress(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.progress = Progress(100, listener=lambda done, total:
+                                 self.calls.append((done, total)))
+
+    def test_aggregates_shards(self):
+        self.progress.update(0, 10)
+        self.progress.update(1, 20)
+        self.progress.update(0, 30)
+        self.assertEqual(self.progress.done, 50)
+
+    def test_listener_is_throttled(self):
+        with mock.patch('upstream.progress.time.time') as now:
+            now.return_value = 1000.0
+            for done in range(1, 50):
+                self.progress.update(0, done)
+            self.assertEqual(self.calls, [(1, 100)])
+            now.return_value = 1000.2
+            self.progress.update(0, 50)
+        self.assertEqual(self.calls, [(1, 100), (50, 100)])
+
+    def test_finish_always_notifies(self):
+        self.progress.update(0, 10)
+        self.progress.update(0, 100)
+        self.progress.finish()
+        self.assertEqual(self.calls[-1], (100, 100))
+
+    def test_shard_callback(self):
+        callback = self.progress.shard_callback(3)
+        callback((40, 50))
+        self.assertEqual(self.progress.done, 40)
+
+    def test_done_when_resuming(self):
+        progress = Progress(100, done=[20, 0, 5])
+        progress.update(1, 10)
+        progress.update(2, 10)
+        self.assertEqual(progress.done, 40)
+
+    def test_concurrent_updates(self):
+        progress = Progress(4000)
+
+        def _shard(key):
+            for done in range(1, 1001):
+                progress.update(key, done)
+        threads = [threading.Thread(target=_shard, args=(key,))
+                   for key in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(progress.done, 4000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import time
+import unittest
+import mock
+
+from webcore import WebCore
+from upstream import clitool
+from upstream.file import ShardFile, MappedShardFile
+from upstream.streamer import Streamer
+from upstream.ratelimit import TokenBucket
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch('upstream.ratelimit.clock',
+                             side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst(self):
+        bucket = TokenBucket(1000, burst=500)
+        self.assertEqual(bucket.reserve(500), 0)
+        self.assertAlmostEqual(bucket.reserve(100), 0.1)
+        # The debt is paid back before anyone else gets through.
+        self.assertAlmostEqual(bucket.reserve(100), 0.2)
+
+    def test_refill(self):
+        bucket = TokenBucket(1000)
+        bucket.reserve(1000)
+        self.now += 0.5
+        self.assertEqual(bucket.reserve(500), 0)
+        # Idle time never fills the bucket past burst.
+        self.now += 10
+        self.assertEqual(bucket.reserve(1000), 0)
+        self.assertAlmostEqual(bucket.reserve(1), 0.001)
+
+    def test_consume(self):
+        bucket = TokenBucket(1000, burst=100)
+        with mock.patch('upstream.ratelimit.time.sleep') as sleep:
+            self.assertEqual(bucket.consume(100), 100)
+            self.assertFalse(sleep.called)
+            bucket.consume(200)
+            sleep.assert_called_once_with(0.2)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(0)
+        with self.assertRaises(ValueError):
+            TokenBucket(10, burst=0)
+
+
+class TestLimitedTransfers(unittest.TestCase):
+
+    def setUp(self):
+        self.uploadfile = 'tests/1k.testfile'
+        self.downloadfile = 'download.testfile'
+
+    def tearDown(self):
+        if os.path.exists(self.downloadfile):
+            os.remove(self.downloadfile)
+
+    def test_shard_file_reads(self):
+        for cls in (ShardFile, MappedShardFile):
+            limiter = mock.Mock()
+            with cls(self.uploadfile, 'rb', shard_size=600, start_pos=100,
+                     read_size=256, limiter=limiter) as shard:
+                for _ in shard:
+                    pass
+            self.assertEqual(
+                sum(args[0] for args, _ in limiter.consume.call_args_list),
+                600)
+
+    def test_shared_between_jobs(self):
+        limiter = TokenBucket(4096, burst=256)
+        with WebCore() as core:
+            streamer = Streamer(core.url, limiter=limiter)
+            shards = [(i, i + 256) for i in range(0, 1024, 256)]
+            started = time.time()
+            uploaded = streamer.upload_shards(self.uploadfile, shards,
+                                              jobs=4, read_size=256)
+            elapsed = time.time() - started
+            # 1024 bytes, less the initial burst, at 4096 bytes/s.
+            self.assertTrue(elapsed >= 0.15, elapsed)
+
+            started = time.time()
+            streamer.download_shards(uploaded, self.downloadfile, jobs=4,
+                                     sizes=[256] * 4, slicesize=256)
+            self.assertTrue(time.time() - started >= 0.15)
+        with open(self.uploadfile, 'rb') as f:
+            expected = f.read()
+        with open(self.downloadfile, 'rb') as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_make_limiter(self):
+        self.assertIsNone(clitool.make_limiter(None))
+        self.assertEqual(clitool.make_limiter('2k').rate, 2048)
+        with mock.patch('sys.stderr'), self.assertRaises(SystemExit):
+            clitool.make_limiter('fast')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import hashlib
+import unittest
+import mock
+import requests
+
+from webcore import WebCore
+from upstream.shard import Shard
+from upstream.streamer import Streamer
+from upstream.metrics import Metrics
+from upstream.retry import RetryPolicy
+from upstream.exc import ResponseError, IntegrityError
+
+
+def error(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return ResponseError("Received status code %d" % status, response)
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = RetryPolicy(attempts=3, backoff=1, max_backoff=3)
+
+    def test_status_code(self):
+        self.assertEqual(error(503).status_code, 503)
+        self.assertIsNone(ResponseError("Server error.").status_code)
+
+    def test_retryable(self):
+        for e in (error(429), error(500), error(503),
+                  requests.exceptions.ConnectionError(),
+                  requests.exceptions.ReadTimeout(),
+                  requests.exceptions.ChunkedEncodingError()):
+            self.assertTrue(self.policy.retryable(e), e)
+        for e in (error(404), error(402), ResponseError("Short shard."),
+                  IntegrityError("Shard abc: expected digest"),
+                  IOError("No space left on device"), ValueError()):
+            self.assertFalse(self.policy.retryable(e), e)
+
+    def test_should_retry(self):
+        self.assertTrue(self.policy.should_retry(error(503), 0))
+        self.assertTrue(self.policy.should_retry(error(503), 1))
+        self.assertFalse(self.policy.should_retry(error(503), 2))
+        self.assertFalse(RetryPolicy(attempts=1).should_retry(error(503), 0))
+        with self.assertRaises(ValueError):
+            RetryPolicy(attempts=0)
+
+    def test_delay(self):
+        with mock.patch('random.uniform', side_effect=lambda a, b: b):
+            self.assertEqual([self.policy.delay(error(503), retries)
+                              for retries in range(4)], [1, 2, 3, 3])
+        with mock.patch('random.uniform', return_value=0):
+            self.assertEqual(self.policy.delay(
+                error(503, {'Retry-After': '2'}), 0), 2)
+            self.assertEqual(self.policy.delay(
+                error(503, {'Retry-After': '120'}), 0), 3)
+            self.assertEqual(self.policy.delay(
+                error(503, {'Retry-After': 'Fri, 31 Dec 1999 23:59:59 GMT'}),
+                0), 0)
+
+
+class TestStreamerRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.server = WebCore(seed=1).__enter__()
+        self.metrics = Metrics()
+        self.stream = Streamer(self.server.url, metrics=self.metrics,
+                               retry=RetryPolicy(attempts=20, backoff=0))
+        self.uploadfile = 'tests/1k.testfile'
+        self.downloadfile = 'download.testfile'
+        with open(self.uploadfile, 'rb') as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+        if os.path.exists(self.downloadfile):
+            os.remove(self.downloadfile)
+
+    def test_upload(self):
+        self.server.fail_next = 2
+        self.server.fail_status = 503
+        hasher = hashlib.sha256()
+        shards = self.stream.upload_shards(
+            self.uploadfile, [(0, 600), (600, 1024)], digests=True,
+            file_hasher=hasher)
+        self.assertEqual(self.server.files[shards[0].filehash],
+                         self.data[:600])
+        self.assertEqual(shards[0].digest,
+                         hashlib.sha256(self.data[:600]).hexdigest())
+        # The failed attempts did not feed the whole-file digest twice.
+        self.assertEqual(hasher.hexdigest(),
+                         hashlib.sha256(self.data).hexdigest())
+        self.assertEqual([(r.retries, r.error is None)
+                          for r in self.metrics.records],
+                         [(0, False), (1, False), (2, True), (0, True)])
+
+    def test_upload_fatal(self):
+        self.server.fail_next = 1
+        self.server.fail_status = 402
+        with self.assertRaises(ResponseError):
+            self.stream.upload(self.uploadfile)
+        self.assertEqual(len(self.metrics.records), 1)
+
+    def test_upload_gives_up(self):
+        self.stream.retry = RetryPolicy(attempts=2, backoff=0)
+        self.server.fail_next = 2
+        with self.assertRaises(ResponseError) as ex:
+            self.stream.upload(self.uploadfile)
+        self.assertEqual(ex.exception.status_code, 500)
+        self.assertEqual(self.server.files, {})
+
+    def test_download_resumes(self):
+        shards = self.stream.upload_shards(
+            self.uploadfile, [(0, 600), (600, 1024)], digests=True)
+        # Responses are cut off half way, at random but repeatably.
+        self.server.drop_rate = 0.5
+        self.server.fail_next = 1
+        del self.metrics.records[:]
+        self.assertEqual(self.stream.download_shards(
+            shards, self.downloadfile, sizes=[600, 424], slicesize=64),
+            1024)
+        with open(self.downloadfile, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        retried = [r for r in self.metrics.records if r.error is not None]
+        self.assertTrue(len(retried) > 1)
+        for shard in shards:
+            records = [r for r in self.metrics.records
+                       if r.shard == shard.filehash]
+            self.assertEqual([r.retries for r in records],
+                             list(range(len(records))))
+        # Each retry picked up where the last one stopped.
+        self.assertEqual(sum(r.bytes for r in self.metrics.records), 1024)
+
+    def test_download_fatal(self):
+        with self.assertRaises(ResponseError):
+            self.stream.download_shards([Shard('abcdef', '0123')],
+                                        self.downloadfile)
+        self.assertEqual(len(self.metrics.records), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import unittest
+import mock
+from six.moves import StringIO
+
+from webcore import WebCore
+from upstream import clitool
+from upstream.shard import Shard
+from upstream.streamer import Streamer
+from upstream.scheduler import NodeScheduler
+from upstream.metrics import Metrics
+from upstream.manifest import read_manifest
+from upstream.exc import ConnectError, ResponseError
+
+
+class TestNodeScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = NodeScheduler(['a', 'b', 'c'])
+
+    def test_spreads_queued_transfers(self):
+        picked = [self.scheduler.acquire() for _ in range(6)]
+        self.assertEqual(sorted(picked), ['a', 'a', 'b', 'b', 'c', 'c'])
+        self.assertEqual(self.scheduler.stats('a').active, 2)
+        self.scheduler.release('b')
+        self.assertEqual(self.scheduler.acquire(), 'b')
+
+    def test_prefers_fast_nodes(self):
+        for server, seconds in (('a', 4), ('b', 1), ('c', 2)):
+            self.scheduler.acquire([server])
+            self.scheduler.release(server, 1000, seconds)
+        # b is twice as fast as c and four times as fast as a: it finishes
+        # two transfers in the time c takes for one, and a gets none.
+        picked = [self.scheduler.acquire() for _ in range(4)]
+        self.assertEqual(picked, ['b', 'c', 'b', 'b'])
+
+    def test_throughput_average(self):
+        scheduler = NodeScheduler(['a'], smoothing=0.5)
+        for seconds in (1, 0.5):
+            scheduler.acquire()
+            scheduler.release('a', 1000, seconds)
+        self.assertEqual(scheduler.stats('a').throughput, 1500)
+
+    def test_failing_nodes_last(self):
+        self.scheduler.acquire(['a'])
+        self.scheduler.release('a', failed=True)
+        picked = [self.scheduler.acquire() for _ in range(3)]
+        self.assertEqual(picked[2], 'a')
+        self.assertEqual(self.scheduler.stats('a').failures, 1)
+
+    def test_candidates(self):
+        self.assertEqual(self.scheduler.acquire(['c', 'd']), 'c')
+        self.assertEqual(self.scheduler.acquire(['c', 'd']), 'd')
+        self.assertEqual(self.scheduler.acquire(exclude=['a', 'b']), 'c')
+        self.assertIsNone(self.scheduler.acquire(['a'], exclude=['a']))
+
+
+class TestMultiServer(unittest.TestCase):
+
+    def setUp(self):
+        self.cores = [WebCore().__enter__() for _ in range(2)]
+        self.urls = [core.url for core in self.cores]
+        self.uploadfile = 'tests/1k.testfile'
+        self.downloadfile = 'download.testfile'
+        self.manifest = 'manifest.testfile'
+        with open(self.uploadfile, 'rb') as f:
+            self.data = f.read()
+        self.plan = [(i, i + 128) for i in range(0, 1024, 128)]
+
+    def tearDown(self):
+        for core in self.cores:
+            core.__exit__(None, None, None)
+        for path in (self.downloadfile, self.manifest):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_spreads_shards(self):
+        metrics = Metrics()
+        stream = Streamer(self.urls, metrics=metrics)
+        shards = stream.upload_shards(self.uploadfile, self.plan, jobs=4)
+        for core in self.cores:
+            self.assertTrue(core.files)
+        for shard in shards:
+            self.assertEqual(len(shard.servers), 1)
+            core = self.cores[self.urls.index(shard.servers[0])]
+            self.assertIn(shard.filehash, core.files)
+
+        stream.download_shards(shards, self.downloadfile, jobs=4,
+                               sizes=[128] * 8)
+        with open(self.downloadfile, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        downloads = [r for r in metrics.records if r.op == 'download']
+        self.assertEqual(set(r.server for r in downloads), set(self.urls))
+        for record in downloads:
+            shard = [s for s in shards if s.filehash == record.shard][0]
+            self.assertEqual(record.server, shard.servers[0])
+
+    def test_replicas(self):
+        stream = Streamer(self.urls, replicas=2)
+        shard = stream.upload(self.uploadfile, digest=True)
+        self.assertEqual(sorted(shard.servers), sorted(self.urls))
+        for core in self.cores:
+            self.assertEqual(core.files[shard.filehash], self.data)
+        with self.assertRaises(ValueError):
+            Streamer(self.urls, replicas=3)
+
+    def test_upload_fails_over(self):
+        self.cores[0].fail_rate = 1.0
+        stream = Streamer(self.urls)
+        shards = stream.upload_shards(self.uploadfile, self.plan[:3])
+        self.assertEqual([shard.servers for shard in shards],
+                         [[self.urls[1]]] * 3)
+
+        stream = Streamer(self.urls, replicas=2)
+        with self.assertRaises(ResponseError):
+            stream.upload(self.uploadfile)
+
+    def test_download_looks_for_unplaced_shards(self):
+        shard = Streamer(self.urls[1]).upload(self.uploadfile)
+        stream = Streamer(self.urls)
+        stream.download_shards([Shard(shard.filehash, shard.decryptkey)],
+                               self.downloadfile)
+        with open(self.downloadfile, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        with self.assertRaises(ResponseError):
+            stream.download_shards([Shard('abcdef', '0123')],
+                                   self.downloadfile)
+
+    def test_unreachable_servers_dropped(self):
+        stream = Streamer([self.urls[0], 'http://127.0.0.1:1'])
+        self.assertEqual(stream.servers, [self.urls[0]])
+        with self.assertRaises(ConnectError):
+            Streamer([self.urls[0], 'http://127.0.0.1:1'], replicas=2)
+
+    def test_cli(self):
+        self.assertEqual(clitool.server_list(None), [clitool.DEFAULT_SERVER])
+        self.assertEqual(clitool.server_list(['a,b', 'c']), ['a', 'b', 'c'])
+
+        argv = ['upstream', '--probe-ttl', '0', '--server',
+                ','.join(self.urls), 'upload', '--shard-size', '512',
+                '--replicas', '2', '--manifest', self.manifest,
+                self.uploadfile]
+        with mock.patch('sys.argv', argv), \
+                mock.patch('sys.stdout', new_callable=StringIO):
+            clitool.main()
+        for entry in read_manifest(self.manifest):
+            self.assertEqual(sorted(entry.servers), sorted(self.urls))
+
+        # Downloads go to the nodes in the manifest, not to --server.
+        argv = ['upstream', '--probe-ttl', '0',
+                '--server', 'http://127.0.0.1:1,' + self.urls[0], 'download',
+                '--manifest', self.manifest, '--dest', self.downloadfile]
+        self.cores[0].fail_rate = 1.0
+        with mock.patch('sys.argv', argv), \
+                mock.patch('sys.stdout', new_callable=StringIO):
+            clitool.main()
+        with open(self.downloadfile, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
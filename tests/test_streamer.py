@@ -24,12 +24,21 @@
 # SOFTWARE.
 
 import os
+import errno
+import socket
+import hashlib
+import shutil
+import threading
 import unittest
 import mock
 
+from webcore import WebCore
 from upstream.shard import Shard
+from upstream.index import ShardIndex
+from upstream.cache import ShardCache
 from upstream.streamer import Streamer
-from upstream.exc import ConnectError, FileError, ShardError, ResponseError
+from upstream.exc import (ConnectError, FileError, ShardError, ResponseError,
+                          IntegrityError, TransferError)
 
 
 class TestStreamer(unittest.TestCase):
@@ -72,16 +81,6 @@ class TestStreamer(unittest.TestCase):
     def test_upload_form_encoded(self, post):
         pass
 
-    @mock.patch('requests.post')
-    def test_upload_sharded_encoded(self, post):
-        with self.assertRaises(NotImplementedError):
-            self.stream._upload_sharded_encoded('http://fake.url', 'fake.path')
-
-    @mock.patch('requests.post')
-    def test_filestream(self, post):
-        with self.assertRaises(NotImplementedError):
-            self.stream._filestream('fake.path')
-
     def test_upload(self):
         # Upload file and check file
         self.shard = self.stream.upload(self.uploadfile)
@@ -172,3 +171,439 @@ class TestStreamer(unittest.TestCase):
         with self.assertRaises(ShardError) as e:
             self.stream.download(shard)
         self.assertEqual(str(e.exception), "Shard missing filehash.")
+
+
+class TestStreamerSession(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch.object(Streamer, 'check_connectivity'):
+            self.stream = Streamer("http://node1.metadisk.org", pool_size=4)
+
+    def tearDown(self):
+        self.stream.close()
+        del self.stream
+
+    def test_session_reused_in_thread(self):
+        self.assertIs(self.stream.session, self.stream.session)
+
+    def test_sessions_share_pool_across_threads(self):
+        sessions = []
+        thread = threading.Thread(
+            target=lambda: sessions.append(self.stream.session))
+        thread.start()
+        thread.join()
+        self.assertIsNot(sessions[0], self.stream.session)
+        self.assertIs(sessions[0].get_adapter('http://node1.metadisk.org'),
+                      self.stream.session.get_adapter(
+                          'https://node1.metadisk.org'))
+        self.assertEqual(self.stream._adapter._pool_maxsize, 4)
+
+    def test_no_keep_alive(self):
+        with mock.patch.object(Streamer, 'check_connectivity'):
+            stream = Streamer("http://node1.metadisk.org", keep_alive=False)
+        self.assertEqual(stream.session.headers['Connection'], 'close')
+
+    def test_check_connectivity_uses_session(self):
+        with mock.patch('requests.Session.get') as get:
+            self.stream.check_connectivity()
+        get.assert_called_once_with("http://node1.metadisk.org", timeout=2)
+
+
+class TestStreamerUploadMethods(unittest.TestCase):
+
+    def setUp(self):
+        self.server = WebCore().__enter__()
+        self.uploadfile = "tests/one-meg.testfile"
+        with open(self.uploadfile, 'rb') as f:
+            f.seek(100)
+            self.data = f.read(300000)
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+        del self.server
+
+    def _upload(self, digest=False, **kwargs):
+        stream = Streamer(self.server.url, **kwargs)
+        shard = stream.upload(self.uploadfile, shard_size=300000,
+                              start_pos=100, digest=digest)
+        self.assertEqual(self.server.files[shard.filehash], self.data)
+        if digest:
+            self.assertEqual(shard.digest,
+                             hashlib.sha256(self.data).hexdigest())
+        return stream
+
+    def test_upload_digest(self):
+        for method in sorted(Streamer.UPLOAD_METHODS):
+            self._upload(digest=True, upload_method=method)
+        self._upload(digest=True, upload_method='lean', use_mmap=True)
+
+    def test_upload_form(self):
+        self._upload(upload_method='form')
+
+    def test_upload_lean(self):
+        self._upload(upload_method='lean')
+        self.assertEqual(self.server.requests[-1]['Content-Length'],
+                         str(len(self.data) + 140))
+
+    def test_upload_lean_mmap(self):
+        self._upload(upload_method='lean', use_mmap=True)
+
+    def test_upload_sendfile(self):
+        self._upload(upload_method='sendfile')
+
+    def test_upload_sendfile_small_blocks(self):
+        with mock.patch.object(Streamer, 'SENDFILE_BLOCK', 65536):
+            self._upload(upload_method='sendfile')
+
+    def test_upload_sendfile_error_status(self):
+        with mock.patch.object(Streamer, 'check_connectivity'):
+            stream = Streamer(self.server.url + '/nowhere',
+                              upload_method='sendfile')
+        with self.assertRaises(ResponseError) as ex:
+            stream.upload(self.uploadfile)
+        self.assertEqual(str(ex.exception), "API call not found.")
+
+    @unittest.skipUnless(hasattr(os, 'sendfile'), 'needs os.sendfile')
+    def test_upload_sendfile_timeout(self):
+        # A server that takes the connection but never reads or answers.
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        try:
+            url = 'http://127.0.0.1:%d' % listener.getsockname()[1]
+            stream = Streamer(url, upload_method='sendfile', probe=None,
+                              timeout=0.5)
+            with self.assertRaises(socket.timeout):
+                stream.upload(self.uploadfile)
+        finally:
+            listener.close()
+
+    @unittest.skipUnless(hasattr(os, 'sendfile'), 'needs os.sendfile')
+    def test_sendfile_waits_for_full_buffer(self):
+        left, right = socket.socketpair()
+        left.settimeout(0.5)
+        try:
+            with mock.patch('os.sendfile', side_effect=[
+                    OSError(errno.EAGAIN, 'Resource temporarily unavailable'),
+                    5]) as sendfile:
+                self.assertEqual(Streamer._sendfile(left, 0, 0, 5), 5)
+            self.assertEqual(sendfile.call_count, 2)
+        finally:
+            left.close()
+            right.close()
+
+    def test_upload_chunked(self):
+        self._upload(upload_method='chunked')
+        headers = self.server.requests[-1]
+        self.assertEqual(headers['Transfer-Encoding'], 'chunked')
+        self.assertEqual(headers['Content-Type'], 'application/octet-stream')
+        self.assertIs(headers['Content-Length'], None)
+
+    def test_filestream(self):
+        stream = Streamer(self.server.url)
+        with stream._open_shard(self.uploadfile, 300000, 100,
+                                read_size=131072) as shard:
+            blocks = list(stream._filestream(shard))
+        self.assertEqual([len(b) for b in blocks], [131072, 131072, 37856])
+        self.assertEqual(b''.join(blocks), self.data)
+
+    def test_upload_shards_dedup(self):
+        stream = Streamer(self.server.url)
+        plan = [(0, 300000), (300000, 600000)]
+        try:
+            with ShardIndex('index.testfile') as index:
+                first = stream.upload_shards(self.uploadfile, plan,
+                                             index=index)
+                posts = len(self.server.requests)
+                second = stream.upload_shards(self.uploadfile, plan[:1],
+                                              index=index)
+        finally:
+            os.remove('index.testfile')
+        self.assertEqual(len(self.server.requests), posts)
+        self.assertEqual(second[0].uri, first[0].uri)
+
+    def test_upload_shards_digests(self):
+        stream = Streamer(self.server.url)
+        plan = [(0, 300000), (300000, 600000), (600000, 1048576)]
+        file_hasher = hashlib.sha256()
+        with open(self.uploadfile, 'rb') as f:
+            data = f.read()
+        with mock.patch('upstream.streamer.hash_range') as hash_range:
+            result = stream.upload_shards(self.uploadfile, plan,
+                                          digests=True,
+                                          file_hasher=file_hasher)
+        self.assertFalse(hash_range.called)
+        self.assertEqual([shard.digest for shard in result],
+                         [hashlib.sha256(data[start:end]).hexdigest()
+                          for start, end in plan])
+        self.assertEqual(file_hasher.hexdigest(),
+                         hashlib.sha256(data).hexdigest())
+
+    def test_unknown_upload_method(self):
+        with self.assertRaises(ValueError):
+            Streamer(self.server.url, upload_method='carrier-pigeon')
+
+
+class TestStreamerUploadShards(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch.object(Streamer, 'check_connectivity'):
+            self.stream = Streamer("http://node1.metadisk.org")
+        self.uploadfile = "tests/1k.testfile"
+        self.shards = [(0, 256), (256, 512), (512, 768), (768, 1024)]
+
+    def tearDown(self):
+        del self.stream
+        del self.shards
+
+    def test_upload_shards_in_order(self):
+        def _upload(filepath, shard_size, start_pos, read_size, callback,
+                    **kwargs):
+            self.assertEqual(shard_size, 256)
+            return Shard(str(start_pos), 'key')
+        self.stream.upload = mock.MagicMock(side_effect=_upload)
+
+        result = self.stream.upload_shards(self.uploadfile, self.shards,
+                                           jobs=3)
+        self.assertEqual([s.filehash for s in result],
+                         ['0', '256', '512', '768'])
+
+    def test_upload_shards_file_hasher_needs_serial_upload(self):
+        with self.assertRaises(ValueError):
+            self.stream.upload_shards(self.uploadfile, self.shards, jobs=2,
+                                      file_hasher=hashlib.sha256())
+
+    def test_upload_shards_partial_failure(self):
+        def _upload(filepath, shard_size, start_pos, read_size, callback,
+                    **kwargs):
+            if start_pos == 256:
+                raise ResponseError("Server error.")
+            return Shard(str(start_pos), 'key')
+        self.stream.upload = mock.MagicMock(side_effect=_upload)
+        done = []
+
+        with self.assertRaises(TransferError) as ex:
+            self.stream.upload_shards(
+                self.uploadfile, self.shards, jobs=2,
+                on_shard=lambda idx, shard: done.append(idx))
+        self.assertEqual(list(ex.exception.errors), [1])
+        self.assertIs(ex.exception.results[1], None)
+        self.assertEqual(ex.exception.results[3].filehash, '768')
+        self.assertEqual(sorted(done), [0, 2, 3])
+
+    def test_upload_shards_bad_file(self):
+        with self.assertRaises(FileError):
+            self.stream.upload_shards('not-a-real-file', self.shards)
+
+    def test_upload_files(self):
+        def _upload(filepath, shard_size, start_pos, read_size, callback,
+                    **kwargs):
+            if filepath.endswith('one-meg.testfile') and start_pos == 512:
+                raise ResponseError("Server error.")
+            return Shard('%s:%d' % (os.path.basename(filepath), start_pos),
+                         'key')
+        self.stream.upload = mock.MagicMock(side_effect=_upload)
+        files = [(self.uploadfile, self.shards),
+                 ('tests/one-meg.testfile', [(0, 512), (512, 1024)])]
+        done = []
+
+        with self.assertRaises(TransferError) as ex:
+            self.stream.upload_files(
+                files, jobs=3,
+                on_shard=lambda i, j, shard: done.append((i, j)))
+        self.assertEqual(list(ex.exception.errors), [(1, 1)])
+        results = ex.exception.results
+        self.assertEqual([s.filehash for s in results[0]],
+                         ['1k.testfile:0', '1k.testfile:256',
+                          '1k.testfile:512', '1k.testfile:768'])
+        self.assertEqual(results[1][0].filehash, 'one-meg.testfile:0')
+        self.assertIs(results[1][1], None)
+        self.assertEqual(len(done), 5)
+
+        with self.assertRaises(FileError):
+            self.stream.upload_files([('not-a-real-file', self.shards)])
+
+
+class TestStreamerDownloadShards(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch.object(Streamer, 'check_connectivity'):
+            self.stream = Streamer("http://node1.metadisk.org")
+        self.downloadfile = "download.testfile"
+        self.shards = [Shard(str(i), 'key') for i in range(4)]
+        self.data = {'0': b'aaaa', '1': b'bb', '2': b'cccccc', '3': b'd'}
+
+        def _download(shard, slicesize=1024, offset=0, server=None):
+            r = mock.MagicMock()
+            r.status_code = 206 if offset else 200
+            r.iter_content.return_value = iter(
+                [self.data[shard.filehash][offset:]])
+            return r
+        self.stream.download = mock.MagicMock(side_effect=_download)
+
+    def tearDown(self):
+        if os.path.exists(self.downloadfile):
+            os.remove(self.downloadfile)
+        del self.stream
+
+    def _read(self):
+        with open(self.downloadfile, 'rb') as f:
+            return f.read()
+
+    def test_download_shards_serial(self):
+        self.stream._shard_sizes = mock.MagicMock()
+        written = self.stream.download_shards(self.shards, self.downloadfile)
+        self.assertEqual(written, 13)
+        self.assertEqual(self._read(), b'aaaabbccccccd')
+        self.assertFalse(self.stream._shard_sizes.called)
+
+    def test_download_shards_parallel(self):
+        self.stream._shard_sizes = mock.MagicMock(return_value=[4, 2, 6, 1])
+        self.stream.download_shards(self.shards, self.downloadfile, jobs=4)
+        self.assertEqual(self._read(), b'aaaabbccccccd')
+
+    def test_download_shards_parallel_unknown_sizes(self):
+        self.stream._shard_sizes = mock.MagicMock(return_value=None)
+        self.stream.download_shards(self.shards, self.downloadfile, jobs=4)
+        self.assertEqual(self._read(), b'aaaabbccccccd')
+
+    def test_download_shards_size_mismatch(self):
+        with self.assertRaises(TransferError) as ex:
+            self.stream.download_shards(self.shards, self.downloadfile,
+                                        jobs=2, sizes=[4, 3, 6, 1])
+        self.assertEqual(list(ex.exception.errors), [1])
+        self.assertEqual(ex.exception.results[2], 6)
+
+    def test_download_shards_resume(self):
+        with open(self.downloadfile, 'wb') as f:
+            f.write(b'aaaab\0cc\0\0\0\0\0')
+        progress = []
+        self.stream.download_shards(
+            self.shards, self.downloadfile, jobs=2, sizes=[4, 2, 6, 1],
+            done=[4, 1, 2, 0],
+            on_progress=lambda idx, n: progress.append((idx, n)))
+        self.assertEqual(self._read(), b'aaaabbccccccd')
+        self.assertEqual(self.stream.download.call_count, 3)
+        self.assertEqual(sorted(progress), [(1, 2), (2, 6), (3, 1)])
+
+    def test_download_shards_resume_range_ignored(self):
+        def _download(shard, slicesize=1024, offset=0, server=None):
+            r = mock.MagicMock()
+            r.status_code = 200
+            data = self.data[shard.filehash]
+            r.iter_content.return_value = iter([data[:1], data[1:]])
+            return r
+        self.stream.download.side_effect = _download
+        with open(self.downloadfile, 'wb') as f:
+            f.write(b'aaaabbccc')
+        self.stream.download_shards(self.shards, self.downloadfile,
+                                    sizes=[4, 2, None, None],
+                                    done=[4, 2, 3, 0])
+        self.assertEqual(self._read(), b'aaaabbccccccd')
+
+    def test_download_shards_resume_complete_shard(self):
+        response = mock.MagicMock(status_code=416)
+        error = ResponseError()
+        error.response = response
+        self.stream.download.side_effect = error
+        sizes = []
+        written = self.stream.download_shards(
+            self.shards[:1], self.downloadfile, done=[4],
+            on_shard=lambda idx, size: sizes.append(size))
+        self.assertEqual(written, 4)
+        self.assertEqual(sizes, [4])
+
+    def _digests(self):
+        for shard in self.shards:
+            shard.digest = hashlib.sha256(
+                self.data[shard.filehash]).hexdigest()
+
+    def test_download_shards_verified(self):
+        self._digests()
+        self.stream.download_shards(self.shards, self.downloadfile, jobs=2,
+                                    sizes=[4, 2, 6, 1])
+        self.assertEqual(self._read(), b'aaaabbccccccd')
+        self.assertEqual(self.stream.download.call_count, 4)
+
+    def test_download_shards_refetches_corrupt_shard(self):
+        self._digests()
+        good = self.data['2']
+        self.data['2'] = b'cccxcc'
+        download = self.stream.download.side_effect
+
+        def _download(shard, slicesize=1024, offset=0, server=None):
+            r = download(shard, slicesize, offset)
+            if shard.filehash == '2':
+                self.data['2'] = good
+            return r
+        self.stream.download.side_effect = _download
+        self.stream.download_shards(self.shards, self.downloadfile)
+        self.assertEqual(self._read(), b'aaaabbccccccd')
+        self.assertEqual(self.stream.download.call_count, 5)
+
+    def test_download_shards_persistently_corrupt(self):
+        self._digests()
+        self.data['1'] = b'bx'
+        with self.assertRaises(TransferError) as ex:
+            self.stream.download_shards(self.shards, self.downloadfile,
+                                        jobs=2, sizes=[4, 2, 6, 1])
+        self.assertEqual(list(ex.exception.errors), [1])
+        self.assertIsInstance(ex.exception.errors[1], IntegrityError)
+        self.assertEqual(self.stream.download.call_count, 5)
+
+    def test_download_shards_resume_verifies_written_data(self):
+        self._digests()
+        with open(self.downloadfile, 'wb') as f:
+            f.write(b'axaab\0cc\0\0\0\0\0')
+        self.stream.download_shards(
+            self.shards, self.downloadfile, jobs=2, sizes=[4, 2, 6, 1],
+            done=[4, 1, 2, 0])
+        self.assertEqual(self._read(), b'aaaabbccccccd')
+        # The first shard was complete on disk but corrupt.
+        self.assertEqual(self.stream.download.call_count, 4)
+
+    def test_download_shards_cache(self):
+        cache = ShardCache('cache.testdir')
+        try:
+            self.stream.download_shards(self.shards, self.downloadfile,
+                                        jobs=2, sizes=[4, 2, 6, 1],
+                                        cache=cache)
+            self.assertEqual(self.stream.download.call_count, 4)
+            os.remove(self.downloadfile)
+            self.stream.download_shards(self.shards[1:3], self.downloadfile,
+                                        jobs=2, sizes=[2, 6], cache=cache)
+            self.assertEqual(self._read(), b'bbcccccc')
+            self.assertEqual(self.stream.download.call_count, 4)
+        finally:
+            shutil.rmtree('cache.testdir')
+
+    def test_download_shards_cache_smaller_than_shard(self):
+        cache = ShardCache('cache.testdir', max_size=1)
+        try:
+            self.stream.download_shards(self.shards, self.downloadfile,
+                                        jobs=2, sizes=[4, 2, 6, 1],
+                                        cache=cache)
+            self.assertEqual(self._read(), b'aaaabbccccccd')
+            os.remove(self.downloadfile)
+            self.stream.download_shards(self.shards[2:3], self.downloadfile,
+                                        cache=cache)
+            self.assertEqual(self._read(), b'cccccc')
+            self.assertLessEqual(cache.size(), 1)
+        finally:
+            shutil.rmtree('cache.testdir')
+
+    def test_download_shards_cache_link(self):
+        cache = ShardCache('cache.testdir')
+        try:
+            sizes = []
+            written = self.stream.download_shards(
+                self.shards[2:3], self.downloadfile, cache=cache,
+                on_shard=lambda idx, size: sizes.append(size))
+            self.assertEqual(written, 6)
+            self.assertEqual(sizes, [6])
+            self.assertEqual(self._read(), b'cccccc')
+            self.assertEqual(
+                os.stat(self.downloadfile).st_ino,
+                os.stat(cache.path('2')).st_ino)
+        finally:
+            shutil.rmtree('cache.testdir')
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import time
+import threading
+import unittest
+
+from upstream.workers import run_jobs
+
+
+class TestRunJobs(unittest.TestCase):
+
+    def test_results_in_order(self):
+        def _slow_first(n):
+            time.sleep(0.05 if n == 0 else 0)
+            return n * 2
+        results, errors = run_jobs(_slow_first, range(5), jobs=3)
+        self.assertEqual(results, [0, 2, 4, 6, 8])
+        self.assertEqual(errors, {})
+
+    def test_failures_keep_finished(self):
+        def _fail_odd(n):
+            if n % 2:
+                raise ValueError(n)
+            return n
+        results, errors = run_jobs(_fail_odd, range(4), jobs=2)
+        self.assertEqual(results, [0, None, 2, None])
+        self.assertEqual(sorted(errors), [1, 3])
+        self.assertTrue(isinstance(errors[1], ValueError))
+
+    def test_bounded_concurrency(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def _track(n):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+
+        run_jobs(_track, range(12), jobs=3)
+        self.assertTrue(1 < state['peak'] <= 3)
+
+    def test_on_result(self):
+        seen = []
+        run_jobs(lambda n: n + 1, range(3), on_result=lambda i, r: seen.append(
+            (i, r)))
+        self.assertEqual(sorted(seen), [(0, 1), (1, 2), (2, 3)])
+
+    def test_empty(self):
+        self.assertEqual(run_jobs(lambda n: n, []), ([], {}))
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+""" A minimal in-process stand-in for the web-core API, for tests that
+need a real HTTP server: ``POST /api/upload`` with a multipart body and
+``GET``/``HEAD /api/download/<filehash>?key=<key>`` with Range support.
+Uploads may also be sent as a raw body with chunked transfer encoding.
+
+The server can also be made to behave like a distant or unreliable node:
+responses can be delayed, transfers capped to a bandwidth, and uploads and
+downloads made to fail with an error status or by dropping the connection
+half way through a download.
+
+Usage::
+
+    with WebCore() as server:
+        streamer = Streamer(server.url)
+
+    with WebCore(latency=0.05, bandwidth=10 * 2 ** 20, fail_rate=0.1):
+        ...
+
+"""
+
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+
+from six.moves import BaseHTTPServer, socketserver
+
+
+class WebCoreHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._download(send_body=True)
+
+    def do_HEAD(self):
+        self._download(send_body=False)
+
+    def do_POST(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = self._read_chunked()
+        else:
+            body = self._read(int(self.headers['Content-Length']))
+        if self.path != '/api/upload':
+            return self._reply(404, b'')
+        self.server.requests.append(self.headers)
+        self._delay()
+        if self.server.should_fail():
+            return self._reply(self.server.fail_status, b'Injected failure')
+        if self.headers.get('Content-Type', '').startswith('multipart/'):
+            data = self._parse_multipart(body)
+        else:
+            data = body
+        if data is None:
+            return self._reply(400, b'Bad multipart body')
+        filehash = hashlib.sha256(data).hexdigest()
+        key = hashlib.sha256(b'key' + data).hexdigest()
+        self.server.files[filehash] = data
+        self._reply(201, json.dumps({'filehash': filehash,
+                                     'key': key}).encode('utf-8'))
+
+    def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            if not size:
+                while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                    pass  # trailers
+                return b''.join(chunks)
+            chunks.append(self._read(size))
+            self.rfile.readline()
+
+    def _parse_multipart(self, body):
+        match = re.search(r'boundary=(\S+)',
+                          self.headers.get('Content-Type', ''))
+        if not match:
+            return None
+        boundary = match.group(1).encode('ascii')
+        start = body.find(b'\r\n\r\n')
+        end = body.rfind(b'\r\n--' + boundary + b'--')
+        if not body.startswith(b'--' + boundary) or start < 0 or end < 0:
+            return None
+        return body[start + 4:end]
+
+    def _download(self, send_body):
+        if self.path == '/':
+            return self._reply(200, b'web-core', send_body)
+        match = re.match(r'^/api/download/([0-9a-f]+)\?key=([0-9a-f]+)$',
+                         self.path)
+        data = self.server.files.get(match.group(1)) if match else None
+        if data is None:
+            return self._reply(404, b'', send_body)
+        self._delay()
+        if self.server.should_fail():
+            return self._reply(self.server.fail_status, b'Injected failure',
+                               send_body)
+
+        byte_range = re.match(r'^bytes=(\d+)-$',
+                              self.headers.get('Range') or '')
+        if byte_range:
+            start = int(byte_range.group(1))
+            if start >= len(data):
+                return self._reply(416, b'', send_body)
+            return self._reply(206, data[start:], send_body, {
+                'Content-Range': 'bytes %d-%d/%d'
+                                 % (start, len(data) - 1, len(data))})
+        self._reply(200, data, send_body)
+
+    def _reply(self, status, body, send_body=True, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if not send_body:
+            return
+        if status < 300 and len(body) > 1 and self.server.should_drop():
+            # Send half of the body, then hang up.
+            self._write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self._write(body)
+
+    def _delay(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def _read(self, size):
+        if not self.server.bandwidth:
+            return self.rfile.read(size)
+        chunks = []
+        while size > 0:
+            chunk = self.rfile.read(min(size, self.server.block_size))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+            time.sleep(len(chunk) / float(self.server.bandwidth))
+        return b''.join(chunks)
+
+    def _write(self, body):
+        if not self.server.bandwidth:
+            return self.wfile.write(body)
+        for start in range(0, len(body), self.server.block_size):
+            chunk = body[start:start + self.server.block_size]
+            self.wfile.write(chunk)
+            time.sleep(len(chunk) / float(self.server.bandwidth))
+
+
+class WebCore(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    block_size = 65536
+
+    def __init__(self, handler=WebCoreHandler, latency=0, bandwidth=None,
+                 fail_rate=0.0, fail_status=500, fail_next=0, drop_rate=0.0,
+                 seed=None):
+        """
+        :param handler: Request handler class
+        :param latency: Seconds to wait before answering each upload or
+        download
+        :param bandwidth: Bytes per second each connection is capped to,
+        in both directions; None for no cap
+        :param fail_rate: Probability of answering an upload or download
+        with fail_status
+        :param fail_status: HTTP status of injected failures
+        :param fail_next: Number of uploads or downloads, from now on, to
+        fail whatever fail_rate is
+        :param drop_rate: Probability of closing the connection half way
+        through a successful download
+        :param seed: Seed for the random failures, for repeatable runs
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.files = {}
+        self.requests = []
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fail_rate = fail_rate
+        self.fail_status = fail_status
+        self.fail_next = fail_next
+        self.drop_rate = drop_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def should_fail(self):
+        with self._lock:
+            if self.fail_next > 0:
+                self.fail_next -= 1
+                return True
+            return self._random.random() < self.fail_rate
+
+    def should_drop(self):
+        with self._lock:
+            return self._random.random() < self.drop_rate
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
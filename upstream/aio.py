@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+""" An asyncio counterpart to upstream.streamer.Streamer, for embedding
+upstream in an event loop and keeping many shard transfers in flight from
+a single thread.  Requires Python 3.6 or later.
+
+Disk reads and writes run in the event loop's default executor, so that a
+slow disk holds up only the transfer waiting on it.
+"""
+
+import ssl
+import asyncio
+
+from six.moves.urllib.parse import urlsplit
+
+from upstream.file import ShardFile, SizeHelpers, PositionalWriter
+from upstream.multipart import MultipartBody
+from upstream.streamer import (Streamer, shard_from_upload, shard_hasher,
+                               verify_shard)
+from upstream.exc import (ConnectError, ResponseError, ShardError,
+                          IntegrityError, TransferError)
+
+
+class AsyncResponse(object):
+
+    def __init__(self, status_code, reason, headers):
+        """ The status and headers of an HTTP response read by
+        AsyncStreamer, plus its body once read.
+
+        :param status_code: HTTP status code as int
+        :param reason: HTTP reason phrase as string
+        :param headers: Dict of headers, with lower-cased names
+        """
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = b''
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+
+class AsyncStreamer(object):
+
+    def __init__(self, server, max_concurrency=64, read_size=262144,
+                 limiter=None, timeout=300):
+        """ For uploading and downloading files from Metadisk from within
+        an asyncio event loop.  Each transfer uses its own connection, and
+        no more than max_concurrency transfers run at once; further calls
+        wait for a free slot.  Unlike Streamer, the server is not probed on
+        creation; await check_connectivity() to do so.
+
+        Usage::
+
+            streamer = AsyncStreamer('http://node1.metadisk.org')
+            shard = await streamer.upload('/path/to/file')
+            data = await streamer.download(shard)
+
+        :param server: URL to the Metadisk server
+        :param max_concurrency: Maximum number of transfers in flight
+        :param read_size: Size in bytes of the blocks read and sent
+        :param limiter: Optional upstream.ratelimit.TokenBucket capping the
+        rate at which shard data is sent and received; waiting for it
+        sleeps in the event loop rather than blocking it
+        :param timeout: Seconds to wait for a connection to open, or for
+        the server to accept or send more data, before a transfer fails
+        with asyncio.TimeoutError; None to wait forever
+        """
+        self.server = server
+        self.max_concurrency = max_concurrency
+        self.read_size = read_size
+        self.limiter = limiter
+        self.timeout = timeout
+        parts = urlsplit(server)
+        self._https = parts.scheme == 'https'
+        self._host = parts.hostname
+        self._port = parts.port or (443 if self._https else 80)
+        self._netloc = parts.netloc
+        self._base_path = parts.path.rstrip('/')
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        """ The asyncio.Semaphore bounding concurrent transfers, created on
+        first use so that it belongs to the running event loop.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def check_connectivity(self):
+        """ Check to see if we even get a connection to the server.
+
+        :raise ConnectError: If the server cannot be reached or errors
+        """
+        try:
+            response, reader, writer = await self._request(
+                'GET', self._base_path or '/')
+            writer.close()
+        except (OSError, asyncio.TimeoutError, ResponseError, ValueError):
+            # ValueError: a status line without a numeric code.
+            raise ConnectError("Could not connect to server.")
+        if response.status_code >= 400:
+            raise ConnectError("Could not connect to server.")
+
+    async def upload(self, filepath, shard_size=0, start_pos=0,
+                     read_size=None):
+        """ Uploads a shard via POST to the web-core API.
+
+        :param filepath: Path to file as a string
+        :param shard_size: Size of the shard in bytes; 0 for 250 MiB
+        :param start_pos: Position of the shard in the file in bytes
+        :param read_size: Size in bytes of the blocks read and sent
+        :return: upstream.shard.Shard
+        :raise ResponseError: If the upload was not accepted
+        """
+        validpath = Streamer.check_path(filepath)
+        if shard_size == 0:
+            shard_size = SizeHelpers.mib_to_bytes(250)
+        async with self.semaphore:
+            with ShardFile(validpath, 'rb', shard_size=shard_size,
+                           start_pos=start_pos) as shard:
+                body = MultipartBody(
+                    shard, buffer_size=read_size or self.read_size)
+                headers = {
+                    'Content-Type': body.content_type,
+                    'Content-Length': str(len(body)),
+                }
+                response, reader, writer = await self._request(
+                    'POST', self._base_path + '/api/upload', headers, body)
+            try:
+                response.content = b''.join(
+                    [block async for block in self._body(reader, response)])
+            finally:
+                writer.close()
+        return shard_from_upload(response)
+
+    async def upload_shards(self, filepath, shards, read_size=None):
+        """ Uploads several shards of one file concurrently.
+
+        :param filepath: Path to file as a string
+        :param shards: List of (start, end) byte positions, one per shard
+        :param read_size: Size in bytes of the blocks read and sent
+        :return: List of upstream.shard.Shard, in shard order
+        :raise TransferError: If any shard failed; shards that did upload
+        are available from its ``results`` attribute
+        """
+        Streamer.check_path(filepath)
+        results = await asyncio.gather(
+            *[self.upload(filepath, shard_size=end - start, start_pos=start,
+                          read_size=read_size)
+              for start, end in shards],
+            return_exceptions=True)
+        return self._check_results(results, 'upload')
+
+    async def download(self, shard, offset=0):
+        """ Downloads a shard from the web-core API into memory.
+
+        :param shard: upstream.shard.Shard instance
+        :param offset: Byte of the shard to start from
+        :return: Bytes of the shard from offset on
+        :raise ResponseError: If the server returned an error
+        """
+        chunks = []
+
+        async def _collect(chunk, position):
+            chunks.append(chunk)
+        await self._download(shard, _collect, offset)
+        return b''.join(chunks)
+
+    async def download_into(self, shard, writer, position, start=0,
+                            size=None):
+        """ Streams a shard into an upstream.file.PositionalWriter.
+
+        :param shard: upstream.shard.Shard instance
+        :param writer: upstream.file.PositionalWriter to write to
+        :param position: Position in the file of the first byte of the shard
+        :param start: Number of bytes of the shard already written
+        :param size: Expected size of the shard in bytes, if known
+        :return: Size of the shard in bytes
+        :raise ResponseError: If the shard is shorter or longer than size
+        :raise IntegrityError: If the shard has a digest and its data does
+        not match it
+        """
+        if size is not None and start >= size:
+            verify_shard(shard, await self._in_executor(
+                shard_hasher, shard, writer, position, size))
+            return size
+        hasher = await self._in_executor(
+            shard_hasher, shard, writer, position, start)
+
+        async def _write(chunk, offset):
+            if hasher is not None:
+                hasher.update(chunk)
+            await self._in_executor(writer.write_at, chunk, position + offset)
+        written = await self._download(shard, _write, start)
+        if size is not None and written != size:
+            raise ResponseError("Shard %s: expected %d bytes, received %d."
+                                % (shard.filehash, size, written))
+        verify_shard(shard, hasher)
+        return written
+
+    async def download_shards(self, shards, savepath, sizes=None):
+        """ Downloads several shards concurrently into a single file.  If
+        sizes are not given they are looked up with HEAD requests; if the
+        server does not report them, shards are fetched one at a time.
+
+        :param shards: List of upstream.shard.Shard instances, in file order
+        :param savepath: Path of the file to write to as string
+        :param sizes: Optional list of shard sizes in bytes
+        :return: Total number of bytes written
+        :raise TransferError: If any shard failed
+        """
+        shards = list(shards)
+
+        async def _fetch(shard, writer, offset, size=None):
+            try:
+                return await self.download_into(shard, writer, offset,
+                                                size=size)
+            except IntegrityError:
+                # Corrupt data: fetch the whole shard again, once.
+                return await self.download_into(shard, writer, offset,
+                                                size=size)
+
+        if sizes is None:
+            sizes = await asyncio.gather(
+                *[self._size(shard) for shard in shards],
+                return_exceptions=True)
+        if any(not isinstance(size, int) for size in sizes):
+            with PositionalWriter(savepath) as writer:
+                offset = 0
+                for shard in shards:
+                    offset += await _fetch(shard, writer, offset)
+            return offset
+
+        offsets = [sum(sizes[:i]) for i in range(len(sizes))]
+        with PositionalWriter(savepath, size=sum(sizes)) as writer:
+            results = await asyncio.gather(
+                *[_fetch(shard, writer, offset, size=size)
+                  for shard, offset, size in zip(shards, offsets, sizes)],
+                return_exceptions=True)
+        return sum(self._check_results(results, 'download'))
+
+    async def _download(self, shard, consume, offset=0):
+        """ Fetches a shard, handing each chunk received to the coroutine
+        ``consume(chunk, offset)``, with offsets relative to the shard.
+
+        :return: Offset reached, i.e. size of the shard if complete
+        """
+        if not shard.filehash:
+            raise ShardError("Shard missing filehash.")
+        headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+        async with self.semaphore:
+            response, reader, writer = await self._request(
+                'GET', '%s/api/download/%s' % (self._base_path, shard.uri),
+                headers)
+            try:
+                if offset and response.status_code == 416:
+                    return offset
+                if response.status_code >= 400:
+                    raise ResponseError("%s %s for %s" % (
+                        response.status_code, response.reason, shard.uri),
+                        response)
+                # A server that does not support ranges sends everything.
+                skip = offset if response.status_code != 206 else 0
+                async for chunk in self._body(reader, response):
+                    if skip:
+                        if len(chunk) <= skip:
+                            skip -= len(chunk)
+                            continue
+                        chunk, skip = chunk[skip:], 0
+                    await self._throttle(len(chunk))
+                    await consume(chunk, offset)
+                    offset += len(chunk)
+            finally:
+                writer.close()
+        return offset
+
+    async def _throttle(self, amount):
+        """ Waits on the limiter, if any, for amount bytes """
+        if self.limiter is not None:
+            delay = self.limiter.reserve(amount)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def _timed(self, awaitable):
+        """ Awaits a network operation, giving up after self.timeout
+
+        :raise asyncio.TimeoutError: If it took longer than that
+        """
+        return await asyncio.wait_for(awaitable, self.timeout)
+
+    @staticmethod
+    async def _in_executor(func, *args):
+        """ Runs blocking file I/O in the event loop's default executor """
+        return await asyncio.get_event_loop().run_in_executor(
+            None, func, *args)
+
+    async def _size(self, shard):
+        """ Looks up the size of a shard with a HEAD request
+
+        :return: Size in bytes, or None if the server does not say
+        """
+        async with self.semaphore:
+            response, reader, writer = await self._request(
+                'HEAD', '%s/api/download/%s' % (self._base_path, shard.uri))
+            writer.close()
+        length = response.headers.get('content-length')
+        if response.status_code != 200 or length is None:
+            return None
+        return int(length)
+
+    @staticmethod
+    def _check_results(results, action):
+        """ Raises a TransferError if any result of asyncio.gather is an
+        exception, or returns the results otherwise.
+        """
+        errors = dict((idx, result) for idx, result in enumerate(results)
+                      if isinstance(result, Exception))
+        if errors:
+            raise TransferError(
+                "%d of %d shard(s) failed to %s."
+                % (len(errors), len(results), action),
+                results=[None if idx in errors else result
+                         for idx, result in enumerate(results)],
+                errors=errors)
+        return results
+
+    async def _request(self, method, path, headers=None, body=()):
+        """ Opens a connection, sends a request and reads the response
+        status and headers.  The caller must read the body, if any, with
+        _body() and close the returned writer.
+
+        :return: Tuple of (AsyncResponse, StreamReader, StreamWriter)
+        :raise asyncio.TimeoutError: If the server takes longer than
+        self.timeout to connect, take more of the request or answer
+        """
+        reader, writer = await self._timed(asyncio.open_connection(
+            self._host, self._port,
+            ssl=ssl.create_default_context() if self._https else None))
+        try:
+            lines = ['%s %s HTTP/1.1' % (method, path),
+                     'Host: %s' % self._netloc,
+                     'Connection: close']
+            lines.extend('%s: %s' % item for item in (headers or {}).items())
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+            blocks = iter(body)
+            while True:
+                block = await self._in_executor(next, blocks, None)
+                if block is None:
+                    break
+                await self._throttle(len(block))
+                writer.write(block)
+                await self._timed(writer.drain())
+            await self._timed(writer.drain())
+
+            status = await self._timed(reader.readline())
+            version, code, reason = (status.decode('latin-1').rstrip('\r\n')
+                                     .split(' ', 2) + [''])[:3]
+            if not version.startswith('HTTP/'):
+                raise ResponseError("Malformed response from server.")
+            response_headers = {}
+            while True:
+                line = await self._timed(reader.readline())
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                response_headers[name.strip().lower()] = value.strip()
+            response = AsyncResponse(int(code), reason, response_headers)
+            response.method = method
+        except BaseException:
+            writer.close()
+            raise
+        return response, reader, writer
+
+    async def _body(self, reader, response):
+        """ Yields the body of a response in chunks as they arrive
+
+        :raise asyncio.TimeoutError: If the server sends nothing for
+        self.timeout
+        """
+        if response.method == 'HEAD' or response.status_code in (204, 304):
+            return
+        if response.headers.get('transfer-encoding') == 'chunked':
+            while True:
+                line = await self._timed(reader.readline())
+                size = int(line.split(b';')[0], 16)
+                if not size:
+                    return
+                remaining = size
+                while remaining:
+                    chunk = await self._timed(
+                        reader.read(min(remaining, self.read_size)))
+                    if not chunk:
+                        raise ResponseError("Connection closed mid-body.")
+                    remaining -= len(chunk)
+                    yield chunk
+                await self._timed(reader.readline())
+        length = response.headers.get('content-length')
+        remaining = int(length) if length is not None else None
+        while remaining is None or remaining > 0:
+            chunk = await self._timed(reader.read(
+                self.read_size if remaining is None
+                else min(remaining, self.read_size)))
+            if not chunk:
+                if remaining:
+                    raise ResponseError("Connection closed mid-body.")
+                return
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import time
+import errno
+import shutil
+import binascii
+import threading
+import contextlib
+from collections import OrderedDict
+
+
+class ShardCache(object):
+
+    """ An on-disk, content-addressed cache of downloaded shards, keyed by
+    filehash and shared by every process pointing at the same directory.
+    Its total size is kept under max_size by evicting the least recently
+    used shards.  Concurrent requests for a shard that is not cached yet,
+    from threads or from other processes, collapse into a single fetch.
+
+    Shards held with :meth:`use` are never evicted while they are held,
+    and room for a new shard is made before it enters the cache.  A shard
+    larger than max_size is still handed out, but it does not push any
+    other shard out and is evicted as soon as it is no longer held.
+
+    Usage::
+
+        cache = ShardCache('/var/cache/upstream', max_size=10 * 2 ** 30)
+        with cache.use(shard.filehash, download_to_path) as path:
+            shutil.copyfile(path, dest)
+
+    """
+
+    def __init__(self, root, max_size=10737418240, lock_timeout=600):
+        """
+        :param root: Directory holding the cache, created if missing
+        :param max_size: Maximum total size of cached shards in bytes
+        :param lock_timeout: Seconds after which a fetch lock left behind
+        by another process is considered abandoned.  A process refreshes
+        its lock while it downloads, so this bounds how long a crashed
+        process holds up the others, not how long a download may take.
+        """
+        self.root = root
+        self.max_size = max_size
+        self.lock_timeout = lock_timeout
+        self._guard = threading.Lock()
+        self._locks = {}
+        self._pins = {}
+        self._index = None
+        self._total = 0
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def path(self, filehash):
+        """ Returns where the shard with filehash is, or would be, cached
+
+        :param filehash: Filehash of the shard
+        :return: Path as string
+        """
+        return os.path.join(self.root, filehash[:2], filehash)
+
+    def get(self, filehash):
+        """ Returns the path of a cached shard, marking it as recently used
+
+        :param filehash: Filehash of the shard
+        :return: Path as string, or None if not cached
+        """
+        path = self.path(filehash)
+        try:
+            os.utime(path, None)
+        except OSError:
+            with self._guard:
+                self._forget(filehash)
+            return None
+        with self._guard:
+            self._touch(filehash, path)
+        return path
+
+    def fetch(self, filehash, download):
+        """ Returns the path of a cached shard, calling download to fetch
+        it first if it is not cached.  Only one thread or process at a time
+        downloads a given shard; the others wait for it and then use the
+        cached copy.  The shard may be evicted by any later fetch; use
+        :meth:`use` to keep it around while reading it.
+
+        :param filehash: Filehash of the shard
+        :param download: Callable taking a path to write the shard to
+        :return: Path of the cached shard as string
+        """
+        with self._guard:
+            entry = self._locks.setdefault(filehash, [threading.Lock(), 0])
+            entry[1] += 1
+            self._pin(filehash)
+        try:
+            with entry[0]:
+                return self._fetch(filehash, download)
+        finally:
+            with self._guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[filehash]
+                self._unpin(filehash)
+
+    @contextlib.contextmanager
+    def use(self, filehash, download):
+        """ Like :meth:`fetch`, but holds the shard in the cache until the
+        with block is left, so that no other fetch evicts it meanwhile.
+
+        :param filehash: Filehash of the shard
+        :param download: Callable taking a path to write the shard to
+        :return: Context manager giving the path of the cached shard
+        """
+        with self._guard:
+            self._pin(filehash)
+        try:
+            yield self.fetch(filehash, download)
+        finally:
+            with self._guard:
+                self._unpin(filehash)
+                if filehash not in self._pins:
+                    self._evict()
+
+    def link(self, filehash, dest):
+        """ Makes a cached shard available at dest, as a hard link where
+        possible and as a copy otherwise.  A hard link shares its data with
+        the cache, so dest must not be modified in place.
+
+        :param filehash: Filehash of a cached shard
+        :param dest: Path to create, which must not exist
+        """
+        path = self.path(filehash)
+        try:
+            os.link(path, dest)
+        except (OSError, AttributeError):
+            shutil.copyfile(path, dest)
+
+    def size(self):
+        """ Returns the total size of the cached shards in bytes """
+        with self._guard:
+            self._load()
+            return self._total
+
+    def evict(self):
+        """ Rescans the cache directory, picking up changes made by other
+        processes, then deletes the least recently used shards that are
+        not in use until the cache fits in max_size.
+        """
+        with self._guard:
+            self._index = None
+            self._evict()
+
+    def _fetch(self, filehash, download):
+        """ Fetches a shard into the cache unless it is already there,
+        with the per-key thread lock held.
+        """
+        path = self.get(filehash)
+        if path is not None:
+            return path
+        path = self.path(filehash)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        lock = path + '.lock'
+        token = self._lock_file(lock)
+        stop = threading.Event()
+        keeper = threading.Thread(target=self._keep_lock,
+                                  args=(lock, token, stop))
+        keeper.daemon = True
+        keeper.start()
+        try:
+            if self.get(filehash) is not None:
+                # Another process fetched it while we waited.
+                return path
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            try:
+                download(tmp)
+                size = os.path.getsize(tmp)
+                with self._guard:
+                    # Make room first, so the new shard is never the one
+                    # evicted to fit it in.  One that cannot fit anyway
+                    # makes no room.
+                    self._evict(size if size <= self.max_size else 0)
+                    os.rename(tmp, path)
+                    self._add(filehash, path, size)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        finally:
+            stop.set()
+            keeper.join()
+            self._unlock(lock, token)
+        return path
+
+    def _load(self):
+        """ Builds the in-memory index of cached shards, least recently
+        used first, from the cache directory if it is not built yet.
+        Called with the guard held.
+        """
+        if self._index is not None:
+            return
+        self._index = OrderedDict()
+        self._total = 0
+        for path, size, mtime in sorted(self._entries(),
+                                        key=lambda entry: entry[2]):
+            self._index[os.path.basename(path)] = size
+            self._total += size
+
+    def _add(self, filehash, path, size):
+        """ Records a new shard as the most recently used one.  Called with
+        the guard held.
+        """
+        self._load()
+        self._forget(filehash)
+        self._index[filehash] = size
+        self._total += size
+
+    def _touch(self, filehash, path):
+        """ Marks a shard as the most recently used one, indexing it if
+        another process cached it.  Called with the guard held.
+        """
+        self._load()
+        size = self._index.pop(filehash, None)
+        if size is None:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                return
+            self._total += size
+        self._index[filehash] = size
+
+    def _forget(self, filehash):
+        """ Drops a shard from the index.  Called with the guard held. """
+        if self._index is not None and filehash in self._index:
+            self._total -= self._index.pop(filehash)
+
+    def _pin(self, filehash):
+        self._pins[filehash] = self._pins.get(filehash, 0) + 1
+
+    def _unpin(self, filehash):
+        self._pins[filehash] -= 1
+        if not self._pins[filehash]:
+            del self._pins[filehash]
+
+    def _evict(self, incoming=0):
+        """ Deletes the least recently used shards that are not in use
+        until the cache, plus incoming bytes about to be added, fits in
+        max_size.  Called with the guard held.
+        """
+        self._load()
+        # Shards that can never fit go first, then the least recently used.
+        oversized = [filehash for filehash, size in self._index.items()
+                     if size > self.max_size]
+        for filehash in oversized + list(self._index):
+            if (self._total + incoming <= self.max_size and
+                    filehash not in oversized):
+                break
+            if filehash in self._pins or filehash not in self._index:
+                continue
+            try:
+                os.remove(self.path(filehash))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    continue
+            self._forget(filehash)
+
+    def _entries(self):
+        """ Yields (path, size, mtime) for every cached shard """
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith(('.lock', '.tmp')):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _lock_file(self, path, poll=0.1):
+        """ Takes a lock shared with other processes by creating path,
+        waiting for another process holding it to release it first.
+
+        :return: Token written to the lock, telling its owner
+        """
+        token = '%d %s' % (os.getpid(),
+                           binascii.hexlify(os.urandom(8)).decode('ascii'))
+        while True:
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                try:
+                    os.write(fd, token.encode('ascii'))
+                finally:
+                    os.close(fd)
+                return token
+            try:
+                if time.time() - os.stat(path).st_mtime > self.lock_timeout:
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue
+            time.sleep(poll)
+
+    def _owns(self, path, token):
+        """ :return: True if the lock at path still holds token """
+        try:
+            with open(path, 'rb') as f:
+                return f.read().decode('ascii', 'replace') == token
+        except (IOError, OSError):
+            return False
+
+    def _keep_lock(self, path, token, stop):
+        """ Refreshes the mtime of a lock held by this process until stop
+        is set, so that other processes do not take it for abandoned
+        during a long download.
+        """
+        interval = max(0.01, self.lock_timeout / 4.0)
+        while not stop.wait(interval):
+            if not self._owns(path, token):
+                return
+            try:
+                os.utime(path, None)
+            except OSError:
+                return
+
+    def _unlock(self, path, token):
+        """ Removes a lock, unless another process took it over """
+        if not self._owns(path, token):
+            return
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+""" Content-defined chunking.  Rather than cutting a file every shard_size
+bytes, boundaries are placed where a rolling hash of the last bytes read
+matches a pattern, so they move with the content: inserting or removing
+bytes near the start of a file only changes the shards around the edit,
+and the shards after it come out identical to before.
+
+The rolling hash is a "gear" hash: each byte shifts the hash left by one
+bit and adds a fixed random value for that byte, so the hash only ever
+depends on the last 64 bytes seen.
+"""
+
+import struct
+import hashlib
+
+
+MASK64 = 0xffffffffffffffff
+
+#: Fixed per-byte values for the gear hash.  They must never change, or
+#: files chunked before and after would no longer share boundaries.
+GEAR = [
+    struct.unpack('>Q', hashlib.sha256(struct.pack('B', i)).digest()[:8])[0]
+    for i in range(256)
+]
+
+
+def boundary_mask(avg_size):
+    """ Returns the mask that the gear hash is checked against for an
+    average chunk size of avg_size: the top log2(avg_size) bits, which
+    depend on all of the last 64 bytes rather than just the last few.
+
+    :param avg_size: Desired average chunk size in bytes
+    :return: Mask as int
+    """
+    bits = max(1, int(avg_size).bit_length() - 1)
+    return (MASK64 << (64 - bits)) & MASK64
+
+
+def cdc_shards(filepath, avg_size, min_size=None, max_size=None,
+               read_size=1048576):
+    """ Splits a file into content-defined shards.  Shard boundaries are
+    never closer than min_size, apart from at the end of the file, nor
+    further apart than max_size.  Bytes within min_size of the last
+    boundary are skipped without hashing, which is what keeps this
+    affordable: the hash runs in pure Python, at around 5-10 MB/s of
+    hashed data.
+
+    :param filepath: Path to file as string
+    :param avg_size: Desired average shard size in bytes
+    :param min_size: Minimum shard size in bytes; avg_size / 4 by default
+    :param max_size: Maximum shard size in bytes; avg_size * 4 by default
+    :param read_size: Size in bytes of each block read from disk
+    :return: List of (start, end) tuples, like clitool.calculate_shards
+    """
+    if min_size is None:
+        min_size = max(1, avg_size // 4)
+    if max_size is None:
+        max_size = avg_size * 4
+    if not 0 < min_size <= max_size:
+        raise ValueError("Expected 0 < min_size <= max_size")
+    # Nothing is cut within min_size of a boundary, so aim the hash at the
+    # rest of the average.
+    mask = boundary_mask(max(1, avg_size - min_size))
+    gear = GEAR
+
+    shards = []
+    start = 0      # file offset of the current shard
+    pos = 0        # file offset of buf[0]
+    h = 0
+    with open(filepath, 'rb') as f:
+        while True:
+            buf = bytearray(f.read(read_size))
+            if not buf:
+                break
+            i = max(0, start + min_size - pos)
+            end = len(buf)
+            while i < end:
+                limit = min(end, start + max_size - pos)
+                found = False
+                # Chunking spends its time here.  Iterating over a slice
+                # of buf runs about twice as fast as indexing it.
+                for n, byte in enumerate(buf[i:limit], i + 1):
+                    h = (h + h + gear[byte]) & MASK64
+                    if not h & mask:
+                        found = True
+                        break
+                i = n if found else limit
+                if found or pos + i - start >= max_size:
+                    shards.append((start, pos + i))
+                    start = pos + i
+                    h = 0
+                    i += min_size
+            pos += end
+    if pos > start:
+        shards.append((start, pos))
+    return shards
@@ -28,37 +28,89 @@ import os
 import sys
 import argparse
 import math
+import json
 import uuid
+import hashlib
 
-import progressbar
-
+# Only modules that import nothing heavy belong up here.  The streamer,
+# and with it requests, is imported by the commands that transfer
+# something, so that --help, --version and bad arguments answer at once.
 import upstream
+from upstream import chunker
 from upstream.shard import Shard
 from upstream.file import SizeHelpers
-from upstream.streamer import Streamer
-from upstream.exc import FileError
+from upstream.cache import ShardCache
+from upstream.manifest import ManifestWriter, read_manifest
+from upstream.progress import Progress
+from upstream.ratelimit import TokenBucket
+from upstream.hedge import HedgePolicy
+from upstream.probe import ProbeCache, default_path
+from upstream.journal import UploadJournal, DownloadJournal
+from upstream.exc import FileError, TransferError
+
+
+#: Server used when no --server is given
+DEFAULT_SERVER = 'http://node1.metadisk.org'
+
+#: Names of Streamer.UPLOAD_METHODS, spelled out so that building the
+#: argument parser does not import the streamer
+UPLOAD_METHODS = ['chunked', 'form', 'lean', 'sendfile']
+
+#: Fields of each shard in an upload-batch --catalog, as for a manifest
+CATALOG_FIELDS = ('offset', 'size', 'uri', 'digest', 'servers')
+
+
+class ProgressBar(object):
+
+    """ A single progress bar for a whole transfer, drawn as the listener
+    of an upstream.progress.Progress.
+    """
+
+    def __init__(self, label, total):
+        import progressbar
+        self.bar = progressbar.ProgressBar(
+            maxval=total,
+            widgets=[
+                label, progressbar.Percentage(),
+                ' ', progressbar.Bar(),
+                ' ', progressbar.ETA(),
+                ' ', progressbar.FileTransferSpeed()
+            ],
+        )
+        self.total = total
+        self.bar.start()
+
+    def update(self, done, total):
+        self.bar.update(min(done, self.total))
+
+    def finish(self):
+        self.bar.finish()
 
 
-class ProgressCallback(object):
+def make_progress(label, total, done=None):
+    """ Returns a Progress drawing a progress bar for a transfer of total
+    bytes, or None if there is nothing to draw: when stdout is not a
+    terminal or the total is unknown.  Without one, no progress callbacks
+    are made at all.
+
+    :param label: Text in front of the bar
+    :param total: Size of the transfer in bytes, or None
+    :param done: Optional list of bytes already done per shard
+    :return: upstream.progress.Progress or None
+    """
+    if total is None or not sys.stdout.isatty():
+        return None
+    bar = ProgressBar(label, total)
+    progress = Progress(total, listener=bar.update, done=done)
+    progress.bar = bar
+    return progress
 
-    def __init__(self):
-        self.bar = None
-        self.started = False
 
-    def callback(self, values):
-        if not self.bar:
-            self.bar = progressbar.ProgressBar(
-                maxval=values[1],
-                widgets=[
-                    'Uploading Shard: ', progressbar.Percentage(),
-                    ' ', progressbar.Bar(),
-                    ' ', progressbar.ETA(),
-                    ' ', progressbar.FileTransferSpeed()
-                ],
-            )
-        if not self.started:
-            self.bar.start()
-            self.bar.update(values[0])
+def finish_progress(progress):
+    """ Draws the final state of a progress bar from make_progress() """
+    if progress is not None:
+        progress.finish()
+        progress.bar.finish()
 
 
 def check_and_get_dest(dest):
@@ -113,6 +165,59 @@ def parse_shard_size(size):
         return SizeHelpers.mib_to_bytes(int(number))
 
 
+def server_list(value):
+    """ Turns --server values into a list of server URLs.  Each value may
+    hold several URLs separated by commas.
+
+    :param value: List of strings as collected by argparse, a single
+    string, or None for the default server
+    :return: List of URLs as strings
+    """
+    if not value:
+        return [DEFAULT_SERVER]
+    if not isinstance(value, list):
+        value = [value]
+    return [server for item in value
+            for server in item.split(',') if server]
+
+
+def make_limiter(limit_rate):
+    """ Creates the bandwidth limiter for a --limit-rate value, given in
+    the same format as shard sizes and meaning bytes per second.
+
+    :param limit_rate: Rate as string, e.g. 512k, or None for no limit
+    :return: upstream.ratelimit.TokenBucket, or None
+    """
+    if not limit_rate:
+        return None
+    rate = parse_shard_size(limit_rate)
+    if not rate:
+        sys.stderr.write('Invalid rate limit: %s\n' % limit_rate)
+        sys.exit(1)
+    return TokenBucket(rate)
+
+
+def make_probe_cache(ttl):
+    """ Creates the cache of server probes for a --probe-ttl value.  It
+    lives in the user's cache directory, so that consecutive runs share
+    it; a ttl of 0 or less means every run probes afresh.
+
+    :param ttl: Seconds probe results are trusted for
+    :return: upstream.probe.ProbeCache
+    """
+    if ttl <= 0:
+        return ProbeCache(ttl=0)
+    return ProbeCache(default_path(), ttl=ttl)
+
+
+def streamer_probe(args):
+    """ :param args: Argparse namespace
+    :return: Keyword arguments for Streamer's probe options
+    """
+    return {'probe': None if args.probe == 'off' else args.probe,
+            'probe_cache': make_probe_cache(args.probe_ttl)}
+
+
 def calculate_shards(args, shard_size, filepath):
     file_size = os.path.getsize(filepath)
     num_shards = math.ceil(file_size / float(shard_size))
@@ -132,11 +237,37 @@ def calculate_shards(args, shard_size, filepath):
     return shards
 
 
-def upload(args):
+def upload_streamer(args, servers, metrics=None):
+    """ Creates the Streamer for the upload and upload-batch commands
+
+    :param args: Parsed args namespace
+    :param servers: List of server URLs
+    :param metrics: Optional upstream.metrics.Metrics to record transfers in
+    :return: upstream.streamer.Streamer
+    """
+    from upstream.streamer import Streamer
+    from upstream.retry import RetryPolicy
+
+    if not 1 <= args.replicas <= len(servers):
+        sys.stderr.write('--replicas must be between 1 and the number of '
+                         'servers, %d\n' % len(servers))
+        sys.exit(1)
+    return Streamer(servers, pool_size=max(1, args.jobs), use_mmap=args.mmap,
+                    upload_method=args.upload_method, metrics=metrics,
+                    limiter=make_limiter(args.limit_rate),
+                    retry=RetryPolicy(attempts=max(0, args.retries) + 1),
+                    replicas=args.replicas, **streamer_probe(args))
+
+
+def upload(args, metrics=None):
     """ Controls actions for uploading
 
     :param args: Parsed args namespace
+    :param metrics: Optional upstream.metrics.Metrics to record transfers in
     """
+    from upstream.streamer import Streamer
+    from upstream.index import ShardIndex
+
     shard_size = parse_shard_size(args.shard_size)
 
     try:
@@ -145,121 +276,578 @@ def upload(args):
         sys.stderr.write('%s\n' % str(e))
         sys.exit(1)
 
-    streamer = Streamer(args.server)
-    shards = calculate_shards(args, shard_size, filepath)
-    shard_info = []
-    for idx, shard in enumerate(shards):
-        i = idx + 1
-        start = shard[0]
-        callback = ProgressCallback()
-        shard = streamer.upload(
-            args.file,
-            start_pos=start,
-            shard_size=shard_size,
-            callback=callback.callback
-        )
-        callback.bar.finish()
-        sys.stdout.flush()
+    jobs = max(1, args.jobs)
+    servers = server_list(args.server)
+    streamer = upload_streamer(args, servers, metrics)
+
+    journal_path = args.journal or UploadJournal.default_path(filepath)
+    if args.resume and os.path.exists(journal_path):
+        journal = UploadJournal.load(journal_path)
+        if not journal.matches(filepath):
+            sys.stderr.write('%s was written for a different or modified '
+                             'file\n' % journal_path)
+            sys.exit(1)
         if args.verbose:
-            print("\nShard %d - URI: %s\n" % (i, shard.uri))
-        shard_info.append(shard.uri)
+            print("Resuming: %d of %d shard(s) already uploaded."
+                  % (len(journal.uris), len(journal.shards)))
+    else:
+        if args.chunking == 'cdc':
+            shards = content_defined_shards(filepath, shard_size)
+            if args.verbose:
+                print("File will be uploaded in %d content-defined "
+                      "piece(s)." % len(shards))
+        else:
+            shards = calculate_shards(args, shard_size, filepath)
+        journal = UploadJournal(journal_path, filepath, shards)
+        journal.save()
+
+    pending = journal.pending()
+    sizes = [journal.shards[idx][1] - journal.shards[idx][0]
+             for idx in pending]
+    progress = make_progress('Uploading: ', sum(sizes))
+
+    def _uploaded(idx, shard):
+        journal.record(pending[idx], shard)
+        if progress is not None:
+            progress.update(idx, sizes[idx])
+        if args.verbose:
+            print("\nShard %d - URI: %s\n" % (pending[idx] + 1, shard.uri))
+        sys.stdout.flush()
+
+    index = ShardIndex(args.index) if args.index else None
+    # The whole file can only be hashed on the way out if every shard is
+    # read, once, in order, and sendfile does not read it at all.
+    file_hasher = None
+    if (jobs == 1 and index is None and args.upload_method != 'sendfile'
+            and len(pending) == len(journal.shards)):
+        file_hasher = hashlib.sha256()
+    try:
+        streamer.upload_shards(
+            filepath, [journal.shards[idx] for idx in pending], jobs=jobs,
+            callback=progress.shard_callback if progress else None,
+            on_shard=_uploaded, index=index,
+            digests=bool(args.manifest), file_hasher=file_hasher)
+    except TransferError as e:
+        for idx in sorted(e.errors):
+            sys.stderr.write("Shard %d failed: %s\n"
+                             % (pending[idx] + 1, e.errors[idx]))
+        sys.stderr.write("Progress saved to %s; run again with --resume to "
+                         "upload the remaining shards.\n" % journal_path)
+        raise
+    finally:
+        finish_progress(progress)
+        if index is not None:
+            index.close()
+
+    if file_hasher is not None:
+        print()
+        print("SHA-256 of %s: %s" % (filepath, file_hasher.hexdigest()))
+
+    if args.manifest:
+        # The last shard of the plan may run past the end of the file.
+        filesize = os.path.getsize(filepath)
+        with ManifestWriter(args.manifest) as manifest:
+            for idx, (start, end) in enumerate(journal.shards):
+                manifest.add(start, min(end, filesize) - start,
+                             journal.uris[idx],
+                             journal.digests.get(idx),
+                             journal.servers.get(idx))
+        journal.remove()
+
+        print()
+        print("Download this file by using the following command: ")
+        print("upstream download --manifest", args.manifest,
+              "--dest <filename>")
+        return
+
+    shard_info = [journal.uris[idx] for idx in range(len(journal.shards))]
+    journal.remove()
 
     print()
     print("Download this file by using the following command: ")
-    print("upstream download --uri", " ".join(shard_info), "--dest <filename>")
+    if servers == [DEFAULT_SERVER]:
+        print("upstream download --uri", " ".join(shard_info),
+              "--dest <filename>")
+    else:
+        print("upstream --server", ",".join(servers), "download --uri",
+              " ".join(shard_info), "--dest <filename>")
+
 
+def scan_files(directory):
+    """ Lists every file under a directory and its subdirectories, without
+    following symbolic links to directories.  Uses os.scandir where there
+    is one, which saves a stat call per entry over os.walk.
 
-def download(args):
+    :param directory: Path of the directory as string
+    :return: Sorted list of file paths
+    """
+    scandir = getattr(os, 'scandir', None)
+    if scandir is None:
+        return sorted(
+            path for root, _, names in os.walk(directory)
+            for path in (os.path.join(root, name) for name in names)
+            if os.path.isfile(path))
+    files = []
+    pending = [directory]
+    while pending:
+        for entry in scandir(pending.pop()):
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+            elif entry.is_file():
+                files.append(entry.path)
+    return sorted(files)
+
+
+def read_paths(stream, null=False):
+    """ Reads a list of paths, one per line or separated by NUL characters
+
+    :param stream: File object to read from
+    :param null: Whether paths are separated by NUL characters
+    :return: List of paths, without blank entries
+    """
+    data = stream.read()
+    if null:
+        return [path for path in data.split('\0') if path]
+    return [path.rstrip('\r') for path in data.split('\n')
+            if path.rstrip('\r')]
+
+
+def batch_name(path, base=None):
+    """ Returns the name a file of a batch is recorded under: its path
+    relative to base, or for a path read from a list, the path without
+    any drive, leading separator or parent directory references.
+
+    :param path: Path of the file as string
+    :param base: Directory the file was found under, if any
+    :return: Relative path as string
+    """
+    if base is not None:
+        return os.path.relpath(path, base)
+    path = os.path.splitdrive(os.path.normpath(path))[1]
+    parts = [part for part in path.replace('\\', '/').split('/')
+             if part not in ('', '.', '..')]
+    return os.path.join(*parts) if parts else path
+
+
+def fixed_shards(size, shard_size):
+    """ Returns (start, end) shards of shard_size bytes covering size
+    bytes, the last one ending at size
+    """
+    return [(start, min(start + shard_size, size))
+            for start in range(0, size, shard_size)]
+
+
+def content_defined_shards(filepath, shard_size):
+    """ Returns the (start, end) shards of a file cut where its content
+    says, averaging shard_size bytes but none over 250 MiB
+    """
+    max_size = min(shard_size * 4, SizeHelpers.mib_to_bytes(250))
+    return chunker.cdc_shards(
+        filepath, shard_size, min_size=min(max(1, shard_size // 4), max_size),
+        max_size=max_size)
+
+
+def plan_shards(args, shard_size, filepath):
+    """ Returns the (start, end) shards a file of a batch is cut into, the
+    last one ending at the end of the file
+    """
+    if args.chunking == 'cdc':
+        return content_defined_shards(filepath, shard_size)
+    return fixed_shards(os.path.getsize(filepath), shard_size)
+
+
+def upload_batch(args, metrics=None):
+    """ Controls actions for uploading many files at once.  The shards of
+    every file go through one Streamer, so the whole batch shares one pool
+    of workers and connections.
+
+    :param args: Parsed args namespace
+    :param metrics: Optional upstream.metrics.Metrics to record transfers in
+    """
+    from upstream.index import ShardIndex
+
+    shard_size = parse_shard_size(args.shard_size)
+    if args.source == '-':
+        base = None
+        paths = read_paths(sys.stdin, args.null)
+    elif os.path.isdir(args.source):
+        base = args.source
+        paths = scan_files(base)
+    else:
+        sys.stderr.write('%s is not a directory\n' % args.source)
+        sys.exit(1)
+
+    files = []
+    for path in paths:
+        if not os.path.isfile(path):
+            sys.stderr.write('Skipping %s: not a file or not found\n' % path)
+            continue
+        files.append((path, plan_shards(args, shard_size, path)))
+    if args.verbose:
+        print("%d file(s) in %d shard(s) to upload."
+              % (len(files), sum(len(plan) for _, plan in files)))
+
+    streamer = upload_streamer(args, server_list(args.server), metrics)
+    remaining = [len(plan) for _, plan in files]
+    uploaded = [[None] * len(plan) for _, plan in files]
+    progress = make_progress('Uploading: ', sum(
+        end - start for _, plan in files for start, end in plan))
+    catalog = open(args.catalog, 'w') if args.catalog else None
+
+    def _list(i):
+        # Written as soon as the file is complete, so that an interrupted
+        # batch still records every file it finished.
+        path, plan = files[i]
+        name = batch_name(path, base)
+        entries = [(start, end - start, shard.uri, shard.digest,
+                    shard.servers)
+                   for (start, end), shard in zip(plan, uploaded[i])]
+        if catalog is not None:
+            catalog.write(json.dumps({
+                'path': name,
+                'size': os.path.getsize(path),
+                'shards': [dict(zip(CATALOG_FIELDS, entry))
+                           for entry in entries],
+            }) + '\n')
+            catalog.flush()
+            return
+        manifest_path = os.path.join(args.manifest_dir, name + '.manifest')
+        directory = os.path.dirname(manifest_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with ManifestWriter(manifest_path) as manifest:
+            for entry in entries:
+                manifest.add(*entry)
+
+    def _uploaded(i, j, shard):
+        if progress is not None:
+            start, end = files[i][1][j]
+            progress.update((i, j), end - start)
+        uploaded[i][j] = shard
+        remaining[i] -= 1
+        if not remaining[i]:
+            _list(i)
+            if args.verbose:
+                print("\nUploaded %s" % files[i][0])
+                sys.stdout.flush()
+
+    index = ShardIndex(args.index) if args.index else None
+    failed = set()
+    error = None
+    try:
+        for i, (_, plan) in enumerate(files):
+            if not plan:
+                _list(i)
+        streamer.upload_files(
+            files, jobs=max(1, args.jobs),
+            callback=progress.shard_callback if progress else None,
+            on_shard=_uploaded, index=index, digests=True)
+    except TransferError as e:
+        error = e
+        for (i, j), shard_error in sorted(e.errors.items()):
+            sys.stderr.write("%s: shard %d failed: %s\n"
+                             % (files[i][0], j + 1, shard_error))
+            failed.add(i)
+    finally:
+        finish_progress(progress)
+        if index is not None:
+            index.close()
+        if catalog is not None:
+            catalog.close()
+
+    print()
+    print("Uploaded %d of %d file(s); their shards are listed in %s."
+          % (len(files) - len(failed), len(files),
+             args.catalog or args.manifest_dir))
+    if error is not None:
+        raise error
+
+
+def download(args, metrics=None):
     """ Controls actions for downloading
 
     :param args: Argparse namespace
+    :param metrics: Optional upstream.metrics.Metrics to record transfers in
     """
+    from upstream.streamer import Streamer
+    from upstream.retry import RetryPolicy
+
     shards = []
-    for uri in args.uri:
-        if args.verbose:
-            print("Creating shard.")
-        shard = Shard()
-        shard.from_uri(uri)
-        shards.append(shard)
+    sizes = None
+    if args.manifest:
+        sizes = []
+        for entry in read_manifest(args.manifest):
+            shard = Shard(digest=entry.digest, servers=entry.servers)
+            shard.from_uri(entry.uri)
+            shards.append(shard)
+            sizes.append(entry.size)
+    else:
+        for uri in args.uri:
+            if args.verbose:
+                print("Creating shard.")
+            shard = Shard()
+            shard.from_uri(uri)
+            shards.append(shard)
 
     if args.verbose:
         print("There are %d shards to download." % len(shards))
 
-    streamer = Streamer(args.server)
+    jobs = max(1, args.jobs)
+    streamer = Streamer(server_list(args.server), pool_size=jobs,
+                        metrics=metrics,
+                        limiter=make_limiter(args.limit_rate),
+                        retry=RetryPolicy(attempts=max(0, args.retries) + 1),
+                        hedge=HedgePolicy() if args.hedge else None,
+                        **streamer_probe(args))
     if args.verbose:
         print("Connecting to %s..." % streamer.server)
 
-    path, fname = check_and_get_dest(args.dest)
-    savepath = os.path.join(path, fname)
-    for i, shard in enumerate(shards):
+    uris = [shard.uri for shard in shards]
+    if args.resume and args.dest and os.path.exists(args.dest):
+        path, fname = os.path.split(os.path.abspath(args.dest))
+        savepath = os.path.join(path, fname)
+        journal = DownloadJournal.load(DownloadJournal.default_path(savepath))
+        if not journal.matches(uris):
+            raise FileError('%s was started for a different download'
+                            % journal.path)
         if args.verbose:
+            print("Resuming: %d bytes already downloaded."
+                  % sum(journal.written))
+    else:
+        path, fname = check_and_get_dest(args.dest)
+        savepath = os.path.join(path, fname)
+        journal = DownloadJournal(DownloadJournal.default_path(savepath),
+                                  uris)
+        if sizes is not None:
+            journal.sizes = sizes
+        journal.save()
+
+    if args.verbose:
+        for shard in shards:
             print("Downloading file %s..." % shard.uri)
-        else:
-            print("Downloading file %d..." % (i + 1))
-        sys.stdout.flush()
+    else:
+        print("Downloading %d file(s)..." % len(shards))
+    sys.stdout.flush()
 
-        r = streamer.download(shard, slicesize=8096)
+    cache = None
+    if args.cache:
+        cache = ShardCache(args.cache, max_size=parse_shard_size(
+            args.cache_size))
 
-        with open(savepath, 'ab') as f:
-            if args.verbose:
-                print("Writing shard.")
-            for _bytes in r.iter_content():
-                f.write(_bytes)
+    progress = None
+    if None not in journal.sizes:
+        progress = make_progress('Downloading: ', sum(journal.sizes),
+                                 done=journal.written)
+
+    def _on_progress(idx, written):
+        journal.update(idx, written)
+        progress.update(idx, written)
+
+    def _on_shard(idx, size):
+        journal.finish(idx, size)
+        if progress is not None:
+            progress.update(idx, size)
+
+    try:
+        streamer.download_shards(
+            shards, savepath, jobs=jobs, sizes=journal.sizes,
+            done=journal.written,
+            on_progress=_on_progress if progress else journal.update,
+            on_shard=_on_shard, cache=cache)
+    except (Exception, KeyboardInterrupt):
+        journal.save()
+        sys.stderr.write("Progress saved to %s; run again with --resume "
+                         "--dest %s to continue.\n" % (journal.path, savepath))
+        raise
+    finally:
+        finish_progress(progress)
+    journal.remove()
 
     print("\nDownloaded to %s." % savepath)
     return fname
 
 
-def parse_args():
+def parse_args(argv=None):
     """ Parses args
 
+    :param argv: List of arguments to parse; sys.argv[1:] by default
     :return: argparse namespace
     """
     parser = argparse.ArgumentParser("Upstream",
                                      description="Command line client for "
                                                  "the Storj web-core API")
-    parser.add_argument('--server', default='http://node1.metadisk.org',
-                        help='Metadisk node to connect to')
+    parser.add_argument('--server', action='append',
+                        help='Metadisk node to connect to, default: %s. '
+                             'Repeat, or separate URLs with commas, to '
+                             'spread shards over several nodes'
+                             % DEFAULT_SERVER)
     parser.add_argument('-v', dest='verbose',
                         action='store_true', help='Verbose output')
+    parser.add_argument('--retries', type=int, default=5,
+                        help='Times to retry a shard after a transient '
+                             'error, such as a 503 or a dropped connection, '
+                             'waiting longer each time, default: 5')
+    parser.add_argument('--probe', default='eager',
+                        choices=['eager', 'lazy', 'off'],
+                        help='When to check that the servers are up: eager '
+                             '(before any transfer, default), lazy (let the '
+                             'first transfer to each server tell) or off')
+    parser.add_argument('--probe-ttl', type=float, default=300,
+                        help='Seconds for which a server found up or down '
+                             'is not probed again, also by later runs; 0 '
+                             'to always probe, default: 300')
+    parser.add_argument('--metrics-out',
+                        help='Write per-shard transfer metrics to this file '
+                             'when done')
+    parser.add_argument('--metrics-format', default='json',
+                        choices=['json', 'prometheus'],
+                        help='Format of --metrics-out: json (default; every '
+                             'shard and per-server histograms) or '
+                             'prometheus (text format for node_exporter\'s '
+                             'textfile collector)')
     parser.add_argument('--version', action='version',
                         version="%(prog)s " + upstream.__version__,
                         help='Display version.')
     subparser = parser.add_subparsers(dest='action')
 
-    upload_parser = subparser.add_parser('upload',
+    # Options shared by upload and upload-batch
+    sending = argparse.ArgumentParser(add_help=False)
+    sending.add_argument('--shard-size',
+                         default=SizeHelpers.mib_to_bytes(250),
+                         help='Size of shards to break file into and to '
+                              'upload, max: 250m, default: 250m. Ex. 25m - '
+                              'file will be broken into 25 MB shards and '
+                              'uploaded shard by shard')
+    sending.add_argument('--jobs', type=int, default=1,
+                         help='Number of shards to upload at the same time, '
+                              'default: 1')
+    sending.add_argument('--mmap', action='store_true',
+                         help='Read the file through a memory map')
+    sending.add_argument('--upload-method', default='form',
+                         choices=UPLOAD_METHODS,
+                         help='How to send shards: form (default), lean '
+                              'multipart, sendfile (lean, with the kernel '
+                              'copying file data; plain HTTP on Linux only) '
+                              'or chunked (raw data, chunked transfer '
+                              'encoding; only for nodes that accept it)')
+    sending.add_argument('--chunking', default='fixed',
+                         choices=['fixed', 'cdc'],
+                         help='Where to cut shards: fixed (every shard-size '
+                              'bytes, default) or cdc (at content-defined '
+                              'boundaries averaging shard-size bytes, so '
+                              'that edits to a file only change the shards '
+                              'around them; it reads the whole file first, '
+                              'at roughly 10 MB/s)')
+    sending.add_argument('--index',
+                         help='Path of a local index of uploaded shards, '
+                              'created if missing. Shards whose content is '
+                              'already in it are not uploaded again')
+    sending.add_argument('--replicas', type=int, default=1,
+                         help='Number of nodes to store each shard on, '
+                              'default: 1')
+    sending.add_argument('--limit-rate',
+                         help='Maximum upload rate in bytes per second, '
+                              'shared by all jobs. Ex. 512k or 2m')
+
+    upload_parser = subparser.add_parser('upload', parents=[sending],
                                          help="Upload a file from API")
-    upload_parser.add_argument('--shard-size',
-                               default=SizeHelpers.mib_to_bytes(250),
-                               help='Size of shards to break file into and '
-                                    'to upload, max: 250m, default: 250m. '
-                                    'Ex. 25m - file will be broken into 25 MB '
-                                    'shards and uploaded shard by shard')
+    upload_parser.add_argument('--resume', action='store_true',
+                               help='Resume an interrupted upload of the '
+                                    'same file, skipping the shards it had '
+                                    'already uploaded')
+    upload_parser.add_argument('--journal',
+                               help='Path of the file recording upload '
+                                    'progress, default: a file named after '
+                                    'the file\'s path under '
+                                    '~/.cache/upstream/journals')
+    upload_parser.add_argument('--manifest',
+                               help='Write the shard list to this manifest '
+                                    'file, to download with download '
+                                    '--manifest, instead of printing a '
+                                    'download command with every URI')
     upload_parser.add_argument('file', help="Path to file to upload")
 
+    batch_parser = subparser.add_parser(
+        'upload-batch', parents=[sending],
+        help="Upload many files, sharing workers and connections")
+    outputs = batch_parser.add_mutually_exclusive_group(required=True)
+    outputs.add_argument('--manifest-dir',
+                         help='Write a manifest for each file under this '
+                              'directory, at the file\'s path relative to '
+                              'the source directory, plus .manifest')
+    outputs.add_argument('--catalog',
+                         help='Write a single catalog of every file '
+                              'instead: one JSON object per line with the '
+                              'file\'s path, size and shards')
+    batch_parser.add_argument('-0', '--null', action='store_true',
+                              help='Paths read from stdin are separated by '
+                                   'NUL characters, as find -print0 writes '
+                                   'them, rather than by newlines')
+    batch_parser.add_argument('source',
+                              help='Directory to upload every file under, '
+                                   'or - to read the paths of the files to '
+                                   'upload from stdin')
+
     download_parser = subparser.add_parser('download',
                                            help="Download a file from API")
-    download_parser.add_argument(
+    source = download_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
         '--uri',
-        required=True,
         nargs='+',
         help='URI, or URIs, of file to download. Accepts multiple values, '
              'space separated. If multiple URIs are specified, the URIs are '
              'joined to create a single file'
     )
+    source.add_argument('--manifest',
+                        help='Manifest file written by upload --manifest '
+                             'listing the shards to download')
     download_parser.add_argument('--dest',
                                  help="Folder or file to download file")
     download_parser.add_argument('--shard-size', type=int, default=1024)
-
-    return parser.parse_args()
+    download_parser.add_argument('--jobs', type=int, default=1,
+                                 help='Number of shards to download at the '
+                                      'same time, default: 1')
+    download_parser.add_argument('--resume', action='store_true',
+                                 help='Continue an interrupted download '
+                                      'into --dest where it stopped')
+    download_parser.add_argument('--cache',
+                                 help='Directory of a local shard cache, '
+                                      'created if missing. Cached shards are '
+                                      'copied from it instead of downloaded')
+    download_parser.add_argument('--cache-size',
+                                 default=SizeHelpers.mib_to_bytes(10240),
+                                 help='Maximum size of the shard cache, '
+                                      'default: 10240m. Least recently used '
+                                      'shards are evicted beyond it')
+    download_parser.add_argument('--limit-rate',
+                                 help='Maximum download rate in bytes per '
+                                      'second, shared by all jobs. Ex. 512k '
+                                      'or 2m')
+    download_parser.add_argument('--hedge', action='store_true',
+                                 help='Request shards that fall well behind '
+                                      'the others a second time, from '
+                                      'another node where there is one; the '
+                                      'first copy to arrive is kept')
+
+    return parser.parse_args(argv)
 
 
 def main():
     args = parse_args()
-    if args.action == 'upload':
-        upload(args)
-    elif args.action == 'download':
-        download(args)
+    metrics = None
+    if args.metrics_out:
+        from upstream.metrics import Metrics
+        metrics = Metrics()
+    try:
+        if args.action == 'upload':
+            upload(args, metrics)
+        elif args.action == 'download':
+            download(args, metrics)
+        elif args.action == 'upload-batch':
+            upload_batch(args, metrics)
+    finally:
+        if metrics is not None:
+            metrics.write(args.metrics_out, args.metrics_format)
 
 
 if __name__ == '__main__':
@@ -37,4 +37,38 @@ class FileError(Exception):
 
 
 class ResponseError(Exception):
+
+    def __init__(self, message='', response=None):
+        """ Raised when a server answers with an error, or with a
+        response that cannot be used.
+
+        :param message: Error message as a string
+        :param response: The response received, if there was one
+        """
+        super(ResponseError, self).__init__(message)
+        self.response = response
+
+    @property
+    def status_code(self):
+        """ HTTP status of the response, or None if there was none """
+        return getattr(self.response, 'status_code', None)
+
+
+class IntegrityError(ResponseError):
     pass
+
+
+class TransferError(ResponseError):
+
+    def __init__(self, message, results=None, errors=None):
+        """ Raised when one or more shards of a multi-shard transfer fail.
+        Shards that did finish are not lost: they are kept in ``results``
+        in shard order, with ``None`` in place of every failed shard.
+
+        :param message: Error message as a string
+        :param results: List of per-shard results in shard order
+        :param errors: Dict mapping shard index to the exception it raised
+        """
+        super(TransferError, self).__init__(message)
+        self.results = results if results is not None else []
+        self.errors = errors if errors is not None else {}
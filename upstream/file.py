@@ -17,6 +17,9 @@
 # limitations under the License.
 
 import os
+import mmap
+import hashlib
+import threading
 
 
 class ShardFile(object):
@@ -30,7 +33,9 @@ class ShardFile(object):
     files from disk out over a network a breeze.  This class also accepts
     an option callback function, which will invoke the callback with a tuple
     of ints in the form of (current_position, reading_total). Both values are
-    in bytes.
+    in bytes.  Hashers, such as ``hashlib.sha256()`` objects, may be passed
+    to be fed every byte of the shard as it is read, so digests come for
+    free with a single pass over the data.
 
     Usage::
 
@@ -41,7 +46,8 @@ class ShardFile(object):
     """
 
     def __init__(self, filename, mode='r', buffering=-1, shard_size=262144000,
-                 start_pos=0, read_size=1024, callback=None):
+                 start_pos=0, read_size=1024, callback=None, hashers=None,
+                 limiter=None):
         """ Initializes with sane defaults similar to the builtin function
         *open*.
         :param filename: Path to file as string
@@ -56,6 +62,12 @@ class ShardFile(object):
         :param callback: The optional callback will invoke the callback with
         a tuple of ints in the form of (current_position, reading_total).
         Both values are in bytes.
+        :param hashers: Optional list of objects with an update() method,
+        such as hashlib objects, fed each byte of the shard once, in order,
+        as it is read.  Bytes read again after seeking back are not fed
+        twice.
+        :param limiter: Optional upstream.ratelimit.TokenBucket that every
+        read draws from, to cap the rate at which the file is read.
         """
         self._f_obj = open(filename, mode, buffering)
         self.shard_size = shard_size
@@ -68,6 +80,9 @@ class ShardFile(object):
         self._calc_total_read()
         if callable(callback):
             self.callback = callback
+        self.hashers = list(hashers or [])
+        self._hashed = start_pos
+        self.limiter = limiter
 
     def __iter__(self):
         return self._generate_slices()
@@ -97,16 +112,32 @@ class ShardFile(object):
         :raise IOError: If exceeding the max_seek attribute
         """
         self._callback()
+        loc = self.tell()
         if size:
-            loc = self.tell()
             if loc == self.max_seek:
                 return ''
-            elif size + loc > self.max_seek:
+            elif size < 0 or size + loc > self.max_seek:
                 size = self.max_seek - loc
-                return self._f_obj.read(size)
-            else:
-                return self._f_obj.read(size)
-        return self._f_obj.read(self.max_seek)
+        else:
+            size = self.max_seek - loc
+        return self._consumed(self._f_obj.read(size), loc)
+
+    def readinto(self, buf):
+        """ Reads into a caller-provided, writable buffer instead of
+        allocating a new bytes object.  Will not read past max_seek.
+
+        :param buf: Writable buffer, such as a bytearray
+        :return: Number of bytes read into buf; 0 at the end of the shard
+        """
+        self._callback()
+        loc = self.tell()
+        size = min(len(buf), self.max_seek - loc)
+        if size <= 0:
+            return 0
+        view = memoryview(buf)[:size]
+        read = self._f_obj.readinto(view)
+        self._consumed(view[:read], loc)
+        return read
 
     def seek(self, *args, **kwargs):
         """ Calls directly to the file object's seek method.
@@ -148,9 +179,28 @@ class ShardFile(object):
                 # The shardsize will exceed the max position, so
                 # only yield what's left
                 diff = self.max_seek - loc
-                yield self._f_obj.read(diff)
+                yield self._consumed(self._f_obj.read(diff), loc)
             else:
-                yield self._f_obj.read(self.read_size)
+                yield self._consumed(self._f_obj.read(self.read_size), loc)
+
+    def _consumed(self, data, loc):
+        """ Feeds the hashers the part of data, read from position loc,
+        that they have not seen yet, and waits on the limiter, if any,
+        for the bytes read.
+
+        :param data: Bytes, or a memoryview, just read
+        :param loc: Position in the file data was read from
+        :return: data, unchanged
+        """
+        if self.limiter is not None and len(data):
+            self.limiter.consume(len(data))
+        end = loc + len(data)
+        if self.hashers and loc <= self._hashed < end:
+            new = data[self._hashed - loc:]
+            for hasher in self.hashers:
+                hasher.update(new)
+            self._hashed = end
+        return data
 
     def _calc_max_seek(self):
         """ Calculates the maximum postion to seek.
@@ -170,18 +220,271 @@ class ShardFile(object):
         self.total_read_bytes = self.max_seek - loc
 
     def _callback(self):
-        do_callback = hasattr(self, 'callback')
-        loc = self._f_obj.tell()
-        if do_callback:
+        # This runs for every slice read, so keep it cheap: no tell() and
+        # no hasattr() when there is no callback.
+        callback = self.__dict__.get('callback')
+        if callback is not None:
+            loc = self.tell()
             if loc < self.max_seek:
-                self.callback(
+                callback(
                     (
-                        abs((self.max_seek - loc) - self.total_read_bytes),
+                        self.total_read_bytes - (self.max_seek - loc),
                         self.total_read_bytes
                     )
                 )
 
 
+class MappedShardFile(ShardFile):
+
+    """ A ShardFile backed by a read-only memory map of the file.  Iterating
+    yields ``memoryview`` slices of the map rather than freshly read bytes
+    objects, so streaming a shard neither allocates nor issues a read
+    system call per slice.  readinto() copies straight from the map into a
+    caller-provided buffer.
+
+    Slices are only valid until the MappedShardFile is closed; copy them
+    with ``bytes()`` if they must outlive it.
+
+    Usage::
+
+        with MappedShardFile('/path/to/file', shard_size=65536) as shard:
+            for view in shard:
+                sock.sendall(view)
+
+    """
+
+    def __init__(self, filename, mode='rb', buffering=-1,
+                 shard_size=262144000, start_pos=0, read_size=1024,
+                 callback=None, hashers=None, limiter=None):
+        """ Accepts the same arguments as ShardFile; mode must be a read
+        mode.
+        """
+        super(MappedShardFile, self).__init__(
+            filename, mode, buffering, shard_size=shard_size,
+            start_pos=start_pos, read_size=read_size, callback=callback,
+            hashers=hashers, limiter=limiter)
+        if self.filesize:
+            self._mmap = mmap.mmap(self._f_obj.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
+        else:
+            # Zero-length files cannot be mapped.
+            self._mmap = None
+            self._view = memoryview(b'')
+        self._pos = start_pos
+
+    def read(self, size=None):
+        """ Reads up to size bytes, not past max_seek, and returns them as
+        a bytes object.
+
+        :param size: Size in bytes to read
+        :return: Bytes read from the map
+        """
+        return self._take(size).tobytes()
+
+    def readinto(self, buf):
+        """ Copies the next bytes of the shard into a caller-provided,
+        writable buffer.
+
+        :param buf: Writable buffer, such as a bytearray
+        :return: Number of bytes copied; 0 at the end of the shard
+        """
+        view = self._take(len(buf))
+        memoryview(buf)[:len(view)] = view
+        return len(view)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """ Moves the position within the map, like a file object's seek.
+
+        :param offset: Offset in bytes
+        :param whence: One of os.SEEK_SET, os.SEEK_CUR or os.SEEK_END
+        """
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.filesize
+        self._pos = offset
+
+    def tell(self):
+        """ Returns the current position within the map
+
+        :return: Position in bytes
+        """
+        return self._pos
+
+    def close(self):
+        """ Releases the map and closes the file """
+        self._view.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Slices handed out are still alive; the map is freed
+                # once they are garbage collected.
+                pass
+        return super(MappedShardFile, self).close()
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def _take(self, size=None):
+        """ Returns a view of the next size bytes, or of the rest of the
+        shard if size is not given, and advances past them.
+        """
+        self._callback()
+        loc = self._pos
+        end = self.max_seek if size is None else min(loc + size,
+                                                     self.max_seek)
+        end = max(end, loc)
+        self._pos = end
+        return self._consumed(self._view[loc:end], loc)
+
+    def _generate_slices(self):
+        """ Yields memoryview slices of read_size bytes until max_seek """
+        while True:
+            view = self._take(self.read_size)
+            if not len(view):
+                return
+            yield view
+
+
+class PositionalWriter(object):
+
+    """ Writes to a file at absolute offsets rather than at a shared cursor,
+    so that several threads can each fill in their own region of the same
+    file at once.  Uses ``os.pwrite`` where the platform provides it and
+    falls back to a locked seek and write elsewhere.
+
+    Usage::
+
+        with PositionalWriter('/path/to/file', size=2048) as writer:
+            writer.write_at(b'second half', 1024)
+            writer.write_at(b'first half', 0)
+
+    """
+
+    def __init__(self, filename, size=None):
+        """ Opens, and creates if needed, the file to write to.
+
+        :param filename: Path to file as string
+        :param size: If given, preallocate the file to this size in bytes
+        """
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        self._fd = os.open(filename, flags, 0o644)
+        self._lock = threading.Lock()
+        if size is not None:
+            self.preallocate(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def preallocate(self, size):
+        """ Sets the size of the file, reserving disk blocks for it up
+        front where the platform supports it.
+
+        :param size: Final size of the file in bytes
+        """
+        if size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self._fd, 0, size)
+            except OSError:
+                # Not supported by every filesystem; ftruncate still
+                # gives us a file of the right size.
+                pass
+        os.ftruncate(self._fd, size)
+
+    def write_at(self, data, offset):
+        """ Writes all of data starting at offset.
+
+        :param data: Bytes to write
+        :param offset: Position in the file, in bytes, of the first byte
+        :return: Number of bytes written
+        """
+        remaining = memoryview(data)
+        while len(remaining):
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(self._fd, remaining, offset)
+            else:
+                with self._lock:
+                    os.lseek(self._fd, offset, os.SEEK_SET)
+                    written = os.write(self._fd, remaining.tobytes())
+            remaining = remaining[written:]
+            offset += written
+        return len(data)
+
+    def read_at(self, size, offset):
+        """ Reads back up to size bytes starting at offset.
+
+        :param size: Number of bytes to read
+        :param offset: Position in the file, in bytes, of the first byte
+        :return: Bytes read; fewer than size at the end of the file
+        """
+        if hasattr(os, 'pread'):
+            return os.pread(self._fd, size, offset)
+        with self._lock:
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            return os.read(self._fd, size)
+
+    def close(self):
+        """ Closes the underlying file descriptor """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def hash_range(filepath, start_pos, size, read_size=1048576, hashers=None):
+    """ Computes the SHA-256 digest of part of a file
+
+    :param filepath: Path to file as string
+    :param start_pos: Position of the first byte to hash
+    :param size: Number of bytes to hash; fewer are hashed if the file
+    ends first
+    :param read_size: Size in bytes of each block read from disk
+    :param hashers: Optional list of further hashlib objects to update
+    with the same bytes
+    :return: Tuple of (hex digest, number of bytes hashed)
+    """
+    sha256 = hashlib.sha256()
+    hashers = [sha256] + list(hashers or [])
+    with ShardFile(filepath, 'rb', shard_size=size, start_pos=start_pos,
+                   read_size=read_size) as shard:
+        hashed = shard.total_read_bytes
+        for block in shard:
+            for hasher in hashers:
+                hasher.update(block)
+    return sha256.hexdigest(), hashed
+
+
+def replace_file(src, dst):
+    """ Atomically renames src over dst, even on platforms whose rename
+    refuses to overwrite.
+
+    :param src: Path of the new file
+    :param dst: Path of the file to replace, which need not exist
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def cache_dir():
+    """ Returns the directory for files kept between runs, such as probe
+    results and upload journals: $XDG_CACHE_HOME/upstream, or
+    ~/.cache/upstream.  It is not created here.
+
+    :return: Path as string
+    """
+    root = (os.environ.get('XDG_CACHE_HOME') or
+            os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(root, 'upstream')
+
+
 class SizeHelpers(object):
 
     @staticmethod
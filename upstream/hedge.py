@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+""" Hedged requests.  In a download of many shards, the whole file waits
+for the slowest one; a shard held up by a slow node or a stalled
+connection decides the total time.  A Hedger watches the shards in flight
+and, when one falls well behind the others, requests the rest of it a
+second time.  Whichever request finishes first wins; the other is
+cancelled, and can no longer touch the file.
+"""
+
+import time
+import threading
+
+
+class Cancelled(Exception):
+    """ Raised inside a request that lost its race, the next time it
+    tries to use the file.
+    """
+    pass
+
+
+class HedgePolicy(object):
+
+    """ Decides when a shard is a straggler worth requesting again.
+
+    A shard is a straggler once it has run for at least min_elapsed
+    seconds at less than 1 / slowdown of the median rate of the other
+    shards of the download.  Each shard is hedged at most once, and no
+    more than max_hedges hedged requests run at a time, so a download
+    that is slow across the board does not double its own load.
+    """
+
+    def __init__(self, slowdown=3.0, min_elapsed=1.0, interval=0.1,
+                 max_hedges=2):
+        """
+        :param slowdown: How many times slower than the median of its peers
+        a shard must be to be hedged
+        :param min_elapsed: Seconds a shard runs before it may be hedged
+        :param interval: Seconds between two checks of a shard's progress
+        :param max_hedges: Most hedged requests in flight at once
+        """
+        self.slowdown = slowdown
+        self.min_elapsed = min_elapsed
+        self.interval = interval
+        self.max_hedges = max_hedges
+
+    def is_straggler(self, rate, elapsed, peer_rates):
+        """ :param rate: Bytes per second the shard has been received at
+        :param elapsed: Seconds since the shard was requested
+        :param peer_rates: Bytes per second of the other shards
+        :return: True if the shard should be requested again
+        """
+        if elapsed < self.min_elapsed or not peer_rates:
+            return False
+        rates = sorted(peer_rates)
+        median = rates[len(rates) // 2]
+        return rate * self.slowdown < median
+
+
+class _Race(object):
+
+    """ The requests racing for one shard """
+
+    def __init__(self, writer, start, on_progress):
+        self.writer = writer
+        self.start = start
+        self.done = start
+        self.on_progress = on_progress
+        self.started = time.time()
+        self.ended = None
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.running = 0
+        self.hedged = False
+        self.won = False
+        self.result = None
+        self.errors = []
+
+    def rate(self, now):
+        elapsed = (self.ended or now) - self.started
+        return (self.done - self.start) / elapsed if elapsed > 0 else 0.0
+
+    def progress(self, written):
+        with self.lock:
+            if written <= self.done:
+                return
+            self.done = written
+        if self.on_progress is not None:
+            self.on_progress(written)
+
+
+class _Lane(object):
+
+    """ A racing request's view of the shared PositionalWriter.  Once the
+    race is won, every other request is cut off from the file: writes and
+    reads raise Cancelled instead.
+    """
+
+    def __init__(self, race):
+        self._race = race
+
+    def write_at(self, data, offset):
+        with self._race.lock:
+            if self._race.won:
+                raise Cancelled("Overtaken by a hedged request.")
+            return self._race.writer.write_at(data, offset)
+
+    def read_at(self, size, offset):
+        with self._race.lock:
+            if self._race.won:
+                raise Cancelled("Overtaken by a hedged request.")
+            return self._race.writer.read_at(size, offset)
+
+
+class Hedger(object):
+
+    """ Runs the shard fetches of one download as races, hedging those
+    that fall behind.  Each fetch runs in a thread of its own, so the
+    caller returns as soon as a request wins, without waiting for the
+    loser, which may be stuck on a stalled connection.
+
+    Usage::
+
+        hedger = Hedger(HedgePolicy())
+        # From each worker thread:
+        size = hedger.run(idx, fetch, writer, start, on_progress)
+
+    where ``fetch(writer, start, on_progress)`` downloads the shard from
+    byte start into writer and returns its size.
+    """
+
+    def __init__(self, policy):
+        """
+        :param policy: upstream.hedge.HedgePolicy
+        """
+        self.policy = policy
+        self.hedges = 0
+        self._races = {}
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def run(self, key, fetch, writer, start=0, on_progress=None):
+        """ Fetches a shard, requesting it a second time, from the byte
+        reached so far, if it turns out to be a straggler.
+
+        :param key: Key identifying the shard within the download
+        :param fetch: Callable as described above
+        :param writer: upstream.file.PositionalWriter to write to
+        :param start: Number of bytes of the shard already written
+        :param on_progress: Optional callable invoked with the number of
+        bytes of the shard written so far
+        :return: Return value of the winning fetch
+        :raise Exception: What the first request raised, if none succeeded
+        """
+        race = _Race(writer, start, on_progress)
+        with self._lock:
+            self._races[key] = race
+        self._launch(race, fetch, start)
+        while not race.finished.wait(self.policy.interval):
+            if self._should_hedge(key, race):
+                self._launch(race, fetch, race.done)
+        with self._lock:
+            race.ended = time.time()
+            if race.hedged:
+                self._active -= 1
+        if race.won:
+            return race.result
+        raise race.errors[0]
+
+    def _should_hedge(self, key, race):
+        with self._lock:
+            if race.hedged or self._active >= self.policy.max_hedges:
+                return False
+            now = time.time()
+            peers = [other.rate(now) for other_key, other
+                     in self._races.items() if other_key != key]
+            if not self.policy.is_straggler(race.rate(now),
+                                            now - race.started, peers):
+                return False
+            race.hedged = True
+            self._active += 1
+            self.hedges += 1
+            return True
+
+    def _launch(self, race, fetch, start):
+        with race.lock:
+            race.running += 1
+        thread = threading.Thread(target=self._fetch,
+                                  args=(race, fetch, start))
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def _fetch(race, fetch, start):
+        result = error = None
+        try:
+            result = fetch(_Lane(race), start, race.progress)
+        except Cancelled:
+            pass
+        except Exception as e:
+            error = e
+        with race.lock:
+            race.running -= 1
+            if race.won:
+                return
+            if error is None and result is not None:
+                race.won = True
+                race.result = result
+                race.finished.set()
+                return
+            if error is not None:
+                race.errors.append(error)
+            if not race.running:
+                race.finished.set()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import time
+import sqlite3
+import threading
+
+
+class ShardIndex(object):
+
+    """ A local, persistent index of shards already uploaded, mapping the
+    SHA-256 digest and size of a shard's content to the URI the server
+    returned for it.  A shard found in the index does not need to be sent
+    again.  Entries are kept per server, as a URI is only valid on the
+    node that issued it.
+
+    Safe to share between threads.
+
+    Usage::
+
+        with ShardIndex('/path/to/index.db') as index:
+            uri = index.lookup(server, digest, size)
+            if uri is None:
+                ...
+                index.add(server, digest, size, shard.uri)
+
+    """
+
+    def __init__(self, path):
+        """ Opens the index, creating it if it does not exist.
+
+        :param path: Path of the SQLite database as string
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS shards ('
+                ' server TEXT NOT NULL,'
+                ' digest TEXT NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' uri TEXT NOT NULL,'
+                ' created REAL NOT NULL,'
+                ' PRIMARY KEY (server, digest, size))')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def lookup(self, server, digest, size):
+        """ Returns the URI of an already uploaded shard
+
+        :param server: URL of the server the shard was uploaded to
+        :param digest: SHA-256 hex digest of the shard's content
+        :param size: Size of the shard in bytes
+        :return: URI as string, or None if not indexed
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT uri FROM shards'
+                ' WHERE server = ? AND digest = ? AND size = ?',
+                (server, digest, size)).fetchone()
+        return row[0] if row else None
+
+    def add(self, server, digest, size, uri):
+        """ Records an uploaded shard
+
+        :param server: URL of the server the shard was uploaded to
+        :param digest: SHA-256 hex digest of the shard's content
+        :param size: Size of the shard in bytes
+        :param uri: URI returned by the server for the shard
+        """
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO shards VALUES (?, ?, ?, ?, ?)',
+                    (server, digest, size, uri, time.time()))
+
+    def remove(self, server, digest, size):
+        """ Forgets a shard, for instance one the server no longer has
+
+        :param server: URL of the server the shard was uploaded to
+        :param digest: SHA-256 hex digest of the shard's content
+        :param size: Size of the shard in bytes
+        """
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'DELETE FROM shards'
+                    ' WHERE server = ? AND digest = ? AND size = ?',
+                    (server, digest, size))
+
+    def __len__(self):
+        with self._lock:
+            row = self._db.execute('SELECT COUNT(*) FROM shards').fetchone()
+        return row[0]
+
+    def close(self):
+        """ Closes the database """
+        with self._lock:
+            self._db.close()
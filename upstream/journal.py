@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+from upstream.exc import FileError
+from upstream.file import replace_file, cache_dir
+
+
+class Journal(object):
+
+    """ Base class for the on-disk journals that let interrupted transfers
+    resume.  Subclasses provide _to_dict() and _from_dict() to convert
+    their state to and from JSON-compatible data, and may override
+    _write() and _read() to lay the file out differently.
+    """
+
+    path = None
+    description = 'journal'
+
+    @staticmethod
+    def default_path(filepath):
+        """ Returns the journal path used for filepath when none is given
+
+        :param filepath: Path of the file being transferred as string
+        :return: Path of the journal file as string
+        """
+        return filepath + '.upstream-journal'
+
+    @classmethod
+    def load(cls, path):
+        """ Reads a journal back from disk
+
+        :param path: Path of the journal file as string
+        :return: Instance of the journal class
+        :raise FileError: If the journal cannot be read or parsed
+        """
+        journal = cls.__new__(cls)
+        journal.path = path
+        try:
+            with open(path) as f:
+                journal._read(f)
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            raise FileError("%s is not a valid %s" % (path, cls.description))
+        return journal
+
+    def save(self):
+        """ Writes the journal to disk atomically, creating its directory
+        if needed
+        """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            self._write(f)
+        replace_file(tmp, self.path)
+
+    def _write(self, f):
+        json.dump(self._to_dict(), f)
+
+    def _read(self, f):
+        self._from_dict(json.load(f))
+
+    def remove(self):
+        """ Deletes the journal from disk, if it was ever written """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class UploadJournal(Journal):
+
+    """ Records the progress of a multi-shard upload on disk so that an
+    interrupted upload can pick up where it stopped.  The journal holds
+    the identity of the file being uploaded, its shard plan and the URI,
+    and digest and servers where known, of every shard uploaded so far.
+
+    The file starts with a line holding the file's identity and shard
+    plan, written once, followed by one line appended per shard as it
+    completes, so recording a shard costs the same however large the
+    plan.  A last line cut short by a crash is ignored on loading.
+
+    Usage::
+
+        journal = UploadJournal.load(path)
+        if not journal.matches(filepath):
+            raise ...
+        for idx in journal.pending():
+            ...
+            journal.record(idx, shard)
+
+    """
+
+    description = 'upload journal'
+
+    @staticmethod
+    def default_path(filepath):
+        """ Returns the journal path used for filepath when none is given:
+        a file under the user's cache directory named after a hash of the
+        file's absolute path, so that files in read-only directories can
+        be uploaded too.
+
+        :param filepath: Path of the file being uploaded as string
+        :return: Path of the journal file as string
+        """
+        key = hashlib.sha256(
+            os.path.abspath(filepath).encode('utf-8')).hexdigest()
+        return os.path.join(cache_dir(), 'journals',
+                            key[:32] + '.upstream-journal')
+
+    def __init__(self, path, filepath, shards):
+        """ Creates a new, empty journal.  Nothing is written until
+        save() or record() is called.
+
+        :param path: Path of the journal file as string
+        :param filepath: Path of the file being uploaded as string
+        :param shards: Shard plan as a list of (start, end) tuples
+        """
+        self.path = path
+        self.filepath = os.path.abspath(filepath)
+        stat = os.stat(filepath)
+        self.filesize = stat.st_size
+        self.mtime = stat.st_mtime
+        self.shards = [tuple(shard) for shard in shards]
+        self.uris = {}
+        self.digests = {}
+        self.servers = {}
+
+    def matches(self, filepath):
+        """ Checks that filepath is still the file this journal was
+        started for, and that it has not changed since.
+
+        :param filepath: Path of the file being uploaded as string
+        :return: Boolean
+        """
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return False
+        return (os.path.abspath(filepath) == self.filepath and
+                stat.st_size == self.filesize and
+                stat.st_mtime == self.mtime)
+
+    def pending(self):
+        """ Returns the indices of the shards not uploaded yet
+
+        :return: List of ints in shard order
+        """
+        return [idx for idx in range(len(self.shards))
+                if idx not in self.uris]
+
+    def record(self, idx, shard):
+        """ Marks a shard as uploaded and appends it to the journal, which
+        is saved first if it was never written
+
+        :param idx: Index of the shard in the shard plan
+        :param shard: upstream.shard.Shard returned for it
+        """
+        self.uris[idx] = shard.uri
+        if getattr(shard, 'digest', None):
+            self.digests[idx] = shard.digest
+        if getattr(shard, 'servers', None):
+            self.servers[idx] = list(shard.servers)
+        if not os.path.exists(self.path):
+            self.save()
+            return
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(self._entry(idx)) + '\n')
+
+    def _entry(self, idx):
+        entry = {'idx': idx, 'uri': self.uris[idx]}
+        if idx in self.digests:
+            entry['digest'] = self.digests[idx]
+        if idx in self.servers:
+            entry['servers'] = self.servers[idx]
+        return entry
+
+    def _write(self, f):
+        f.write(json.dumps(self._to_dict()) + '\n')
+        for idx in sorted(self.uris):
+            f.write(json.dumps(self._entry(idx)) + '\n')
+
+    def _read(self, f):
+        lines = f.read().split('\n')
+        self._from_dict(json.loads(lines[0]))
+        for number, line in enumerate(lines[1:], 2):
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                if number == len(lines):
+                    # Cut short by a crash while appending.
+                    break
+                raise
+            idx = int(entry['idx'])
+            self.uris[idx] = entry['uri']
+            if entry.get('digest'):
+                self.digests[idx] = entry['digest']
+            if entry.get('servers'):
+                self.servers[idx] = list(entry['servers'])
+
+    def _to_dict(self):
+        return {
+            'filepath': self.filepath,
+            'filesize': self.filesize,
+            'mtime': self.mtime,
+            'shards': self.shards,
+        }
+
+    def _from_dict(self, data):
+        self.filepath = data['filepath']
+        self.filesize = data['filesize']
+        self.mtime = data['mtime']
+        self.shards = [tuple(shard) for shard in data['shards']]
+        # Journals written before shards were appended hold them here.
+        self.uris = dict((int(idx), uri)
+                         for idx, uri in data.get('uris', {}).items())
+        self.digests = dict((int(idx), digest)
+                            for idx, digest in data.get('digests', {}).items())
+        self.servers = dict((int(idx), list(servers)) for idx, servers
+                            in data.get('servers', {}).items())
+
+
+class DownloadJournal(Journal):
+
+    """ Records the progress of a multi-shard download on disk: the URIs
+    being fetched, the size of each shard once known and the number of
+    bytes of each shard already written to the destination file.  Progress
+    may be reported from several threads at once; it is saved at most
+    once per save_interval seconds, and always when a shard completes.
+    """
+
+    description = 'download journal'
+
+    def __init__(self, path, uris, save_interval=1.0):
+        """ Creates a new, empty journal.  Nothing is written until
+        save() or finish() is called.
+
+        :param path: Path of the journal file as string
+        :param uris: List of shard URIs being downloaded, in file order
+        :param save_interval: Minimum seconds between two saves triggered
+        by update()
+        """
+        self.path = path
+        self.uris = list(uris)
+        self.sizes = [None] * len(self.uris)
+        self.written = [0] * len(self.uris)
+        self.save_interval = save_interval
+        self._init_lock()
+
+    def _init_lock(self):
+        self._lock = threading.Lock()
+        self._last_save = 0
+
+    def matches(self, uris):
+        """ Checks that this journal was started for the same download
+
+        :param uris: List of shard URIs being downloaded, in file order
+        :return: Boolean
+        """
+        return self.uris == list(uris)
+
+    def update(self, idx, written):
+        """ Records how many bytes of a shard are on disk, saving the
+        journal if it has not been saved recently.
+
+        :param idx: Index of the shard
+        :param written: Number of bytes of the shard written so far
+        """
+        with self._lock:
+            self.written[idx] = written
+            if time.time() - self._last_save >= self.save_interval:
+                self._save()
+
+    def finish(self, idx, size):
+        """ Marks a shard as completely downloaded and saves the journal
+
+        :param idx: Index of the shard
+        :param size: Size of the shard in bytes
+        """
+        with self._lock:
+            self.written[idx] = size
+            self.sizes[idx] = size
+            self._save()
+
+    def save(self):
+        """ Writes the journal to disk atomically """
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        super(DownloadJournal, self).save()
+        self._last_save = time.time()
+
+    def _to_dict(self):
+        return {
+            'uris': self.uris,
+            'sizes': self.sizes,
+            'written': self.written,
+        }
+
+    def _from_dict(self, data):
+        self.uris = list(data['uris'])
+        self.sizes = list(data['sizes'])
+        self.written = [int(n) for n in data['written']]
+        if not len(self.uris) == len(self.sizes) == len(self.written):
+            raise ValueError("Journal lists differ in length")
+        self.save_interval = 1.0
+        self._init_lock()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+""" Manifests describe how a file was split into shards: the URI of each
+shard, in order, with its offset and size in the file and the SHA-256
+digest of its data.  They replace passing every URI on the command line,
+which stops working for files with many thousands of shards.
+
+A manifest is a text file with a header line followed by one line per
+shard::
+
+    upstream-manifest 2
+    0 26214400 9f86d08...a08 05034bf...c1c?key=ae01ece...9e9
+    26214400 1048576 - 4caea2b...b94?key=ff8781f...869 http://a,http://b
+
+Each shard line holds the offset, the size, the digest, or ``-`` if it
+is not known, and the URI, separated by single spaces, then optionally
+the comma-separated URLs of the servers holding the shard.  Version 1
+manifests, which predate the server list, are read too.  Manifests are
+written and read a line at a time, so neither side ever holds the whole
+shard list in memory.
+"""
+
+import os
+from collections import namedtuple
+
+from upstream.exc import FileError
+
+
+MAGIC = 'upstream-manifest'
+VERSION = 2
+
+#: Versions read_manifest understands
+SUPPORTED_VERSIONS = (1, 2)
+
+
+class ManifestEntry(namedtuple('ManifestEntry',
+                               ['offset', 'size', 'digest', 'uri',
+                                'servers'])):
+
+    """ One shard of a manifest.  digest and servers are None when they
+    are not known.
+    """
+
+    __slots__ = ()
+
+
+ManifestEntry.__new__.__defaults__ = (None,)
+
+
+class ManifestWriter(object):
+
+    """ Writes a manifest one shard at a time.  Shards must be added in
+    file order.  The manifest only appears at its path once closed, so a
+    half-written manifest is never mistaken for a complete one.
+
+    Usage::
+
+        with ManifestWriter('/path/to/file.manifest') as manifest:
+            for (start, end), shard in zip(plan, shards):
+                manifest.add(start, end - start, shard.uri, shard.digest)
+
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the manifest file as string
+        """
+        self.path = path
+        self._tmp = path + '.tmp'
+        self._f = open(self._tmp, 'w')
+        self._f.write('%s %d\n' % (MAGIC, VERSION))
+        self._next = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        if type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add(self, offset, size, uri, digest=None, servers=None):
+        """ Appends a shard to the manifest
+
+        :param offset: Position of the shard in the file in bytes
+        :param size: Size of the shard in bytes
+        :param uri: URI of the shard as string
+        :param digest: SHA-256 hex digest of the shard's data, if known
+        :param servers: List of URLs of the servers holding the shard, if
+        known
+        :raise ValueError: If the shard does not start where the previous
+        one ended
+        """
+        if offset != self._next:
+            raise ValueError("Shard at offset %d does not follow the "
+                             "previous one, which ended at %d"
+                             % (offset, self._next))
+        line = '%d %d %s %s' % (offset, size, digest or '-', uri)
+        if servers:
+            line += ' ' + ','.join(servers)
+        self._f.write(line + '\n')
+        self._next = offset + size
+
+    def close(self):
+        """ Finishes the manifest and moves it into place """
+        self._f.close()
+        os.rename(self._tmp, self.path)
+
+    def abort(self):
+        """ Discards the manifest written so far """
+        self._f.close()
+        os.remove(self._tmp)
+
+
+def write_manifest(path, entries):
+    """ Writes a complete manifest
+
+    :param path: Path of the manifest file as string
+    :param entries: Iterable of ManifestEntry, or of (offset, size, digest,
+    uri[, servers]) tuples, in file order
+    """
+    with ManifestWriter(path) as manifest:
+        for entry in entries:
+            entry = ManifestEntry(*entry)
+            manifest.add(entry.offset, entry.size, entry.uri, entry.digest,
+                         entry.servers)
+
+
+def read_manifest(path):
+    """ Reads a manifest lazily, one shard at a time
+
+    :param path: Path of the manifest file as string
+    :return: Generator of ManifestEntry, in file order
+    :raise FileError: If the file is not a manifest or a line is malformed
+    """
+    try:
+        f = open(path)
+    except (IOError, OSError):
+        raise FileError('%s could not be opened' % path)
+    with f:
+        header = f.readline().split()
+        if len(header) != 2 or header[0] != MAGIC:
+            raise FileError('%s is not an upstream manifest' % path)
+        try:
+            version = int(header[1])
+        except ValueError:
+            version = None
+        if version not in SUPPORTED_VERSIONS:
+            raise FileError('%s is a version %s manifest; only versions %s '
+                            'are supported' % (path, header[1], ', '.join(
+                                str(v) for v in SUPPORTED_VERSIONS)))
+        expected = 0
+        for lineno, line in enumerate(f, 2):
+            fields = line.split()
+            if not fields:
+                continue
+            servers = None
+            if version > 1 and len(fields) == 5:
+                servers = fields.pop().split(',')
+            try:
+                offset, size, digest, uri = fields
+                offset, size = int(offset), int(size)
+            except ValueError:
+                raise FileError('%s:%d: expected "<offset> <size> <digest> '
+                                '<uri> [<servers>]"' % (path, lineno))
+            if offset != expected:
+                raise FileError('%s:%d: expected a shard at offset %d'
+                                % (path, lineno, expected))
+            expected = offset + size
+            yield ManifestEntry(offset, size,
+                                None if digest == '-' else digest, uri,
+                                servers)
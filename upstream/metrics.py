@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+""" Per-shard transfer metrics.  A Metrics object handed to a Streamer
+receives a ShardMetrics record for every attempt at uploading or
+downloading a shard, with its timings and byte count, keeps latency
+histograms per server, and passes each record on to any hooks registered
+with it.  It can be saved as JSON or in the Prometheus text format, e.g.
+for node_exporter's textfile collector.
+"""
+
+import json
+import time
+import threading
+
+from requests.packages.urllib3.connection import (HTTPConnection,
+                                                  HTTPSConnection)
+from requests.packages.urllib3.connectionpool import (HTTPConnectionPool,
+                                                      HTTPSConnectionPool)
+
+from upstream.file import replace_file
+
+
+#: Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0, float('inf'))
+
+_timing = threading.local()
+
+
+def reset_connect_time():
+    """ Starts timing connections made by the current thread afresh """
+    _timing.connect = 0.0
+
+
+def connect_time():
+    """ Returns the seconds the current thread has spent opening
+    connections, TLS handshakes included, since reset_connect_time()
+
+    :return: Seconds as float; 0 if pooled connections were reused
+    """
+    return getattr(_timing, 'connect', 0.0)
+
+
+def add_connect_time(seconds):
+    """ Adds time spent opening a connection by the current thread, for
+    connections not made through an instrumented adapter.
+
+    :param seconds: Time spent as float
+    """
+    _timing.connect = connect_time() + seconds
+
+
+class TimedHTTPConnection(HTTPConnection):
+
+    def connect(self):
+        start = time.time()
+        try:
+            return super(TimedHTTPConnection, self).connect()
+        finally:
+            add_connect_time(time.time() - start)
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+
+    def connect(self):
+        start = time.time()
+        try:
+            return super(TimedHTTPSConnection, self).connect()
+        finally:
+            add_connect_time(time.time() - start)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+def instrument_adapter(adapter):
+    """ Makes the connections of a requests HTTPAdapter report the time
+    they take to open through connect_time().
+
+    :param adapter: requests.adapters.HTTPAdapter
+    """
+    adapter.poolmanager.pool_classes_by_scheme = {
+        'http': TimedHTTPConnectionPool,
+        'https': TimedHTTPSConnectionPool,
+    }
+
+
+class ShardMetrics(object):
+
+    """ Measurements of one attempt at a shard transfer.  Times are in
+    seconds; those that could not be measured are None.
+    """
+
+    __slots__ = ('op', 'server', 'shard', 'bytes', 'connect', 'ttfb',
+                 'duration', 'retries', 'error', 'final', 'time')
+
+    def __init__(self, op, server, shard=None, bytes=0, connect=None,
+                 ttfb=None, duration=None, retries=0, error=None,
+                 final=True):
+        """
+        :param op: 'upload' or 'download'
+        :param server: URL of the node the shard was sent to or read from
+        :param shard: Filehash of the shard, if known
+        :param bytes: Bytes of shard data transferred
+        :param connect: Time spent opening connections; 0 if a pooled
+        connection was reused
+        :param ttfb: Time from sending the request to receiving the
+        response headers; for uploads this includes sending the body
+        :param duration: Time the whole transfer took
+        :param retries: Number of attempts made before the last one
+        :param error: Description of the error the transfer failed with
+        :param final: False for an attempt that failed and is made again
+        """
+        self.op = op
+        self.server = server
+        self.shard = shard
+        self.bytes = bytes
+        self.connect = connect
+        self.ttfb = ttfb
+        self.duration = duration
+        self.retries = retries
+        self.error = error
+        self.final = final
+        self.time = time.time()
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class Histogram(object):
+
+    """ A cumulative histogram in the style of Prometheus """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """ Adds a value to every bucket whose bound it does not exceed """
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        return {
+            'buckets': [['+Inf' if bound == float('inf') else bound, count]
+                        for bound, count in zip(self.buckets, self.counts)],
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class Metrics(object):
+
+    """ Collects the ShardMetrics of transfers, possibly from several
+    threads at once, and aggregates them per server and operation.
+
+    Usage::
+
+        metrics = Metrics()
+        metrics.add_hook(lambda record: log.info(record.to_dict()))
+        streamer = Streamer(server, metrics=metrics)
+        ...
+        metrics.write('/var/lib/node_exporter/upstream.prom', 'prometheus')
+
+    """
+
+    #: Timings kept as histograms, by ShardMetrics attribute
+    TIMINGS = ('connect', 'ttfb', 'duration')
+
+    def __init__(self, buckets=BUCKETS, keep_records=True):
+        """
+        :param buckets: Upper bounds of the histogram buckets in seconds
+        :param keep_records: Whether to keep every ShardMetrics, or only
+        the aggregates, e.g. for long-running processes
+        """
+        self.buckets = buckets
+        self.keep_records = keep_records
+        self.records = []
+        self.servers = {}
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """ Registers a callable invoked with each ShardMetrics as it is
+        recorded, from the thread that made the transfer.
+
+        :param hook: Callable taking a ShardMetrics
+        """
+        self._hooks.append(hook)
+
+    def record(self, metrics):
+        """ Adds the measurements of one attempt at a shard transfer.  The
+        shard and its outcome are counted on its final attempt; each
+        attempt before that counts as one retry.
+
+        :param metrics: ShardMetrics
+        """
+        with self._lock:
+            if self.keep_records:
+                self.records.append(metrics)
+            stats = self._stats(metrics.server, metrics.op)
+            stats['bytes'] += metrics.bytes
+            if not metrics.final:
+                stats['retries'] += 1
+            else:
+                stats['shards'] += 1
+                if metrics.error is not None:
+                    stats['errors'] += 1
+            for name in self.TIMINGS:
+                value = getattr(metrics, name)
+                if value is not None:
+                    stats[name].observe(value)
+        for hook in self._hooks:
+            hook(metrics)
+
+    def _stats(self, server, op):
+        ops = self.servers.setdefault(server, {})
+        if op not in ops:
+            ops[op] = {'shards': 0, 'bytes': 0, 'retries': 0, 'errors': 0}
+            for name in self.TIMINGS:
+                ops[op][name] = Histogram(self.buckets)
+        return ops[op]
+
+    def to_dict(self):
+        """ Returns the records and aggregates as JSON-compatible data """
+        with self._lock:
+            servers = {}
+            for server, ops in self.servers.items():
+                servers[server] = {}
+                for op, stats in ops.items():
+                    servers[server][op] = dict(
+                        (name, value.to_dict()
+                         if isinstance(value, Histogram) else value)
+                        for name, value in stats.items())
+            return {
+                'shards': [record.to_dict() for record in self.records],
+                'servers': servers,
+            }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """ Returns the aggregates in the Prometheus text format """
+        lines = []
+        with self._lock:
+            for name, kind, helptext in (
+                    ('shards', 'counter', 'Shards transferred'),
+                    ('bytes', 'counter', 'Bytes of shard data transferred'),
+                    ('retries', 'counter', 'Shard transfer retries'),
+                    ('errors', 'counter', 'Failed shard transfers')):
+                metric = 'upstream_%s_total' % name
+                lines.append('# HELP %s %s' % (metric, helptext))
+                lines.append('# TYPE %s %s' % (metric, kind))
+                for server, op, stats in self._series():
+                    lines.append('%s{%s} %d' % (
+                        metric, _labels(server, op), stats[name]))
+            for name, helptext in (
+                    ('connect', 'Time spent opening connections per shard'),
+                    ('ttfb', 'Time to response headers per shard'),
+                    ('duration', 'Duration of each shard transfer')):
+                metric = 'upstream_shard_%s_seconds' % name
+                lines.append('# HELP %s %s' % (metric, helptext))
+                lines.append('# TYPE %s histogram' % metric)
+                for server, op, stats in self._series():
+                    histogram = stats[name]
+                    labels = _labels(server, op)
+                    for bound, count in zip(histogram.buckets,
+                                            histogram.counts):
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append('%s_bucket{%s,le="%s"} %d'
+                                     % (metric, labels, le, count))
+                    lines.append('%s_sum{%s} %r'
+                                 % (metric, labels, histogram.sum))
+                    lines.append('%s_count{%s} %d'
+                                 % (metric, labels, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def _series(self):
+        for server in sorted(self.servers):
+            for op in sorted(self.servers[server]):
+                yield server, op, self.servers[server][op]
+
+    def write(self, path, format='json'):
+        """ Saves the metrics to a file atomically, so that a collector
+        never reads a partial file.
+
+        :param path: Path of the file as string
+        :param format: 'json' or 'prometheus'
+        :raise ValueError: On an unknown format
+        """
+        if format == 'json':
+            text = self.to_json()
+        elif format == 'prometheus':
+            text = self.to_prometheus()
+        else:
+            raise ValueError("Unknown metrics format %r" % format)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        replace_file(tmp, path)
+
+
+def _labels(server, op):
+    server = server.replace('\\', '\\\\').replace('"', '\\"')
+    return 'server="%s",op="%s"' % (server, op)
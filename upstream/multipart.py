@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import uuid
+
+
+class MultipartBody(object):
+
+    """ A multipart/form-data request body holding a single file field, as
+    expected by the web-core ``/api/upload`` endpoint.  Unlike a general
+    purpose encoder it knows its exact length up front and streams the
+    file part straight from a ShardFile in large buffers.
+
+    Iterating yields the part headers, then the file data, then the
+    closing boundary.  Since it has a length, requests sends it with a
+    Content-Length header rather than chunked.
+
+    Usage::
+
+        with ShardFile('/path/to/file', 'rb') as shard:
+            body = MultipartBody(shard)
+            requests.post(url, data=body,
+                          headers={'Content-Type': body.content_type})
+
+    """
+
+    def __init__(self, shard, field='file', filename='file', boundary=None,
+                 buffer_size=262144):
+        """
+        :param shard: upstream.file.ShardFile positioned at the start of
+        the data to send
+        :param field: Name of the form field
+        :param filename: File name sent for the field
+        :param boundary: Multipart boundary; a random one if not given
+        :param buffer_size: Size in bytes of each block read from shard
+        """
+        self.shard = shard
+        self.boundary = boundary or uuid.uuid4().hex
+        self.buffer_size = buffer_size
+        self.preamble = (
+            '--%s\r\n'
+            'Content-Disposition: form-data; name="%s"; filename="%s"\r\n'
+            '\r\n' % (self.boundary, field, filename)
+        ).encode('utf-8')
+        self.epilogue = ('\r\n--%s--\r\n' % self.boundary).encode('utf-8')
+        self.data_size = len(shard)
+
+    @property
+    def content_type(self):
+        """ Value of the Content-Type header for this body """
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __len__(self):
+        return len(self.preamble) + self.data_size + len(self.epilogue)
+
+    def __iter__(self):
+        yield self.preamble
+        self.shard.read_size = self.buffer_size
+        for block in self.shard:
+            yield block
+        yield self.epilogue
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+""" Remembering which servers are up.  Probing a server costs a round trip
+before any work starts; a ProbeCache keeps the outcome for a while, in
+memory and optionally in a small JSON file, so that a script running
+upstream many times in a row only probes once in a while.
+"""
+
+import os
+import json
+import time
+import threading
+
+from upstream.file import replace_file, cache_dir
+
+
+def default_path():
+    """ Returns the path of the probe cache shared by command line runs:
+    probes.json under $XDG_CACHE_HOME/upstream, or ~/.cache/upstream.
+
+    :return: Path as string
+    """
+    return os.path.join(cache_dir(), 'probes.json')
+
+
+class ProbeCache(object):
+
+    """ Whether each server was last found reachable, and when.  Results
+    older than ttl seconds are forgotten.  Safe to share between threads
+    and between Streamers.
+
+    Given a path, results are read from it on creation and written back
+    whenever one changes, or is about to expire, merged with what other
+    processes wrote there meanwhile.  The file is only a hint: if it
+    cannot be read or written, the cache carries on in memory.
+    """
+
+    def __init__(self, path=None, ttl=300.0):
+        """
+        :param path: Optional path of a JSON file to share results through
+        :param ttl: Seconds a result is trusted for
+        """
+        self.path = path
+        self.ttl = ttl
+        self._results = {}
+        self._lock = threading.Lock()
+        if path is not None:
+            self._results = self._load()
+
+    def get(self, server):
+        """ :param server: URL of the server
+        :return: True if the server was recently reachable, False if it
+        was recently unreachable, None if there is no recent result
+        """
+        with self._lock:
+            result = self._results.get(server)
+        if result is None or time.time() - result[0] > self.ttl:
+            return None
+        return result[1]
+
+    def put(self, server, reachable):
+        """ Records the outcome of a probe, or of any request that shows
+        whether the server can be reached.
+
+        :param server: URL of the server
+        :param reachable: Boolean
+        """
+        now = time.time()
+        with self._lock:
+            last = self._results.get(server)
+            self._results[server] = (now, bool(reachable))
+            # Skip the write while the file already says the same thing.
+            stale = (last is None or last[1] != bool(reachable) or
+                     now - last[0] > self.ttl / 2.0)
+        if self.path is not None and stale:
+            self._save()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            return dict((server, (float(checked), bool(reachable)))
+                        for server, (checked, reachable) in data.items())
+        except (IOError, OSError, ValueError, TypeError, AttributeError):
+            return {}
+
+    def _save(self):
+        with self._lock:
+            results = self._load()
+            for server, result in self._results.items():
+                if server not in results or results[server][0] < result[0]:
+                    results[server] = result
+            self._results = results
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(tmp, 'w') as f:
+                json.dump(dict((server, list(result))
+                               for server, result in results.items()), f)
+            replace_file(tmp, self.path)
+        except (IOError, OSError):
+            pass
+
+
+#: Results shared by every Streamer of this process that is not given a
+#: cache of its own
+SHARED_CACHE = ProbeCache(ttl=60.0)
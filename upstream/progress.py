@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import time
+import threading
+
+
+class Progress(object):
+
+    """ Tracks how many bytes of a transfer are done, summed over the
+    shards it is made of, which may be moving concurrently.  Each shard
+    reports its own running total; the listener is told about the
+    transfer as a whole, at most ``rate`` times per second however often
+    shards report, so that redrawing a progress bar costs next to nothing.
+
+    Usage::
+
+        progress = Progress(total, listener=bar.update)
+        streamer.upload(..., callback=progress.shard_callback(0))
+        progress.finish()
+
+    """
+
+    def __init__(self, total=None, listener=None, rate=10, done=None):
+        """
+        :param total: Total size of the transfer in bytes, if known
+        :param listener: Callable invoked as ``listener(done, total)``
+        :param rate: Maximum number of listener calls per second
+        :param done: Optional list of bytes of each shard already done,
+        e.g. when resuming, indexed by shard
+        """
+        self.total = total
+        self.listener = listener
+        self.interval = 1.0 / rate
+        self._shards = dict(enumerate(done or []))
+        self.done = sum(self._shards.values())
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def update(self, key, done):
+        """ Records the number of bytes of a shard done so far.  Safe to
+        call from several threads.
+
+        :param key: Shard the count is for, e.g. its index
+        :param done: Bytes of the shard done so far
+        """
+        with self._lock:
+            self.done += done - self._shards.get(key, 0)
+            self._shards[key] = done
+            now = time.time()
+            if now < self._next:
+                return
+            self._next = now + self.interval
+            self._notify()
+
+    def shard_callback(self, key):
+        """ Returns a callback in the form ShardFile expects, taking a
+        ``(done, total)`` tuple, that reports to this Progress.
+
+        :param key: Shard the callback reports for
+        :return: Callable
+        """
+        def _callback(values):
+            self.update(key, values[0])
+        return _callback
+
+    def finish(self):
+        """ Tells the listener about the final count, however recently it
+        was last told.
+        """
+        with self._lock:
+            self._notify()
+
+    def _notify(self):
+        if self.listener is not None:
+            self.listener(self.done, self.total)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import time
+import threading
+
+
+#: Monotonic where available, so that clock changes do not stall transfers
+clock = getattr(time, 'monotonic', time.time)
+
+
+class TokenBucket(object):
+
+    """ A thread-safe token bucket limiting the rate at which bytes are
+    transferred.  Every transfer sharing a bucket draws from the same
+    budget, so the total rate of all of them stays under the limit however
+    many run at once.
+
+    The bucket fills at ``rate`` tokens per second, up to ``burst``.  A
+    caller taking more tokens than are available takes them anyway and
+    waits until the bucket would have refilled: the debt makes the next
+    callers wait their turn after it.
+
+    Usage::
+
+        bucket = TokenBucket(1048576)    # 1 MiB/s
+        for block in blocks:
+            bucket.consume(len(block))
+            send(block)
+
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: Sustained rate in bytes per second
+        :param burst: Most bytes that may pass at once after an idle
+        period; one second's worth by default
+        :raise ValueError: If rate or burst is not positive
+        """
+        if burst is None:
+            burst = rate
+        if rate <= 0 or burst <= 0:
+            raise ValueError("Expected a positive rate and burst")
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """ Takes amount tokens without waiting.
+
+        :param amount: Number of bytes about to be transferred
+        :return: Seconds the caller must wait before transferring them
+        """
+        with self._lock:
+            now = clock()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def consume(self, amount):
+        """ Takes amount tokens, sleeping until they are available.
+
+        :param amount: Number of bytes about to be, or just, transferred
+        :return: amount
+        """
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+        return amount
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import time
+import random
+import socket
+
+import requests
+from six.moves import builtins
+from six.moves import http_client
+
+from upstream.exc import ResponseError
+
+
+#: Exceptions raised when a connection fails, stalls or is cut short.  The
+#: builtin ConnectionError, which covers resets and broken pipes on raw
+#: sockets, only exists on Python 3; socket.error stands in on Python 2.
+CONNECTION_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    socket.timeout,
+    http_client.HTTPException,
+    getattr(builtins, 'ConnectionError', socket.error),
+)
+
+
+class RetryPolicy(object):
+
+    """ Decides whether a failed shard transfer is tried again, and how long
+    to wait first.  Errors are retryable if the server answered with one of
+    ``statuses``, which signal an overloaded or briefly unavailable server,
+    or if the connection failed or timed out; anything else, such as a 404
+    or a full disk, fails at once.
+
+    Waits grow exponentially with each retry, capped at max_backoff, and are
+    drawn at random below that bound ("full jitter"), so that many transfers
+    failing together do not all come back at the same moment.
+
+    Usage::
+
+        policy = RetryPolicy(attempts=5)
+        retries = 0
+        while True:
+            try:
+                return transfer()
+            except Exception as e:
+                if not policy.should_retry(e, retries):
+                    raise
+                policy.wait(e, retries)
+                retries += 1
+
+    """
+
+    #: HTTP statuses worth retrying: timeouts, rate limits and 5xx errors
+    #: that do not mean the request itself was wrong
+    STATUSES = frozenset([408, 429, 500, 502, 503, 504])
+
+    def __init__(self, attempts=5, backoff=0.5, max_backoff=30.0,
+                 statuses=STATUSES):
+        """
+        :param attempts: Most times a transfer is tried, including the
+        first; 1 disables retries
+        :param backoff: Upper bound in seconds of the wait before the first
+        retry; doubled for each retry after it
+        :param max_backoff: Longest wait in seconds before any retry
+        :param statuses: HTTP status codes that are retryable
+        :raise ValueError: If attempts is below 1
+        """
+        if attempts < 1:
+            raise ValueError("Expected at least 1 attempt")
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = frozenset(statuses)
+
+    def retryable(self, error):
+        """ Classifies an exception as transient or fatal.
+
+        :param error: Exception a transfer failed with
+        :return: True if trying again may succeed
+        """
+        if isinstance(error, ResponseError):
+            return error.status_code in self.statuses
+        return isinstance(error, CONNECTION_ERRORS)
+
+    def should_retry(self, error, retries):
+        """ :param error: Exception the latest attempt failed with
+        :param retries: Number of retries made so far
+        :return: True if the transfer should be tried again
+        """
+        return retries + 1 < self.attempts and self.retryable(error)
+
+    def delay(self, error, retries):
+        """ Picks the wait before the next retry.  A Retry-After header,
+        in seconds, raises the wait to what the server asked for, within
+        max_backoff.
+
+        :param error: Exception the latest attempt failed with
+        :param retries: Number of retries made so far
+        :return: Seconds to wait
+        """
+        bound = min(self.max_backoff, self.backoff * 2 ** retries)
+        delay = random.uniform(0, bound)
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None) or {}
+        try:
+            after = float(headers.get('Retry-After', 0))
+        except ValueError:
+            # An HTTP date; not worth parsing for a bounded wait.
+            after = 0
+        return max(delay, min(after, self.max_backoff))
+
+    def wait(self, error, retries):
+        """ Sleeps for delay(error, retries) seconds """
+        time.sleep(self.delay(error, retries))
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import threading
+
+
+class NodeStats(object):
+
+    """ What a NodeScheduler knows about one server """
+
+    __slots__ = ('server', 'active', 'assigned', 'throughput', 'failures')
+
+    def __init__(self, server):
+        self.server = server
+        #: Transfers currently running against the server
+        self.active = 0
+        #: Transfers ever given to the server
+        self.assigned = 0
+        #: Moving average of the bytes per second of each transfer, or
+        #: None before the first one finishes
+        self.throughput = None
+        #: Consecutive failed transfers
+        self.failures = 0
+
+
+class NodeScheduler(object):
+
+    """ Spreads shard transfers over a pool of servers, sending each to the
+    node expected to finish it soonest.  A node's expected wait grows with
+    the transfers already queued on it and shrinks with the throughput its
+    recent transfers achieved; nodes that keep failing are tried last.
+    Nodes not measured yet are assumed to be as fast as the best one, so
+    that every node gets tried.
+
+    A scheduler is shared by all the threads of a Streamer.  Every
+    acquire() must be followed by a release() once the transfer ends.
+
+    Usage::
+
+        scheduler = NodeScheduler(['http://a.example', 'http://b.example'])
+        server = scheduler.acquire()
+        try:
+            transfer(server)
+        finally:
+            scheduler.release(server, size, seconds)
+
+    """
+
+    def __init__(self, servers, smoothing=0.3):
+        """
+        :param servers: List of server URLs in the pool
+        :param smoothing: Weight of the latest transfer in each node's
+        throughput average, between 0 and 1
+        """
+        self.servers = list(servers)
+        self.smoothing = smoothing
+        self._nodes = dict((server, NodeStats(server))
+                           for server in self.servers)
+        self._lock = threading.Lock()
+
+    def stats(self, server):
+        """ Returns the NodeStats of a server, tracking it from now on if
+        it is not in the pool
+
+        :param server: Server URL as string
+        :return: upstream.scheduler.NodeStats
+        """
+        with self._lock:
+            return self._node(server)
+
+    def acquire(self, candidates=None, exclude=()):
+        """ Picks the node to run a transfer on and counts the transfer as
+        queued on it.
+
+        :param candidates: Servers that may be picked, such as the nodes
+        holding a shard; the whole pool if None
+        :param exclude: Servers not to pick, such as nodes that already
+        failed this transfer
+        :return: Server URL as string, or None if no candidate is left
+        """
+        candidates = self.servers if candidates is None else candidates
+        with self._lock:
+            nodes = [self._node(server) for server in candidates
+                     if server not in exclude]
+            if not nodes:
+                return None
+            known = [node.throughput for node in nodes if node.throughput]
+            best = max(known) if known else 1.0
+            node = min(nodes, key=lambda node: (
+                self._wait(node, best), node.assigned))
+            node.active += 1
+            node.assigned += 1
+            return node.server
+
+    def release(self, server, size=0, seconds=0, failed=False):
+        """ Records the end of a transfer started with acquire()
+
+        :param server: Server URL returned by acquire()
+        :param size: Bytes transferred
+        :param seconds: Time the transfer took
+        :param failed: Whether the transfer failed
+        """
+        with self._lock:
+            node = self._node(server)
+            node.active = max(0, node.active - 1)
+            if failed:
+                node.failures += 1
+                return
+            node.failures = 0
+            if size and seconds > 0:
+                rate = size / float(seconds)
+                if node.throughput is None:
+                    node.throughput = rate
+                else:
+                    node.throughput += self.smoothing * (rate -
+                                                         node.throughput)
+
+    def _node(self, server):
+        node = self._nodes.get(server)
+        if node is None:
+            node = self._nodes[server] = NodeStats(server)
+        return node
+
+    @staticmethod
+    def _wait(node, best):
+        """ Relative time a new transfer would take on node: everything
+        queued on it, plus the new transfer, at its throughput, halved for
+        every consecutive failure.
+        """
+        throughput = (node.throughput or best) / 2 ** min(node.failures, 16)
+        return (node.active + 1) / throughput
@@ -30,7 +30,7 @@ from upstream.exc import ShardError
 class Shard(object):
 
     def __init__(self, filehash=None, decryptkey=None, filename=None,
-                 filepath=None):
+                 filepath=None, digest=None, servers=None):
         """ Stores information about an encryted shard. Allows for
         format conversions.
 
@@ -38,11 +38,15 @@ class Shard(object):
         :param decryptkey: The decryption key for a file.
         :param filename: Name of the file(destroyed on encryption).
         :param filepath:  Location of the file.
+        :param digest: SHA-256 hex digest of the shard's data, if known.
+        :param servers: URLs of the servers holding the shard, if known.
         """
         self.filehash = filehash
         self.decryptkey = decryptkey
         self.filename = filename
         self.filepath = filepath
+        self.digest = digest
+        self.servers = list(servers or [])
 
     def from_uri(self, uri):
         """ Loads object data with information from a URI string in the format
@@ -24,83 +24,605 @@
 # SOFTWARE.
 
 import os
+import time
+import errno
+import select
+import socket
+import hashlib
+import threading
 
-from requests_toolbelt import MultipartEncoder
-from six.moves.urllib.request import urlopen
-from six.moves.urllib.error import URLError
+from six.moves.http_client import HTTPResponse
+from six.moves.urllib.parse import urlsplit
 
 
+import six
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 
 from upstream.shard import Shard
-from upstream.file import ShardFile, SizeHelpers
-from upstream.exc import FileError, ResponseError, ConnectError, ShardError
+from upstream.file import (ShardFile, MappedShardFile, SizeHelpers,
+                           PositionalWriter, hash_range)
+from upstream.multipart import MultipartBody
+from upstream.workers import run_jobs
+from upstream.scheduler import NodeScheduler
+from upstream.retry import CONNECTION_ERRORS
+from upstream.hedge import Hedger, Cancelled
+from upstream.probe import SHARED_CACHE
+from upstream.metrics import (ShardMetrics, instrument_adapter,
+                              reset_connect_time, connect_time,
+                              add_connect_time)
+from upstream.exc import (FileError, ResponseError, ConnectError, ShardError,
+                          IntegrityError, TransferError)
+
+
+def shard_from_upload(r):
+    """ Checks the response to an upload and returns the Shard it holds.
+
+    :param r: Response with status_code, reason and text attributes
+    :return: upstream.shard.Shard
+    :raise ResponseError: If the upload was not accepted
+    """
+    # Make sure that the API call is actually there
+    if r.status_code == 404:
+        raise ResponseError("API call not found.", r)
+    elif r.status_code == 402:
+        raise ResponseError("Payment required.", r)
+    elif r.status_code == 500:
+        raise ResponseError("Server error.", r)
+    elif r.status_code == 201:
+        shard = Shard()
+        shard.from_json(r.text)
+        return shard
+    else:
+        raise ResponseError("Received status code %s %s"
+                            % (r.status_code, r.reason), r)
+
+
+def shard_hasher(shard, writer=None, offset=0, written=0):
+    """ Starts the running digest used to verify a shard as it downloads,
+    if its expected digest is known.  Bytes of the shard already on disk
+    from an earlier attempt are read back and hashed first.
+
+    :param shard: upstream.shard.Shard instance
+    :param writer: upstream.file.PositionalWriter holding the shard
+    :param offset: Position in the file of the first byte of the shard
+    :param written: Number of bytes of the shard already on disk
+    :return: hashlib object, or None if there is nothing to verify against
+    """
+    if not shard.digest:
+        return None
+    hasher = hashlib.sha256()
+    end = offset + written
+    while offset < end:
+        block = writer.read_at(min(end - offset, 1048576), offset)
+        if not block:
+            break
+        hasher.update(block)
+        offset += len(block)
+    return hasher
+
+
+def verify_shard(shard, hasher):
+    """ Compares a running digest from shard_hasher() to the shard's
+    expected digest.
+
+    :param shard: upstream.shard.Shard instance
+    :param hasher: hashlib object, or None to skip verification
+    :raise IntegrityError: If the digests differ
+    """
+    if hasher is not None and hasher.hexdigest() != shard.digest:
+        raise IntegrityError("Shard %s: expected digest %s, received %s."
+                             % (shard.filehash, shard.digest,
+                                hasher.hexdigest()))
+
+
+class _HashFeed(object):
+
+    """ Stands in for a list of hashers across repeated attempts at
+    sending the same data.  Each attempt feeds it from the first byte
+    again, but the hashers are only given bytes that no earlier attempt
+    got as far as.
+    """
+
+    def __init__(self, hashers):
+        self.hashers = hashers
+        self.fed = 0
+        self.seen = 0
+
+    def restart(self):
+        """ Marks the start of another attempt """
+        self.seen = 0
+
+    def update(self, data):
+        end = self.seen + len(data)
+        if end > self.fed:
+            new = data[self.fed - self.seen:]
+            for hasher in self.hashers:
+                hasher.update(new)
+            self.fed = end
+        self.seen = end
 
 
 class Streamer(object):
 
-    def __init__(self, server):
+    #: Ways of sending an upload request body, by upload_method name
+    UPLOAD_METHODS = {
+        'form': '_upload_form_encoded',
+        'lean': '_upload_lean',
+        'sendfile': '_upload_sendfile',
+        'chunked': '_upload_sharded_encoded',
+    }
+
+    #: Bytes handed to each os.sendfile call by _upload_sendfile
+    SENDFILE_BLOCK = 4194304
+
+    #: Bytes read from disk for each chunk sent by _upload_sharded_encoded
+    CHUNK_SIZE = 262144
+
+    def __init__(self, server, pool_size=10, keep_alive=True,
+                 use_mmap=False, upload_method='form', metrics=None,
+                 limiter=None, retry=None, replicas=1, hedge=None,
+                 probe='eager', probe_cache=None, timeout=300):
         """ For uploading and downloading files from Metadisk.
 
-        :param server: URL to the Metadisk server
+        All requests made by a Streamer, from any thread, share one pool of
+        connections to the server, so that consecutive shard transfers do
+        not each pay for a new TCP and TLS handshake.
+
+        Given several servers, each shard is uploaded to the node expected
+        to take it soonest (see upstream.scheduler.NodeScheduler), and to
+        as many nodes as ``replicas`` asks for.  The returned Shard lists
+        its nodes in ``servers``; downloads of such shards are spread over
+        the nodes holding them.  Shards with no recorded nodes are looked
+        for on every server.
+
+        :param server: URL to the Metadisk server, or a list of URLs of
+        several; the first is the primary server
+        :param pool_size: Maximum number of connections kept open to the
+        server; should be at least the number of concurrent transfers
+        :param keep_alive: Whether to reuse connections between requests
+        :param use_mmap: Whether to read shards for upload through a memory
+        map of the file (upstream.file.MappedShardFile)
+        :param upload_method: How upload request bodies are built; one of
+        ``'form'`` (requests_toolbelt's MultipartEncoder), ``'lean'``
+        (upstream.multipart.MultipartBody, streamed in large buffers) or
+        ``'sendfile'`` (lean, but sending the file data with os.sendfile
+        over a raw socket; falls back to lean for HTTPS servers or where
+        os.sendfile is unavailable) or ``'chunked'`` (raw shard data with
+        chunked transfer encoding, for nodes that accept it)
+        :param metrics: Optional upstream.metrics.Metrics to record the
+        timings and size of every shard transfer in
+        :param limiter: Optional upstream.ratelimit.TokenBucket capping the
+        rate at which shard data is sent and received.  Every transfer of
+        this Streamer draws from it, whichever thread it runs in; share one
+        bucket between Streamers to cap them all together.
+        :param retry: Optional upstream.retry.RetryPolicy.  A shard whose
+        transfer fails with a transient error is tried again under it:
+        uploads from the shard's first byte, downloads from the byte they
+        stopped at.  Without one, the first error is raised.
+        :param replicas: Number of servers each shard is uploaded to
+        :param hedge: Optional upstream.hedge.HedgePolicy.  A shard of
+        download_shards() that falls well behind the others under it is
+        requested again, from the byte it reached, on another connection
+        and preferably from another node; the first request to finish
+        wins and the other is cancelled.
+        :param probe: When to find out which servers are reachable:
+        ``'eager'`` (check_connectivity() on creation, skipping servers
+        with a recent result in probe_cache), ``'lazy'`` (no probe; the
+        first transfer to each server tells, and servers recently found
+        unreachable are left out of the pool) or None (never)
+        :param probe_cache: upstream.probe.ProbeCache of recent results,
+        kept up to date by every transfer; by default one shared by the
+        whole process, remembering results for a minute
+        :param timeout: Seconds to wait for a connection to open, or for
+        the server to accept or send more data, before a transfer fails;
+        None to wait forever
+        :raise ValueError: If there are fewer servers than replicas
         """
-        self.server = server
-        self.check_connectivity()
+        if upload_method not in self.UPLOAD_METHODS:
+            raise ValueError("Unknown upload method %r" % upload_method)
+        if probe not in ('eager', 'lazy', None):
+            raise ValueError("Unknown probe mode %r" % probe)
+        if isinstance(server, six.string_types):
+            server = [server]
+        self.servers = list(server)
+        if not 1 <= replicas <= len(self.servers):
+            raise ValueError("Cannot place %d replica(s) on %d server(s)"
+                             % (replicas, len(self.servers)))
+        self.server = self.servers[0]
+        self.replicas = replicas
+        self.scheduler = NodeScheduler(self.servers)
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.use_mmap = use_mmap
+        self.upload_method = upload_method
+        self.metrics = metrics
+        self.limiter = limiter
+        self.retry = retry
+        self.hedge = hedge
+        self.probe = probe
+        self.timeout = timeout
+        self.probe_cache = (probe_cache if probe_cache is not None
+                            else SHARED_CACHE)
+        self._adapter = HTTPAdapter(pool_connections=len(self.servers),
+                                    pool_maxsize=pool_size)
+        if metrics is not None:
+            instrument_adapter(self._adapter)
+        self._local = threading.local()
+        if probe == 'eager':
+            self.check_connectivity(cached=True)
+        elif probe == 'lazy':
+            reachable = [server for server in self.servers
+                         if self.probe_cache.get(server) is not False]
+            if len(reachable) >= replicas:
+                self._use_servers(reachable)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    @property
+    def session(self):
+        """ The requests.Session for the calling thread.  Each thread gets
+        its own session, as sessions are not safe to share between threads,
+        but every session draws from the same connection pool.
+
+        :return: requests.Session
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            if not self.keep_alive:
+                session.headers['Connection'] = 'close'
+            self._local.session = session
+        return session
+
+    def close(self):
+        """ Closes all pooled connections to the server """
+        self._adapter.close()
 
-    def check_connectivity(self):
+    def check_connectivity(self, cached=False):
         """ Check to see if we even get a connection to the server.
         https://stackoverflow.com/questions/3764291/checking-network-connection
+
+        Of several servers, those that cannot be reached are left out of
+        the pool, as long as enough remain to place every replica.  The
+        probe goes through the connection pool, so the connection it opens
+        is the one the first transfer uses.
+
+        :param cached: Whether to trust recent results in the probe cache
+        rather than probing those servers again
+        :raise ConnectError: If fewer servers than replicas are reachable
         """
-        try:
-            urlopen(self.server, timeout=2)
-        except URLError:
+        reachable = []
+        for server in self.servers:
+            up = self.probe_cache.get(server) if cached else None
+            if up is None:
+                try:
+                    self.session.get(server, timeout=2).raise_for_status()
+                    up = True
+                except requests.exceptions.RequestException:
+                    up = False
+                self.probe_cache.put(server, up)
+            if up:
+                reachable.append(server)
+        if len(reachable) < self.replicas:
             raise ConnectError("Could not connect to server.")
+        self._use_servers(reachable)
+
+    def _use_servers(self, servers):
+        """ Narrows the pool down to servers, the first being primary """
+        self.servers = self.scheduler.servers = servers
+        self.server = servers[0]
 
     def upload(self, filepath, shard_size=0, start_pos=0, read_size=1024,
-               callback=None):
+               callback=None, digest=False, hashers=None):
         """ Uploads a shard via POST to the specified node
         to the web-core API.  See API docs:
         https://github.com/Storj/web-core#api-documentation
 
         :param filepath: Path to file as a string
+        :param digest: If true, the SHA-256 digest of the shard's data is
+        computed as it is sent and stored in the ``digest`` attribute of
+        the returned Shard
+        :param hashers: Optional list of hashlib objects to update with the
+        shard's data as it is sent.  They see each byte once, even if the
+        upload is retried.
+        :return: upstream.shard.Shard, with the servers it was stored on in
+        its ``servers`` attribute
+        :raise ResponseError: If the shard could not be stored on enough
+        servers
+        """
+        hashers = list(hashers or [])
+        if digest:
+            hashers.insert(0, hashlib.sha256())
+        feed = _HashFeed(hashers) if hashers else None
+        if (feed is not None and self.upload_method == 'sendfile' and
+                all(self._sends_file(server) for server in self.servers)):
+            # The data never passes through Python with sendfile, so read
+            # it once more locally rather than giving up on sendfile.
+            hash_range(filepath, start_pos,
+                       shard_size or SizeHelpers.mib_to_bytes(250),
+                       hashers=hashers)
+            feed = None
+        shard = error = None
+        tried = []
+        while shard is None or len(shard.servers) < self.replicas:
+            server = self.scheduler.acquire(exclude=tried)
+            if server is None:
+                raise error
+            tried.append(server)
+            first = shard is None
+            size = 0
+            started = time.time()
+            try:
+                # Only the first copy is hashed and reported as progress.
+                stored = self._upload_to(
+                    server, filepath, shard_size, start_pos, read_size,
+                    callback if first else None, feed if first else None)
+                size = min(shard_size or SizeHelpers.mib_to_bytes(250),
+                           os.path.getsize(filepath) - start_pos)
+            except (ResponseError,) + CONNECTION_ERRORS as e:
+                # Try another node, if there is one.
+                error = e
+                continue
+            finally:
+                self.scheduler.release(server, size, time.time() - started,
+                                       failed=not size)
+            if first:
+                shard = stored
+            elif stored.uri != shard.uri:
+                raise ResponseError("%s stored the shard as %s, but %s as "
+                                    "%s." % (shard.servers[0], shard.uri,
+                                             server, stored.uri))
+            shard.servers.append(server)
+
+        if digest:
+            shard.digest = hashers[0].hexdigest()
+        return shard
+
+    def _upload_to(self, server, filepath, shard_size, start_pos, read_size,
+                   callback=None, feed=None):
+        """ Uploads a shard to one server, retrying as the retry policy
+        allows.
+
+        :param server: URL of the server
+        :param feed: Optional _HashFeed to pass the shard's data to
         :return: upstream.shard.Shard
-        :raise LookupError: IF
         """
-        # Open the file and upload it via POST
-        url = self.server + "/api/upload"  # web-core API
-        r = self._upload_form_encoded(
-            url,
-            filepath,
-            shard_size=shard_size,
-            start_pos=start_pos,
-            read_size=read_size,
-            callback=callback
-        )
+        url = server + "/api/upload"  # web-core API
+        uploader = getattr(self, self.UPLOAD_METHODS[self.upload_method])
+        retries = 0
+        while True:
+            started = time.time()
+            reset_connect_time()
+            r = None
+            if feed is not None:
+                feed.restart()
+            try:
+                r = uploader(
+                    url,
+                    filepath,
+                    shard_size=shard_size,
+                    start_pos=start_pos,
+                    read_size=read_size,
+                    callback=callback,
+                    hashers=[feed] if feed is not None else None
+                )
+                shard = shard_from_upload(r)
+                break
+            except Exception as e:
+                retry = self._should_retry(e, retries)
+                self._record('upload', started, response=r, error=e,
+                             retries=retries, server=server,
+                             final=not retry)
+                if not retry:
+                    raise
+                self.retry.wait(e, retries)
+            retries += 1
+        size = min(shard_size or SizeHelpers.mib_to_bytes(250),
+                   os.path.getsize(filepath) - start_pos)
+        self._record('upload', started, shard, size, r, retries=retries,
+                     server=server)
+        return shard
+
+    def _should_retry(self, error, retries):
+        """ :return: True if this Streamer's retry policy allows another
+        attempt after error
+        """
+        if self.retry is None:
+            return False
+        return self.retry.should_retry(error, retries)
+
+    def _record(self, op, started, shard=None, size=0, response=None,
+                error=None, retries=0, server=None, final=True):
+        """ Records the metrics of an attempt at a shard transfer, if this
+        Streamer collects any.
+
+        :param op: 'upload' or 'download'
+        :param started: time.time() when the transfer started
+        :param shard: upstream.shard.Shard transferred, if known
+        :param size: Bytes of shard data transferred
+        :param response: Response received, if any
+        :param error: Exception the transfer failed with, if it did
+        :param retries: Number of attempts at the shard before this one
+        :param server: URL of the server; the primary server by default
+        :param final: False if the attempt failed and is made again
+
+        Whether the transfer got an answer from the server is noted in the
+        probe cache as well, so that it doubles as a probe.
+        """
+        if self.probe is not None:
+            self.probe_cache.put(server or self.server,
+                                 not isinstance(error, CONNECTION_ERRORS))
+        if self.metrics is None:
+            return
+        elapsed = getattr(response, 'elapsed', None)
+        self.metrics.record(ShardMetrics(
+            op, server or self.server,
+            shard=shard.filehash if shard is not None else None,
+            bytes=size,
+            connect=connect_time(),
+            ttfb=elapsed.total_seconds() if elapsed else None,
+            duration=time.time() - started,
+            retries=retries,
+            error=(str(error) or type(error).__name__)
+            if error is not None else None,
+            final=final))
+
+    def upload_shards(self, filepath, shards, jobs=1, read_size=1024,
+                      callback=None, on_shard=None, index=None,
+                      digests=False, file_hasher=None):
+        """ Uploads several shards of one file, up to ``jobs`` of them at
+        the same time.
+
+        :param filepath: Path to file as a string
+        :param shards: List of (start, end) byte positions, one per shard,
+        as returned by ``upstream.clitool.calculate_shards``
+        :param jobs: Maximum number of shards uploaded concurrently
+        :param read_size: Size of each slice read from disk in bytes
+        :param callback: Optional callable taking a shard index and
+        returning the progress callback to use for that shard, or None
+        :param on_shard: Optional callable invoked as ``on_shard(index,
+        shard)`` as soon as a shard has been uploaded
+        :param index: Optional upstream.index.ShardIndex.  Shards whose
+        content it holds for at least ``replicas`` of the servers are not
+        uploaded again; shards that are uploaded are added to it.
+        :param digests: If true, the SHA-256 digest of each shard's data
+        is stored in its ``digest`` attribute.  Without an index, digests
+        are computed from the data as it is sent rather than by reading
+        the file twice.
+        :param file_hasher: Optional hashlib object to update with every
+        shard's data, in shard order, as it is sent.  Only supported with
+        one job and no index, where shards are read once each and in order.
+        :return: List of upstream.shard.Shard, in shard order
+        :raise TransferError: If any shard failed; shards that did upload
+        are available from its ``results`` attribute
+        """
+        self.check_path(filepath)
+        shards = list(shards)
+        if file_hasher is not None and (jobs > 1 or index is not None):
+            raise ValueError("file_hasher requires jobs=1 and no index")
+
+        def _upload(idx):
+            start, end = shards[idx]
+            return self._upload_range(
+                filepath, start, end, read_size=read_size,
+                callback=callback(idx) if callback else None, index=index,
+                digest=digests,
+                hashers=[file_hasher] if file_hasher is not None else None)
+
+        results, errors = run_jobs(_upload, range(len(shards)), jobs=jobs,
+                                   on_result=on_shard)
+        if errors:
+            raise TransferError(
+                "%d of %d shard(s) failed to upload."
+                % (len(errors), len(shards)),
+                results=results, errors=errors)
+        return results
+
+    def upload_files(self, files, jobs=1, read_size=1024, callback=None,
+                     on_shard=None, index=None, digests=False):
+        """ Uploads the shards of many files, up to ``jobs`` shards at
+        the same time whichever files they belong to.  All of them share
+        one pool of workers and this Streamer's connections, so a batch of
+        small files keeps every worker busy and pays for setting up a
+        connection only once.
 
-        # Make sure that the API call is actually there
-        if r.status_code == 404:
-            raise ResponseError("API call not found.")
-        elif r.status_code == 402:
-            raise ResponseError("Payment required.")
-        elif r.status_code == 500:
-            raise ResponseError("Server error.")
-        elif r.status_code == 201:
-            shard = Shard()
-            shard.from_json(r.text)
+        :param files: List of (filepath, shards) pairs, shards being a list
+        of (start, end) byte positions as for upload_shards()
+        :param jobs: Maximum number of shards uploaded concurrently
+        :param read_size: Size of each slice read from disk in bytes
+        :param callback: Optional callable taking a ``(file index, shard
+        index)`` pair and returning the progress callback for that shard,
+        or None
+        :param on_shard: Optional callable invoked as ``on_shard(file
+        index, shard index, shard)`` as soon as a shard has been uploaded
+        :param index: Optional upstream.index.ShardIndex, as for
+        upload_shards()
+        :param digests: If true, the SHA-256 digest of each shard's data
+        is stored in its ``digest`` attribute
+        :return: For each file, its list of upstream.shard.Shard
+        :raise FileError: If any path is not a file
+        :raise TransferError: If any shard failed; ``results`` holds the
+        list of each file with None for failed shards, and ``errors`` maps
+        (file index, shard index) pairs to exceptions
+        """
+        files = [(self.check_path(filepath), list(shards))
+                 for filepath, shards in files]
+        tasks = [(i, j) for i, (_, shards) in enumerate(files)
+                 for j in range(len(shards))]
+
+        def _upload(task):
+            filepath, shards = files[task[0]]
+            start, end = shards[task[1]]
+            return self._upload_range(
+                filepath, start, end, read_size=read_size,
+                callback=callback(task) if callback else None, index=index,
+                digest=digests)
+
+        def _uploaded(idx, shard):
+            on_shard(tasks[idx][0], tasks[idx][1], shard)
+
+        results, errors = run_jobs(_upload, tasks, jobs=jobs,
+                                   on_result=_uploaded if on_shard else None)
+        shards = [[None] * len(plan) for _, plan in files]
+        for (i, j), shard in zip(tasks, results):
+            shards[i][j] = shard
+        if errors:
+            raise TransferError(
+                "%d of %d shard(s) failed to upload."
+                % (len(errors), len(tasks)),
+                results=shards,
+                errors=dict((tasks[idx], e) for idx, e in errors.items()))
+        return shards
+
+    def _upload_range(self, filepath, start, end, read_size=1024,
+                      callback=None, index=None, digest=False, hashers=None):
+        """ Uploads the shard of filepath from byte start to end, unless
+        index shows it is already stored on enough servers.
+
+        :return: upstream.shard.Shard
+        """
+        if index is None:
+            return self.upload(filepath, shard_size=end - start,
+                               start_pos=start, read_size=read_size,
+                               callback=callback, digest=digest,
+                               hashers=hashers)
+        digest, size = hash_range(filepath, start, end - start)
+        found = [(server, index.lookup(server, digest, size))
+                 for server in self.servers]
+        found = [(server, uri) for server, uri in found if uri]
+        if len(found) >= self.replicas:
+            shard = Shard(digest=digest,
+                          servers=[server for server, _ in found])
+            shard.from_uri(found[0][1])
             return shard
-        else:
-            err = ResponseError("Received status code %s %s"
-                                % (r.status_code, r.reason))
-            err.response = r
-            raise err
+        shard = self.upload(filepath, shard_size=end - start,
+                            start_pos=start, read_size=read_size,
+                            callback=callback, hashers=hashers)
+        shard.digest = digest
+        for server in shard.servers:
+            index.add(server, digest, size, shard.uri)
+        return shard
 
-    def download(self, shard, slicesize=1024):
+    def download(self, shard, slicesize=1024, offset=0, server=None):
         """ Downloads a file from the web-core API.
 
         :param shards: An iterable of upstream.shard.Shard instances
         :param dest: Path to place file as string, otherwise save to CWD using
         filehash as filename
         :param slicesize: Size of shards to write to disk in bytes
+        :param offset: Byte of the shard to start from.  If not zero, a
+        Range request is made; callers must check for a 206 status, as a
+        server ignoring the range answers 200 with the whole shard.
+        :param server: URL of the server to download from; by default the
+        first of the shard's servers, or the primary server
         :return: True if success, else None
         :raise FileError: If dest is not a valid filepath or if already exists
         """
@@ -109,18 +631,130 @@ class Streamer(object):
         except AssertionError:
             raise ShardError("Shard missing filehash.")
 
-        url = "%s/api/download/%s" % (self.server, shard.uri)
+        url = "%s/api/download/%s" % (server or self._home(shard), shard.uri)
+        headers = {'Range': 'bytes=%d-' % offset} if offset else None
 
-        r = requests.get(url, stream=True)
+        r = self.session.get(url, stream=True, headers=headers,
+                             timeout=self.timeout)
         try:
             r.raise_for_status()
         except requests.exceptions.HTTPError as e:
-            err = ResponseError(str(e))
-            err.response = r
-            raise err
+            raise ResponseError(str(e), r)
 
         return r
 
+    def download_shards(self, shards, savepath, jobs=1, sizes=None,
+                        slicesize=8192, done=None, on_progress=None,
+                        on_shard=None, cache=None):
+        """ Downloads several shards into a single file, up to ``jobs`` of
+        them at the same time.  The file is preallocated and each shard is
+        written at its own offset, so shards may finish in any order.
+
+        An interrupted download is continued by passing the number of
+        bytes of each shard already in the file as ``done``; only the rest
+        of each shard is then requested.
+
+        :param shards: List of upstream.shard.Shard instances, in file order
+        :param savepath: Path of the file to write to as string
+        :param jobs: Maximum number of shards downloaded concurrently
+        :param sizes: Optional list of shard sizes in bytes, with None for
+        unknown sizes.  If jobs is above 1 and some sizes are unknown, they
+        are looked up on the server beforehand.
+        :param slicesize: Size of the chunks written to disk in bytes
+        :param done: Optional list of bytes already written for each shard
+        :param on_progress: Optional callable invoked as
+        ``on_progress(index, written)`` from worker threads as each shard
+        is written to disk
+        :param on_shard: Optional callable invoked as ``on_shard(index,
+        size)`` as soon as a shard is complete
+        :param cache: Optional upstream.cache.ShardCache.  Shards are
+        fetched into it, unless already there, and copied out of it; a
+        file made of a single shard is hard linked to the cached copy.
+
+        Shards with a ``digest`` are hashed as they are written; one whose
+        data does not match is fetched again once, from its first byte,
+        before it is reported as failed with an IntegrityError.  Under the
+        Streamer's retry policy, a shard cut short by a transient error is
+        resumed with a Range request from the byte it reached; shards that
+        did finish are left alone.  Under the Streamer's hedge policy,
+        shards lagging behind the others are requested a second time.
+        :return: Total number of bytes written
+        :raise TransferError: If any shard failed; the size of each shard
+        that did finish is in its ``results``
+        """
+        shards = list(shards)
+        done = list(done) if done else [0] * len(shards)
+        if (cache is not None and len(shards) == 1 and
+                not os.path.exists(savepath)):
+            with self._use_cached(cache, shards[0], slicesize) as path:
+                cache.link(shards[0].filehash, savepath)
+                size = os.path.getsize(path)
+            if on_shard is not None:
+                on_shard(0, size)
+            return size
+        if (jobs > 1 and len(shards) > 1 and
+                (sizes is None or None in sizes)):
+            sizes = self._shard_sizes(shards, jobs) or sizes
+        hedger = None
+        if self.hedge is not None and cache is None:
+            hedger = Hedger(self.hedge)
+
+        def _attempt(idx, offset, start):
+            def _progress(written):
+                on_progress(idx, written)
+
+            def _download(lane, begin, progress):
+                return self._download_shard(
+                    shards[idx], lane, offset, size=size,
+                    slicesize=slicesize, start=begin, on_progress=progress,
+                    tried=tried)
+
+            tried = []
+
+            size = sizes[idx] if sizes else None
+            if cache is not None and (size is None or start < size):
+                return self._copy_cached(
+                    cache, shards[idx], writer, offset, slicesize=slicesize,
+                    start=start,
+                    on_progress=_progress if on_progress else None)
+            if hedger is not None:
+                return hedger.run(
+                    idx, _download, writer, start,
+                    on_progress=_progress if on_progress else None)
+            return _download(writer, start,
+                             _progress if on_progress else None)
+
+        def _fetch(idx, offset):
+            try:
+                return _attempt(idx, offset, done[idx])
+            except IntegrityError:
+                # What was written is corrupt: fetch the whole shard again.
+                return _attempt(idx, offset, 0)
+
+        if sizes is None or None in sizes:
+            # Sizes unknown, so offsets are too: fetch one after another.
+            with PositionalWriter(savepath) as writer:
+                offset = 0
+                for idx in range(len(shards)):
+                    size = _fetch(idx, offset)
+                    if on_shard is not None:
+                        on_shard(idx, size)
+                    offset += size
+            return offset
+
+        offsets = [sum(sizes[:i]) for i in range(len(sizes))]
+
+        with PositionalWriter(savepath, size=sum(sizes)) as writer:
+            results, errors = run_jobs(
+                lambda idx: _fetch(idx, offsets[idx]), range(len(shards)),
+                jobs=jobs, on_result=on_shard)
+        if errors:
+            raise TransferError(
+                "%d of %d shard(s) failed to download."
+                % (len(errors), len(shards)),
+                results=results, errors=errors)
+        return sum(results)
+
     @staticmethod
     def check_path(filepath):
         """ Expands and validates a given path to a file and returns it
@@ -137,65 +771,434 @@ class Streamer(object):
         return expandedpath
 
     def _upload_form_encoded(self, url, filepath, shard_size, start_pos,
-                             read_size=1024, callback=None):
+                             read_size=1024, callback=None, hashers=None):
         """ Streams file from disk and uploads it.
 
         :param url: API endpoint as URL to upload to
         :param filepath: Path to file as string
         :return: requests.Response
         """
+        # Only this upload method needs requests_toolbelt.
+        from requests_toolbelt import MultipartEncoder
+
+        with self._open_shard(filepath, shard_size, start_pos, read_size,
+                              callback, hashers) as shard:
+            m = MultipartEncoder({
+                'file': ('file', shard)
+            })
+            headers = {
+                'Content-Type': m.content_type
+            }
+            return self.session.post(url, data=m, headers=headers,
+                                     timeout=self.timeout)
+
+    def _upload_lean(self, url, filepath, shard_size, start_pos,
+                     read_size=1024, callback=None, hashers=None):
+        """ Streams file from disk and uploads it as a MultipartBody.
+
+        :param url: API endpoint as URL to upload to
+        :param filepath: Path to file as string
+        :return: requests.Response
+        """
+        with self._open_shard(filepath, shard_size, start_pos, read_size,
+                              callback, hashers) as shard:
+            body = MultipartBody(shard)
+            headers = {
+                'Content-Type': body.content_type
+            }
+            return self.session.post(url, data=body, headers=headers,
+                                     timeout=self.timeout)
+
+    def _upload_sendfile(self, url, filepath, shard_size, start_pos,
+                         read_size=1024, callback=None, hashers=None):
+        """ Uploads a shard over a raw socket, handing the file data to the
+        kernel with os.sendfile so it is never copied through Python.  The
+        request bypasses the connection pool, proxies and TLS; HTTPS
+        servers, platforms without os.sendfile, and uploads that must hash
+        the data, which never passes through Python here, use _upload_lean;
+        upload() hashes the data beforehand instead of passing hashers.
+
+        :param url: API endpoint as URL to upload to
+        :param filepath: Path to file as string
+        :return: requests.Response
+        """
+        parts = urlsplit(url)
+        if not self._sends_file(url) or hashers:
+            return self._upload_lean(url, filepath, shard_size, start_pos,
+                                     read_size, callback, hashers)
+
+        with self._open_shard(filepath, shard_size, start_pos, read_size,
+                              callback, hashers) as shard:
+            body = MultipartBody(shard)
+            head = (
+                'POST %s HTTP/1.1\r\n'
+                'Host: %s\r\n'
+                'Content-Type: %s\r\n'
+                'Content-Length: %d\r\n'
+                'Connection: close\r\n'
+                '\r\n'
+            ) % (parts.path or '/', parts.netloc, body.content_type,
+                 len(body))
+            head = head.encode('latin-1')
+
+            connecting = time.time()
+            sock = socket.create_connection(
+                (parts.hostname, parts.port or 80), timeout=self.timeout)
+            add_connect_time(time.time() - connecting)
+            try:
+                try:
+                    self._sendfile_body(sock, head, body)
+                except socket.timeout:
+                    raise
+                except socket.error:
+                    # The server may have answered, e.g. with an error,
+                    # and closed before taking the whole body; report its
+                    # response if there is one.
+                    pass
+                return self._read_raw_response(sock, url)
+            finally:
+                sock.close()
+
+    @staticmethod
+    def _sends_file(url):
+        """ :return: True if _upload_sendfile can use os.sendfile for url
+        """
+        return urlsplit(url).scheme == 'http' and hasattr(os, 'sendfile')
+
+    def _sendfile_body(self, sock, head, body):
+        """ Sends request headers and a MultipartBody on a raw socket, with
+        the file part going through os.sendfile.
+
+        :param sock: Connected socket
+        :param head: Request line and headers as bytes
+        :param body: upstream.multipart.MultipartBody to send
+        """
+        shard = body.shard
+        sock.sendall(head + body.preamble)
+        fileno = shard._f_obj.fileno()
+        offset = shard.tell()
+        block = self.SENDFILE_BLOCK
+        if self.limiter is not None:
+            block = min(block, max(1, int(self.limiter.burst)))
+        while offset < shard.max_seek:
+            count = min(shard.max_seek - offset, block)
+            if self.limiter is not None:
+                self.limiter.consume(count)
+            offset += self._sendfile(sock, fileno, offset, count)
+            shard.seek(offset)
+            shard._callback()
+        sock.sendall(body.epilogue)
+
+    @staticmethod
+    def _sendfile(sock, fileno, offset, count):
+        """ Calls os.sendfile on a socket, which has a timeout and so is
+        non-blocking underneath, waiting up to that timeout for the socket
+        to take data whenever its buffer is full.
+
+        :return: Number of bytes sent
+        :raise socket.timeout: If the socket takes nothing for that long
+        """
+        while True:
+            try:
+                return os.sendfile(sock.fileno(), fileno, offset, count)
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+            if not select.select([], [sock], [], sock.gettimeout())[1]:
+                raise socket.timeout("timed out")
+
+    @staticmethod
+    def _read_raw_response(sock, url):
+        """ Reads an HTTP response from a raw socket into a
+        requests.Response, so callers need not care how it was fetched.
+
+        :param sock: Connected socket the request was sent on
+        :param url: URL the request was sent to
+        :return: requests.Response
+        """
+        raw = HTTPResponse(sock, method='POST')
+        raw.begin()
+        try:
+            response = requests.Response()
+            response.status_code = raw.status
+            response.reason = raw.reason
+            response.headers = CaseInsensitiveDict(raw.getheaders())
+            response._content = raw.read()
+            response.encoding = 'utf-8'
+            response.url = url
+            return response
+        finally:
+            raw.close()
+
+    def _open_shard(self, filepath, shard_size, start_pos, read_size=1024,
+                    callback=None, hashers=None):
+        """ Opens the part of a file to upload as a ShardFile, or as a
+        MappedShardFile if this Streamer uses memory maps.
+
+        :param filepath: Path to file as string
+        :param shard_size: Size of the shard in bytes; 0 for the default
+        :param start_pos: Position of the shard in the file in bytes
+        :param hashers: Optional list of hashlib objects fed the shard's
+        data as it is read
+        :return: upstream.file.ShardFile
+        """
         validpath = self.check_path(filepath)
         if shard_size == 0:
             shard_size = SizeHelpers.mib_to_bytes(250)
-        shard = ShardFile(
+        cls = MappedShardFile if self.use_mmap else ShardFile
+        return cls(
             validpath, 'rb',
             shard_size=shard_size,
             start_pos=start_pos,
             read_size=read_size,
-            callback=callback
+            callback=callback,
+            hashers=hashers,
+            limiter=self.limiter
         )
-        m = MultipartEncoder({
-            'file': ('file', shard)
-        })
-        headers = {
-            'Content-Type': m.content_type
-        }
-        return requests.post(url, data=m, headers=headers)
-
-    def _upload_sharded_encoded(self, url, filepath):
-        """ Uploads a file using sharded transfer encoding.
-        web-core does not currently accept this type of uploads because
-        of issues in upstream projects, primariy flask and werkzeug.  Leaving
-        it here for posterity as it might be useful in the future.
-        This function currently rases a NotImplementedError currently becuase
-        it's purposely "deactivated".
+
+    def _download_shard(self, shard, writer, offset, size=None,
+                        slicesize=8192, start=0, on_progress=None,
+                        tried=None):
+        """ Streams a single shard into a PositionalWriter like
+        _download_into, trying again after transient errors, as far as
+        the retry policy allows, from the byte the last attempt reached.
+
+        Each attempt goes to the least loaded of the servers holding the
+        shard, or of all servers if the shard does not say, preferring
+        nodes that have not failed it yet.  A node answering 404 is passed
+        over for the next one straight away.
+
+        :param tried: Optional list of the servers asked for the shard so
+        far, shared between concurrent requests for it so that a hedged
+        request goes to another node; each server asked is added to it
+        :return: Size of the shard in bytes
+        """
+        candidates = getattr(shard, 'servers', None) or self.servers
+        failed = []
+        tried = [] if tried is None else tried
+        reached = [start]
+
+        def _progress(written):
+            reached[0] = written
+            if on_progress is not None:
+                on_progress(written)
+
+        def _will_retry(error):
+            return (self._should_retry(error, retries) or
+                    (getattr(error, 'status_code', None) == 404 and
+                     bool(set(candidates) - set(failed) - set([server]))))
+
+        retries = 0
+        while True:
+            server = (self.scheduler.acquire(candidates, exclude=tried) or
+                      self.scheduler.acquire(candidates, exclude=failed) or
+                      self.scheduler.acquire(candidates))
+            tried.append(server)
+            begun = reached[0]
+            started = time.time()
+            done = False
+            try:
+                size = self._download_into(
+                    shard, writer, offset, size=size, slicesize=slicesize,
+                    start=reached[0], on_progress=_progress,
+                    retries=retries, server=server, will_retry=_will_retry)
+                done = True
+                return size
+            except Cancelled:
+                # Overtaken by a hedged request: the node did nothing wrong.
+                done = True
+                raise
+            except Exception as e:
+                retry = _will_retry(e)
+                failed.append(server)
+                if not retry:
+                    raise
+                if self._should_retry(e, retries):
+                    self.retry.wait(e, retries)
+            finally:
+                self.scheduler.release(server, reached[0] - begun,
+                                       time.time() - started,
+                                       failed=not done)
+            retries += 1
+
+    def _download_into(self, shard, writer, offset, size=None,
+                       slicesize=8192, start=0, on_progress=None,
+                       retries=0, server=None, will_retry=None):
+        """ Streams a single shard into a PositionalWriter.
+
+        :param shard: upstream.shard.Shard instance
+        :param writer: upstream.file.PositionalWriter to write to
+        :param offset: Position in the file of the first byte of the shard
+        :param size: Expected size of the shard in bytes, if known
+        :param slicesize: Size of the chunks written to disk in bytes
+        :param start: Number of bytes of the shard already written, which
+        are not downloaded again
+        :param on_progress: Optional callable invoked with the number of
+        bytes of the shard written so far after each chunk
+        :param retries: Number of attempts at the shard before this one,
+        for metrics
+        :param server: URL of the server to download from, as for download()
+        :param will_retry: Optional callable telling from the exception an
+        attempt failed with whether it will be made again, for metrics
+        :return: Size of the shard in bytes
+        :raise ResponseError: If the shard is shorter or longer than size
+        :raise IntegrityError: If the shard has a digest and its data does
+        not match it
+        """
+        if size is not None and start >= size:
+            verify_shard(shard, shard_hasher(shard, writer, offset, size))
+            return size
+        hasher = shard_hasher(shard, writer, offset, start)
+        server = server or self._home(shard)
+        started = time.time()
+        reset_connect_time()
+        try:
+            r = self.download(shard, slicesize=slicesize, offset=start,
+                              server=server)
+        except ResponseError as e:
+            if start and e.response.status_code == 416:
+                # Nothing left past start: the shard was already complete.
+                verify_shard(shard, hasher)
+                return start
+            self._record('download', started, shard, error=e,
+                         retries=retries, server=server,
+                         final=not (will_retry and will_retry(e)))
+            raise
+        except Exception as e:
+            self._record('download', started, shard, error=e,
+                         retries=retries, server=server,
+                         final=not (will_retry and will_retry(e)))
+            raise
+
+        # A server that does not support ranges sends the whole shard.
+        skip = start if r.status_code != 206 else 0
+        written = start
+        try:
+            for chunk in r.iter_content(slicesize):
+                if skip:
+                    if len(chunk) <= skip:
+                        skip -= len(chunk)
+                        continue
+                    chunk, skip = chunk[skip:], 0
+                if hasher is not None:
+                    hasher.update(chunk)
+                if self.limiter is not None:
+                    self.limiter.consume(len(chunk))
+                written += writer.write_at(chunk, offset + written)
+                if on_progress is not None:
+                    on_progress(written)
+            if size is not None and written != size:
+                raise ResponseError("Shard %s: expected %d bytes, received "
+                                    "%d." % (shard.filehash, size, written))
+            verify_shard(shard, hasher)
+        except Cancelled:
+            # The shard is counted by the request that overtook this one.
+            raise
+        except Exception as e:
+            self._record('download', started, shard, written - start, r, e,
+                         retries, server,
+                         final=not (will_retry and will_retry(e)))
+            raise
+        self._record('download', started, shard, written - start, r,
+                     retries=retries, server=server)
+        return written
+
+    def _use_cached(self, cache, shard, slicesize=8192):
+        """ Returns a context manager giving the path of shard in cache,
+        downloading it there first if needed, and keeping it from being
+        evicted until the with block is left.
+        """
+        def _download(path):
+            with PositionalWriter(path) as writer:
+                try:
+                    self._download_shard(shard, writer, 0,
+                                         slicesize=slicesize)
+                except IntegrityError:
+                    writer.preallocate(0)
+                    self._download_shard(shard, writer, 0,
+                                         slicesize=slicesize)
+        return cache.use(shard.filehash, _download)
+
+    def _copy_cached(self, cache, shard, writer, offset, slicesize=8192,
+                     start=0, on_progress=None):
+        """ Writes shard from cache into writer at offset, skipping the
+        first start bytes, which are already there.
+
+        :return: Size of the shard in bytes
+        """
+        written = start
+        with self._use_cached(cache, shard, slicesize) as path:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                while True:
+                    block = f.read(max(slicesize, 1048576))
+                    if not block:
+                        break
+                    writer.write_at(block, offset + written)
+                    written += len(block)
+                    if on_progress is not None:
+                        on_progress(written)
+        return written
+
+    def _home(self, shard):
+        """ Returns the URL of the server to ask for shard when there is
+        no reason to prefer any: the first of its servers, or the primary
+        server.
+        """
+        servers = getattr(shard, 'servers', None)
+        return servers[0] if servers else self.server
+
+    def _shard_sizes(self, shards, jobs=1):
+        """ Looks up the size of each shard with HEAD requests.
+
+        :param shards: List of upstream.shard.Shard instances
+        :param jobs: Maximum number of concurrent requests
+        :return: List of sizes in bytes, or None if the server did not
+        report the size of every shard
+        """
+        def _size(shard):
+            url = "%s/api/download/%s" % (self._home(shard), shard.uri)
+            r = self.session.head(url, allow_redirects=True,
+                                  timeout=self.timeout)
+            length = r.headers.get('Content-Length')
+            if r.status_code != 200 or length is None:
+                return None
+            return int(length)
+
+        sizes, errors = run_jobs(_size, shards, jobs=jobs)
+        if errors or None in sizes:
+            return None
+        return sizes
+
+    def _upload_sharded_encoded(self, url, filepath, shard_size=0,
+                                start_pos=0, read_size=1024, callback=None,
+                                hashers=None):
+        """ Uploads a shard using chunked transfer encoding: the raw shard
+        data is sent as it is read, without multipart framing and without
+        knowing its length beforehand.  Public web-core nodes do not accept
+        this type of upload because of issues in upstream projects,
+        primarily flask and werkzeug, so only use it with ingest nodes
+        known to support it.
 
         :param url: API endpoint as URL to upload to
         :param filepath: Path to file as string
         :return: requests.Response
-        :raise NotImplementedError: Raises this error on any call.
-        """
-        raise NotImplementedError
-        # validpath = self.check_path(filepath)
-        # return requests.post(url, data=self._filestream(validpath))
-
-    def _filestream(self, filepath):
-        """ Streaming file generator.  Useful when chunked transfer encoding
-        is supported in web-core.
-
-        :param filepath: Path to file to stream
-        :raise FileError: If path is not valid
-        """
-        raise NotImplementedError
-        # expandedpath = os.path.expanduser(filepath)
-        # try:
-        #    os.path.isfile(expandedpath)
-        # except AssertionError:
-        #    raise FileError("%s not a file or not found" % filepath)
-
-        # with open(expandedpath, 'rb') as f:
-        #    while True:
-        #        shard = f.read(self.shard_size)
-        #        if not shard:
-        #            break
-        #        yield shard
+        """
+        with self._open_shard(filepath, shard_size, start_pos,
+                              max(read_size, self.CHUNK_SIZE),
+                              callback, hashers) as shard:
+            headers = {
+                'Content-Type': 'application/octet-stream'
+            }
+            return self.session.post(url, data=self._filestream(shard),
+                                     headers=headers, timeout=self.timeout)
+
+    def _filestream(self, shard):
+        """ Streaming shard generator.  Hiding the ShardFile behind a
+        generator, which has no length, is what makes requests send it
+        with chunked transfer encoding.
+
+        :param shard: upstream.file.ShardFile to stream
+        """
+        for block in shard:
+            yield block
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Paul Durivage for Storj Labs
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+def run_jobs(func, items, jobs=1, on_result=None):
+    """ Calls ``func`` on every item of ``items`` using a bounded pool of
+    ``jobs`` threads.  Results are returned in the same order as ``items``,
+    no matter in which order they complete.  An exception raised for one
+    item does not stop the others; it is collected and returned instead.
+
+    :param func: Callable taking a single item
+    :param items: Iterable of items to process
+    :param jobs: Maximum number of items processed at the same time
+    :param on_result: Optional callable invoked as ``on_result(index,
+    result)`` from the calling thread each time an item succeeds
+    :return: Tuple of (results, errors), where results is a list in item
+    order with ``None`` for failed items and errors is a dict mapping the
+    index of each failed item to its exception
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = {}
+
+    def _run(pair):
+        idx, item = pair
+        try:
+            return idx, func(item), None
+        except Exception as e:
+            return idx, None, e
+
+    def _collect(idx, result, err):
+        if err is not None:
+            errors[idx] = err
+            return
+        results[idx] = result
+        if on_result is not None:
+            on_result(idx, result)
+
+    jobs = max(1, min(int(jobs), len(items)))
+    if jobs == 1:
+        for pair in enumerate(items):
+            _collect(*_run(pair))
+        return results, errors
+
+    # Imported here, as a single job never needs it and it is slow to
+    # import.
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(jobs)
+    try:
+        for outcome in pool.imap_unordered(_run, enumerate(items)):
+            _collect(*outcome)
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return results, errors